@@ -0,0 +1,100 @@
+#!/usr/bin/env python2
+
+# Times the reader on two large inputs, against the reader of another
+# revision (by default, the one before the reader was rewritten around
+# compiled regular expressions), taken from git:
+#
+# - stdlib.lisp a hundred times over, followed by a quoted list of a
+#   hundred thousand items, read from a string;
+# - a single quoted list of two hundred thousand items, one per line,
+#   read from a file a line at a time.
+
+from read import Reader
+import subprocess
+import argparse
+import tempfile
+import time
+import imp
+import sys
+import os
+
+def make_input(copies, items):
+    with open('stdlib.lisp') as f:
+        stdlib = f.read()
+    data = ' '.join('(item-{0} {0})'.format(i)
+                    for i in xrange(items))
+    return stdlib * copies + "\n(define data '({}))\n".format(data)
+
+def make_large_form(lines):
+    items = ''.join('(item-{0} {0})\n'.format(i) for i in xrange(lines))
+    return "(define data '(\n{}))\n".format(items)
+
+def old_reader(revision):
+    source = subprocess.check_output(['git', 'show', revision + ':read.py'])
+    module = imp.new_module('old_read')
+    exec source in module.__dict__
+    # the globals of a module are cleared when it is freed.
+    sys.modules[module.__name__] = module
+    return module.Reader
+
+def read_all(reader_class, text, filename):
+    if filename is None:
+        reader = reader_class(text, '<bench>')
+        return count_forms(reader)
+
+    with open(filename) as f:
+        return count_forms(reader_class(f, filename))
+
+def count_forms(reader):
+    forms = 0
+    while reader.read() is not None:
+        forms += 1
+    return forms
+
+def best_time(reader_class, text, filename, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        forms = read_all(reader_class, text, filename)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, forms
+
+def compare(title, readers, text, filename, repeat):
+    print '{}: {:.1f}MB.'.format(title, len(text) / 1e6)
+    for name, reader_class in readers:
+        elapsed, forms = best_time(reader_class, text, filename, repeat)
+        print '  {}: {} forms in {:.2f}s.'.format(name, forms, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the reader.')
+    parser.add_argument('--old', default='b2f0c9f^', metavar='REVISION',
+                        help='The revision to take the old reader from.')
+    parser.add_argument('--copies', type=int, default=100,
+                        help='The number of copies of stdlib.lisp.')
+    parser.add_argument('--items', type=int, default=100000,
+                        help='The number of items in the quoted list.')
+    parser.add_argument('--lines', type=int, default=200000,
+                        help='The number of lines of the single large form.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='The number of runs to take the best of.')
+    args = parser.parse_args()
+
+    readers = [('old', old_reader(args.old)), ('new', Reader)]
+
+    compare('Many forms', readers, make_input(args.copies, args.items),
+            None, args.repeat)
+
+    text = make_large_form(args.lines)
+    fd, filename = tempfile.mkstemp(suffix='.lisp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        compare('One large form, from a file', readers, text, filename,
+                args.repeat)
+    finally:
+        os.remove(filename)
+
+if __name__ == '__main__':
+    main()
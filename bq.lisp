@@ -1,12 +1,62 @@
-(defun bq-simplify (form)
-  ;; if there's an append in which all arguments are single lengthed
-  ;; lists, convert it to a "list" call:
-  ;; (append '(x) (list y) '(z)) => (list 'x y 'z)
-  ;;
-  ;; if there is a list call in which all forms are quoted, convert it
-  ;; to a single quoted list:
-  ;; (list 'x 'y 'z) => '(x y z)
-  form)
+;; the items of a list in a backquote template are processed into one of:
+;;   (:const x)   the item x itself
+;;   (:value e)   the value of the form e
+;;   (:splice e)  the elements of the value of the form e
+;; which bq-simplify turns into the code that makes the list.
+
+(defun bq-constant? (item)
+  ;; (:value 'x) is as constant as (:const x).
+  (cond ((eq (first item) :const) #t)
+        ((atom (second item)) #f)
+        ((= (len (second item)) 2) (eq (first (second item)) 'quote))
+        (#t #f)))
+
+(defun bq-constant (item)
+  (if (eq (first item) :const)
+      (second item)
+      (second (second item))))
+
+(defun bq-code (item)
+  (if (eq (first item) :const)
+      (list 'quote (second item))
+      (second item)))
+
+(defun bq-list (run)
+  ;; a run of items that are not spliced in makes a quoted list if they
+  ;; are all constants, and a list call otherwise:
+  ;; (:const x) (:const y) => '(x y)
+  ;; (:const x) (:value y) => (list 'x y)
+  (if (all (mapf bq-constant? run))
+      (list 'quote (mapf bq-constant run))
+      (prep 'list (mapf bq-code run))))
+
+(defun bq-run (items)
+  (cond ((null items) nil)
+        ((eq (ffirst items) :splice) nil)
+        (#t (prep (first items) (bq-run (rest items))))))
+
+(defun bq-after-run (items)
+  (cond ((null items) nil)
+        ((eq (ffirst items) :splice) items)
+        (#t (bq-after-run (rest items)))))
+
+(defun bq-parts (items)
+  (cond ((null items) nil)
+        ((eq (ffirst items) :splice)
+         (prep (second (first items)) (bq-parts (rest items))))
+        (#t (prep (bq-list (bq-run items))
+                  (bq-parts (bq-after-run items))))))
+
+(defun bq-simplify (items)
+  ;; the runs of items between the spliced ones are made into lists,
+  ;; which are only appended if anything is spliced in:
+  ;; (:const x) (:value y) (:splice z) => (append (list 'x y) z)
+  (let ((parts (bq-parts items)))
+    (cond ((null parts) ''())
+          ((and (null (rest parts))
+                (not (eq (ffirst items) :splice)))
+           (first parts))
+          (#t (prep 'append parts)))))
 
 (defun bq-is-unquote (form)
   (cond ((atom form) #f)
@@ -28,25 +78,25 @@
 
 (defun bq-process-list-item (form level)
   (cond ((atom form)
-         (list 'quote (list form)))
+         (list :const form))
         ((bq-is-unquote form)
          (if (= level 1)
-             (list 'list (second form))
-             (list 'list (bq-process-list form (-- level)))))
+             (list :value (second form))
+             (list :value (bq-process-list form (-- level)))))
         ((bq-is-unquote-splicing form)
-         (second form))
+         (list :splice (second form)))
         ((bq-is-backquote form)
-         (list 'list
+         (list :value
                (bq-process-list form (++ level))))
         (#t
-         (list 'list
+         (list :value
                (bq-process-list form level)))))
 
 (defun bq-process-list (form level)
-  (prep 'append
-        (mapf (fn (form)
-                (bq-process-list-item form level))
-              form)))
+  (bq-simplify
+   (mapf (fn (form)
+           (bq-process-list-item form level))
+         form)))
 
 (defun bq-process (form level)
   (cond ((atom form)
@@ -66,5 +116,4 @@
          (bq-process-list form level))))
 
 (defmac backquote (form)
-  (bq-simplify
-   (bq-process form 1)))
+  (bq-process form 1))
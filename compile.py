@@ -0,0 +1,414 @@
+from parable import Symbol, List, Integer, String, Error, Function, Macro, \
+    Frame, TailCall, CompiledCode, ParamError, Message, create_error, lookup, \
+    check_function_params, collect_references, collect_heads, may_expand, \
+    Primitive, expand_macro_call, eval_function_composition, \
+    eval as eval_tree, special_forms as tree_forms, true, false, empty_list, \
+    check_try, catch_table, no_catch_error, arg_list, copy_location, locate, IT
+
+# The closure compiler turns a form into a tree of Python closures, one
+# per node, each taking the environment to run in and returning the
+# value of the node. Special forms are dispatched once, at compile time,
+# and local variables are resolved to (depth, slot) addresses in the
+# Frame chain, the same layout the tree-walker uses for lexically
+# addressed code; so functions created by either engine can be called
+# from the other.
+#
+# Primitives registered in parable.py are compiled to a call of their
+# Python function; the arity check is made at compile time.
+#
+# Closures compiled for nodes in tail position return a TailCall instead
+# of calling the function, and the eval loop in parable.py runs it.
+
+class Scope(object):
+    '''The compile time counterpart of a Frame: the names of one level of
+    lexically addressed variables, and the enclosing scope. Past the
+    outermost scope variables are looked up by name at run time.
+
+    '''
+
+    def __init__(self, names, parent):
+        self.names = names
+        self.parent = parent
+
+def find(scope, name):
+    depth = 0
+    while scope is not None:
+        if name in scope.names:
+            return depth, scope.names.index(name)
+        scope = scope.parent
+        depth += 1
+    return None
+
+def scope_depth(scope):
+    depth = 0
+    while scope is not None:
+        scope = scope.parent
+        depth += 1
+    return depth
+
+def parent_at(env, depth):
+    while depth:
+        env = env.parent
+        depth -= 1
+    return env
+
+def error_code(*args):
+    return lambda env: create_error(*args)
+
+def compile_constant(exp):
+    return lambda env: exp
+
+def compile_local(depth, slot):
+    if depth == 0:
+        return lambda env: env.values[slot]
+    elif depth == 1:
+        return lambda env: env.parent.values[slot]
+    else:
+        return lambda env: parent_at(env, depth).values[slot]
+
+def compile_global(exp, depth, location):
+    def global_ref(env):
+        value = lookup(parent_at(env, depth), exp)
+        if value is None:
+            error = create_error(':variable-error',
+                                 ':msg', Message('Unbound variable: {}', exp.name),
+                                 ':form', exp)
+            if location is not None:
+                copy_location(error, location)
+            return error
+        return value
+
+    return global_ref
+
+def compile_symbol(exp, scope, location=None):
+    if exp.kind == Symbol.NIL:
+        return compile_constant(empty_list)
+    elif exp.kind == Symbol.KEYWORD:
+        return compile_constant(exp)
+    elif exp.kind == Symbol.COMPOSITION:
+        return lambda env: eval_function_composition(exp, env)
+
+    address = find(scope, exp)
+    if address is not None:
+        return compile_local(*address)
+
+    return compile_global(exp, scope_depth(scope), location)
+
+def compile_item(form, i, scope, tail):
+    # item i of form. Symbols have no location of their own; errors
+    # about one take its location in form (see List.item_location).
+    exp = form[i]
+    if type(exp) == Symbol:
+        return compile_symbol(exp, scope, form.item_location(i))
+    return compile(exp, scope, tail)
+
+def compile_tree(exp, scope, tail):
+    # forms without a compiler of their own are left to the tree-walker;
+    # the Frame chain carries the names it needs to look variables up.
+    return lambda env: eval_tree(exp, env)
+
+def compile_fn(exp, scope, tail):
+    if len(exp) != 3:
+        return error_code(':form-error',
+                          ':msg', 'Invalid fn expression.',
+                          ':form', exp)
+
+    params = exp[1]
+    body = exp[2]
+    try:
+        check_function_params(params)
+    except ParamError as e:
+        return error_code(':param-error',
+                          ':msg', str(e),
+                          ':form', params)
+
+    # capture the local variables of the enclosing scopes the body
+    # refers to; the closure frame holds their values.
+    names = tuple(p for p in params if p != Symbol('&'))
+    captured = []
+    addresses = []
+    for name in collect_references(body, frozenset(names), []):
+        address = find(scope, name)
+        if address is not None:
+            captured.append(name)
+            addresses.append(compile_local(*address))
+    captured = tuple(captured)
+
+    if captured:
+        body_scope = Scope(names, Scope(captured, None))
+    else:
+        body_scope = Scope(names, None)
+    code = CompiledCode(compile(body, body_scope, True))
+    depth = scope_depth(scope)
+
+    # a macro called in the body can expand to a reference to any
+    # local variable, so the body is then compiled again, lazily, to
+    # run in the whole environment; see may_expand.
+    heads = tuple(collect_heads(body, frozenset(names), [])) if scope else ()
+    full_code = []
+
+    def fn(env):
+        if heads and may_expand(heads, env):
+            if not full_code:
+                full_code.append(CompiledCode(
+                    compile(body, Scope(names, scope), True)))
+            return Function.compiled(params, body, names, full_code[0], env)
+
+        closure = parent_at(env, depth)
+        if captured:
+            closure = Frame(captured, [a(env) for a in addresses], closure)
+        return Function.compiled(params, body, names, code, closure)
+
+    return fn
+
+def compile_mac(exp, scope, tail):
+    if len(exp) != 3:
+        return error_code(':form-error',
+                          ':msg', 'Invalid mac expression.',
+                          ':form', exp)
+
+    def mac(env):
+        try:
+            return Macro(exp[1], exp[2], env)
+        except ParamError as e:
+            return create_error(':param-error',
+                                ':msg', 'Invalid macro parameter list: ' + str(e),
+                                ':form', exp[1])
+
+    return mac
+
+def compile_if(exp, scope, tail):
+    if len(exp) != 4:
+        return error_code(':arg-error',
+                          ':msg', '`if` form accepts exactly 3 arguments; {} given.'.format(len(exp) - 1),
+                          ':form', exp)
+
+    cond_code = compile_item(exp, 1, scope, False)
+    then_code = compile_item(exp, 2, scope, tail)
+    else_code = compile_item(exp, 3, scope, tail)
+
+    def if_(env):
+        cond = cond_code(env)
+        if isinstance(cond, Error):
+            return cond
+
+        # besides the Bools themselves, the values equal to them (the
+        # integers 1 and 0) are accepted; see parable.condition.
+        if cond is true:
+            return then_code(env)
+        elif cond is false:
+            return else_code(env)
+        elif cond == true:
+            return then_code(env)
+        elif cond == false:
+            return else_code(env)
+        else:
+            error = create_error(':type-error',
+                                 ':msg', Message('`if` condition can only be a boolean; got a {} instead.', type(cond).__name__),
+                                 ':form', exp[1])
+            locate(error, exp)
+            return error
+
+    return if_
+
+def compile_quote(exp, scope, tail):
+    if len(exp) != 2:
+        return error_code(':arg-error',
+                          ':msg', '`quote` form accepts exactly one argument; got {} instead.'.format(len(exp) - 1),
+                          ':form', exp)
+    return compile_constant(exp[1])
+
+def compile_try(exp, scope, tail):
+    error = check_try(exp)
+    if error is not None:
+        return lambda env: error
+
+    # errors are values in this engine, so catching one is a type check
+    # on the value of the form; the clauses run in a frame binding `it`
+    # to the type of the error.
+    form_code = compile_item(exp, 1, scope, False)
+    clause_scope = Scope(IT, scope)
+    clauses = [(compile_item(c, 0, clause_scope, False),
+                compile_item(c, 1, clause_scope, tail))
+               for c in exp[2:]]
+    # with keyword types only, the clause is found in a dictionary; the
+    # first of several clauses for the same type wins.
+    codes = None
+    if catch_table(exp[2:]) is not None:
+        codes = dict((c[0], code) for c, (_, code) in reversed(zip(exp[2:], clauses)))
+
+    def try_(env):
+        value = form_code(env)
+        if type(value) != Error:
+            return value
+
+        error_type = value.type
+        frame = Frame(IT, [error_type], env)
+        if codes is not None:
+            code = codes.get(error_type)
+            if code is not None:
+                return code(frame)
+        else:
+            for type_code, code in clauses:
+                if type_code(frame) is error_type:
+                    return code(frame)
+
+        return no_catch_error(exp)
+
+    return try_
+
+def compile_primitive(prim, exp, scope):
+    error = prim.check_arity(exp)
+    if error is not None:
+        return lambda env: error
+
+    arg_codes = [compile_item(exp, i, scope, False)
+                 for i in xrange(1, len(exp))]
+    apply = prim.apply
+
+    # avoid the generic loop over the arguments for the common arities.
+    if len(arg_codes) == 1:
+        arg_code, = arg_codes
+        return lambda env: apply([arg_code(env)], exp)
+    elif len(arg_codes) == 2:
+        first_code, second_code = arg_codes
+        return lambda env: apply([first_code(env), second_code(env)], exp)
+    else:
+        return lambda env: apply([a(env) for a in arg_codes], exp)
+
+def compile_apply(exp, scope, tail):
+    if len(exp) != 3:
+        return error_code(':arg-error',
+                          ':msg', '`apply` expects 2 arguments; {} given.'.format(len(exp) - 1),
+                          ':form', exp)
+
+    func_code = compile_item(exp, 1, scope, False)
+    args_code = compile_item(exp, 2, scope, False)
+
+    def apply(env):
+        func = func_code(env)
+        if isinstance(func, Error):
+            return func
+        if not isinstance(func, Function):
+            return create_error(':type-error',
+                                ':msg', '`apply` first argument must be a function; got {}.'.format(func),
+                                ':form', exp[1])
+        args = args_code(env)
+        if isinstance(args, Error):
+            return args
+        if not isinstance(args, (list, List)):
+            return create_error(':type-error',
+                                ':msg', 'A list not passed as function argument list.',
+                                ':form', args)
+
+        env = func.bind(args)
+        if isinstance(env, Error):
+            return env
+
+        if tail:
+            return TailCall(func.code, env)
+        return eval_tree(func.code, env)
+
+    return apply
+
+def compile_call(exp, scope, tail):
+    head_code = compile_item(exp, 0, scope, False)
+    arg_codes = [compile_item(exp, i, scope, False)
+                 for i in xrange(1, len(exp))]
+
+    # the last macro seen at this call site and its compiled expansion.
+    expansion = [None, None]
+
+    def call(env):
+        func = head_code(env)
+        if isinstance(func, Function):
+            values = [a(env) for a in arg_codes]
+            frame = func.frame(values)
+            if frame is None:
+                return func.arg_error(arg_list(values, exp))
+
+            if tail:
+                return TailCall(func.code, frame)
+            return eval_tree(func.code, frame)
+
+        if isinstance(func, Integer):
+            if len(exp) != 2:
+                return create_error(':arg-error',
+                                    ':msg', 'Index form with more than one argument.',
+                                    ':form', exp)
+
+            second = arg_codes[0](env)
+            if not isinstance(second, (List, String)):
+                return create_error(':type-error',
+                                    ':msg', 'Only lists and strings can be indexed.',
+                                    ':form', exp[1])
+
+            if func < 0 or func > len(second) - 1:
+                return create_error(':index-error',
+                                    ':msg', 'Index {} not valid for the given argument.'.format(func),
+                                    ':form', exp[0])
+
+            if isinstance(second, List):
+                return second[func]
+            else:
+                return String(second[func])
+
+        if isinstance(func, Error):
+            return func
+
+        if not isinstance(func, Macro):
+            error = create_error(':value-error',
+                                 ':msg', 'Not a function or a macro: {}'.format(func),
+                                 ':form', exp[0])
+            locate(error, exp)
+            return error
+
+        if expansion[0] is not func:
+            expanded = expand_macro_call(func, exp)
+            expansion[:] = [func, compile(expanded, scope, tail)]
+
+        return expansion[1](env)
+
+    return call
+
+special_forms = {
+    'fn': compile_fn,
+    'mac': compile_mac,
+    'if': compile_if,
+    'quote': compile_quote,
+    'apply': compile_apply,
+    'try': compile_try,
+    'error': compile_tree,
+}
+
+def compile_sexp(exp, scope, tail):
+    if len(exp) == 0:
+        return compile_constant(empty_list)
+
+    head = exp[0]
+    if type(head) == Symbol:
+        if head.name in special_forms:
+            return special_forms[head.name](exp, scope, tail)
+        prim = tree_forms.get(head)
+        if type(prim) == Primitive:
+            return compile_primitive(prim, exp, scope)
+
+    return compile_call(exp, scope, tail)
+
+def compile(exp, scope, tail):
+    '''Compiles exp into a closure that evaluates it in an environment
+    matching scope. If tail is true, function calls in tail position
+    are returned as TailCall objects instead of being made.
+
+    '''
+
+    t = type(exp)
+    if t == List:
+        return compile_sexp(exp, scope, tail)
+    elif t == Symbol:
+        return compile_symbol(exp, scope)
+    else:
+        return compile_constant(exp)
+
+def eval(exp, env):
+    return eval_tree(CompiledCode(compile(exp, None, True)), env)
@@ -1,9 +1,31 @@
 #!/usr/bin/env python2
 
-from parable import Symbol, eval as eval_form, macro_expand, List, Error
+from parable import Symbol, eval as eval_form, macro_expand, List, Error, Env, \
+    macro_stats, lisp_forms, derived_forms
 from read import Reader, ReadError, EofReadError
 from pprint import pprint
-from util import InvalidAssocList, assoc
+import native
+import cPickle
+import hashlib
+import atexit
+import sys
+import os
+
+# the execution engines that can be chosen with --engine: the
+# tree-walking evaluator in parable.py, the closure compiler in
+# compile.py and the bytecode engine in vm.py. The last two are only
+# imported when chosen (see engine), which keeps them out of the
+# startup time of the default engine.
+engines = {
+    'tree': 'parable',
+    'closure': 'compile',
+    'vm': 'vm',
+}
+
+def engine(name):
+    '''Returns the eval function of the named engine.'''
+
+    return __import__(engines[name]).eval
 
 class LoadWarning(RuntimeWarning):
     def __init__(self, msg, form):
@@ -16,7 +38,8 @@ class LoadError(RuntimeError):
         self.form = form
 
 def display_form(form, context):
-    if form.filename == '<string>' or form.filename == '':
+    # forms read from a string or a pipe have no file to show them from.
+    if form.filename.startswith('<') or form.filename == '':
         return
 
     with open(form.filename) as f:
@@ -93,25 +116,26 @@ def print_exception(e):
     display_form(e.form, True)
 
 def print_error(e):
-    try:
-        msg = assoc(e.attrs, Symbol(':msg'))
-    except (KeyError, InvalidAssocList):
-        msg = ''
-
-    try:
-        form = assoc(e.attrs, Symbol(':form'))
-    except (KeyError, InvalidAssocList):
-        form = e
+    msg = e.get(':msg', '')
+    form = e.get(':form', e)
 
     if msg:
         print 'Error of type "{}": {}'.format(e.type.name, msg)
     else:
         print 'Error of type "{}".'.format(e.type.name)
 
-    if form:
+    # an error is located where its form is, or where the symbol it is
+    # about appears (see parable.locate).
+    if e.filename:
+        display_form(e, True)
+    elif form:
         display_form(form, True)
 
-def run_tests(f, filename, env):
+def print_macro_stats():
+    print 'Macro expansions: {} cached, {} expanded.'.format(
+        macro_stats['hits'], macro_stats['misses'])
+
+def run_tests(f, filename, env, eval_form=eval_form):
     passed = 0
     failed = 0
     error = 0
@@ -134,16 +158,16 @@ def run_tests(f, filename, env):
         elif isinstance(result, Error):
             error += 1
 
-            try:
-                desc = assoc(result.attrs, Symbol(':msg'))
+            desc = result.get(':msg')
+            if desc is not None:
                 print 'Test error ({}): {}'.format(result.type.name, desc)
-            except (KeyError, InvalidAssocList) as e:
+            else:
                 print 'Test error ({}).'.format(result.type.name)
 
-            try:
-                form = assoc(result, Symbol(':form'))
+            form = result.get(':form')
+            if form is not None:
                 display_form(form, False)
-            except (KeyError, InvalidAssocList):
+            else:
                 print 'No location information for the error.'
         else:
             error += 1
@@ -152,7 +176,111 @@ def run_tests(f, filename, env):
 
     return passed, failed, error
 
-def load(f, filename, env):
+# the version of the format of the cache files load keeps next to each
+# loaded file; bump it whenever the forms the reader or the macro
+# expander produce change.
+cache_version = 8
+
+def cache_filename(filename):
+    return filename + 'c'
+
+def cache_key(f, env):
+    '''Returns the key a cache of the expanded forms of the file f is
+    valid for when loaded into env, or None if there can be none. The
+    expansion of a form depends on whatever the macros see in env,
+    which is what the files loaded into it before defined; so the names
+    and keys of those files are part of the key, along with the names
+    bound in env, which also covers a mapping with no record of what
+    was loaded into it. The file is read to the end, a chunk at a time.
+
+    '''
+
+    loaded = getattr(env, 'loaded', ())
+    if any(key is None for _, key in loaded):
+        # a file loaded without a key, which it cannot be told apart by.
+        return None
+
+    h = hashlib.sha1()
+    h.update('{}\0{}\0'.format(cache_version, sys.version))
+    for chunk in iter(lambda: f.read(65536), ''):
+        h.update(chunk)
+    for filename, key in loaded:
+        h.update('\0{}\0{}'.format(filename, key))
+    # env is an Env or a plain mapping of names to values.
+    vars = env.vars if isinstance(env, Env) else env
+    h.update('\0'.join(sorted(name.name for name in vars)))
+    return h.hexdigest()
+
+def read_cache(filename, key):
+    '''Returns the list of pickled expanded forms cached for filename, or
+    None if there is no cache valid for key.
+
+    '''
+
+    try:
+        with open(cache_filename(filename), 'rb') as f:
+            cached_key, forms = cPickle.load(f)
+    except Exception:
+        # no cache, or one we cannot read; either way, it gets rebuilt.
+        return None
+
+    if cached_key != key:
+        return None
+    return forms
+
+def write_cache(filename, key, forms):
+    tmp = '{}.{}'.format(cache_filename(filename), os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            cPickle.dump((key, forms), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, cache_filename(filename))
+    except (IOError, OSError):
+        # the cache is only an optimization.
+        pass
+
+# the version of the image format; images written by another version,
+# or by another Python version, are refused.
+image_version = 11
+
+def dump_image(env, filename):
+    '''Writes env, with everything reachable from it (functions, macros
+    and the environments they are closed over), to an image file that
+    load_image can later restore it from.
+
+    '''
+
+    try:
+        data = cPickle.dumps((image_version, sys.version, env),
+                             cPickle.HIGHEST_PROTOCOL)
+    except (cPickle.PicklingError, TypeError) as e:
+        # functions made by the closure engine hold Python closures.
+        raise LoadError('Cannot write an image of this environment: {}'.format(e), None)
+
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def load_image(filename):
+    '''Returns the environment stored in an image written by dump_image.'''
+
+    with open(filename, 'rb') as f:
+        try:
+            version, python_version, env = cPickle.load(f)
+        except Exception:
+            raise LoadError('Invalid image file: {}'.format(filename), None)
+
+    if version != image_version or python_version != sys.version:
+        raise LoadError('Image {} was written by another version.'.format(filename), None)
+
+    return env
+
+def read_forms(f, filename, env):
+    '''Reads the top-level forms in f and yields each one along with its
+    macro expansion, which is done in env right before the form is
+    yielded; that way each form sees the definitions of the previous
+    ones.
+
+    '''
+
     reader = Reader(f, filename)
     while True:
         form = reader.read()
@@ -161,61 +289,189 @@ def load(f, filename, env):
             break
 
         expanded, _ = macro_expand(form, env)
+        yield form, expanded
+
+# the standard library. The definitions it makes of the derived forms
+# (let, cond, when and so on) are recorded in the environment it is
+# loaded into, as those the native forms stand for (see
+# parable.runs_natively).
+stdlib_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'stdlib.lisp')
 
+def is_stdlib(filename):
+    try:
+        return os.path.samefile(filename, stdlib_filename)
+    except OSError:
+        return False
+
+def load(f, filename, env, eval_form=eval_form, use_cache=True):
+    # the expanded forms are cached in a file next to the loaded one,
+    # which saves reading and expanding them the next time the file is
+    # loaded into the same environment.
+    if filename.startswith('<'):
+        use_cache = False
+
+    cached = None
+    key = None
+    if use_cache:
+        try:
+            start = f.tell()
+            key = cache_key(f, env)
+            f.seek(start)
+        except IOError:
+            # a pipe, which can only be read once.
+            key = None
+        if key is None:
+            use_cache = False
+        else:
+            cached = read_cache(filename, key)
+
+    if cached is not None:
+        forms = ((cPickle.loads(i),) * 2 for i in cached)
+    else:
+        forms = read_forms(f, filename, env)
+
+    stdlib = isinstance(env, Env) and is_stdlib(filename)
+    pickled = []
+    for form, expanded in forms:
         if type(expanded) != List or len(expanded) != 3 or expanded[0] != Symbol('define'):
             raise LoadWarning('Unrecognized top-level form.', expanded)
 
         if type(expanded[1]) != Symbol:
             raise LoadError('Invalid top-level form.', form)
 
+        if use_cache and cached is None and pickled is not None:
+            # pickle the form before evaluating it adds anything to it.
+            try:
+                pickled.append(cPickle.dumps(expanded, cPickle.HIGHEST_PROTOCOL))
+            except (cPickle.PicklingError, TypeError):
+                # a macro put a value that cannot be pickled in it.
+                pickled = None
+
         val = eval_form(expanded[2], env)
         if isinstance(val, Error):
             print_error(val)
             exit(2)
         env[expanded[1]] = val
+        if stdlib and expanded[1] in derived_forms:
+            env.stdlib[expanded[1]] = val
+
+    if use_cache and cached is None and pickled is not None:
+        write_cache(filename, key, pickled)
+
+    # the files loaded after this one are cached for an env with it.
+    if isinstance(env, Env):
+        env.loaded += ((filename, key),)
 
     return env
 
+def open_input(filename):
+    '''Opens a file given on the command line, returning it along with
+    the name to report locations in it with. "-" is the standard input,
+    which is read a form at a time as it arrives.
+
+    '''
+
+    if filename == '-':
+        return os.fdopen(os.dup(sys.stdin.fileno())), '<stdin>'
+    return open(filename), filename
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(
         description='Loads and evaluates parable files and expressions.')
     parser.add_argument('-l', '--load', type=str, dest='load_files',
                         nargs='+', metavar='FILES',
-                        help='Load one or more files.')
+                        help='Load one or more files; - is the standard '
+                        'input.')
     parser.add_argument('-t', '--test', type=str, dest='test_files',
                         nargs='+', metavar='FILES',
-                        help='run one or more test files.')
+                        help='run one or more test files; - is the '
+                        'standard input.')
     parser.add_argument('-e', '--eval', type=str, dest='eval_expression',
                         metavar='EXPR',
                         help='Evaluate the given expression.')
     parser.add_argument('-m', '--macro-expand', type=str,
                         dest='expand_expression', metavar='EXPR',
                         help='Macro-expand the given expression.')
+    parser.add_argument('-d', '--disassemble', type=str,
+                        dest='disassemble_expression', metavar='EXPR',
+                        help='Print the bytecode the given expression '
+                        'compiles to.')
+    parser.add_argument('--engine', type=str, dest='engine',
+                        choices=sorted(engines), default='tree',
+                        help='The engine to evaluate code with.')
+    parser.add_argument('--native', type=str, dest='native',
+                        choices=['on', 'off', 'check'], default='on',
+                        help='Use the native versions of stdlib functions, '
+                        'or check them against the Lisp versions.')
+    parser.add_argument('--lisp-forms', action='store_true',
+                        dest='lisp_forms',
+                        help='Use the stdlib definitions of let, let*, '
+                        'cond, when, and and or instead of the native '
+                        'special forms.')
+    parser.add_argument('--image', type=str, dest='image', metavar='FILE',
+                        help='Start from the environment in an image file '
+                        'instead of an empty one.')
+    parser.add_argument('--dump-image', type=str, dest='dump_image',
+                        metavar='FILE',
+                        help='Write the environment to an image file after '
+                        'loading files.')
+    parser.add_argument('--no-cache', action='store_false', dest='cache',
+                        help='Do not use or write the cache of expanded '
+                        'forms next to loaded files.')
+    parser.add_argument('--macro-stats', action='store_true',
+                        dest='macro_stats',
+                        help='Print macro expansion cache statistics on exit.')
     args = parser.parse_args()
 
     count = len(list(
         1 for i in ('eval_expression',
                     'expand_expression',
+                    'disassemble_expression',
                     'test_files')
         if getattr(args, i) != None))
 
     if count > 1:
-        print 'Only one of -t, -m and -e can be used.'
+        print 'Only one of -t, -m, -d and -e can be used.'
         exit(1)
-    elif count == 0:
-        print 'Either -t, -m or -e must be used.'
+    elif count == 0 and not args.dump_image:
+        print 'Either -t, -m, -d, -e or --dump-image must be used.'
         exit(1)
 
-    env = {}
-    for lib in args.load_files:
-        with open(lib) as f:
+    eval_form = engine(args.engine)
+    lisp_forms(args.lisp_forms)
+
+    if args.macro_stats:
+        atexit.register(print_macro_stats)
+
+    try:
+        env = load_image(args.image) if args.image else Env()
+    except (IOError, LoadError) as e:
+        print_exception(e)
+        exit(2)
+
+    for lib in args.load_files or []:
+        f, lib = open_input(lib)
+        with f:
             try:
-                env.update(load(f, lib, env))
+                env.update(load(f, lib, env, eval_form, args.cache))
             except (LoadError, LoadWarning) as e:
                 print_exception(e)
                 exit(2)
 
+    # images hold the Lisp versions of the native functions, so that
+    # --native applies to the runs that load them too.
+    if args.dump_image:
+        try:
+            dump_image(env, args.dump_image)
+        except (IOError, LoadError) as e:
+            print_exception(e)
+            exit(2)
+
+    if args.native != 'off':
+        native.install(env, check=args.native == 'check')
+
     if args.eval_expression:
         try:
             form = Reader(args.eval_expression, '<string>').read()
@@ -238,12 +494,22 @@ def main():
             print_error(result)
             exit(2)
         print 'Macro Expansion Result:', result[1], pprint(result[0])
+    elif args.disassemble_expression:
+        try:
+            form = Reader(args.disassemble_expression, '<string>').read()
+        except ReadError as e:
+            print_exception(e)
+            exit(2)
+        from vm import assemble, disassemble
+        expanded, _ = macro_expand(form, env)
+        print disassemble(assemble(expanded, None, True))
     elif args.test_files:
         passed = failed = error = 0
         for test_file in args.test_files:
             try:
-                with open(test_file) as f:
-                    p, f, e = run_tests(f, test_file, env)
+                f, test_file = open_input(test_file)
+                with f:
+                    p, f, e = run_tests(f, test_file, env, eval_form)
                     passed += p
                     failed += f
                     error += e
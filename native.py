@@ -0,0 +1,370 @@
+from parable import Symbol, List, Integer, String, Error, Function, \
+    CompiledCode, create_error, special_forms, make_integer, true, false, \
+    empty_list
+
+# Python implementations of some of the functions in stdlib.lisp. The
+# Lisp versions recurse once per list element and copy the list with
+# `rest` at each step, so they are quadratic and run out of Python stack
+# on long lists.
+#
+# A native function replaces the Lisp function of the same name in an
+# environment (see install), keeping its parameter list and body, so it
+# is still a function to typeof and pprint, and can be called by any
+# engine. It only handles the arguments the Lisp version is normally
+# called with; for anything else (e.g. a list argument that is not a
+# list) it calls the Lisp version, so the two always behave the same.
+
+# the forms errors from the integer primitives point at.
+iadd_form = List([Symbol('iadd'), Symbol('n'), Symbol('m')])
+imul_form = List([Symbol('imul'), Symbol('n'), Symbol('m')])
+
+def equal(v1, v2):
+    '''The `=` function of stdlib.lisp: values of the same type that are
+    eq, or lists of equal elements.
+
+    '''
+
+    if type(v1) != type(v2):
+        return False
+    if type(v1) != List:
+        return v1 == v2
+    if len(v1) != len(v2):
+        return False
+    for i, j in zip(v1, v2):
+        if not equal(i, j):
+            return False
+    return True
+
+def prep_all(items, tail):
+    '''Returns what prepending items to tail one by one, from the last one
+    to the first, would: an error if any of them is an error, or tail
+    is not a list.
+
+    '''
+
+    for i in items:
+        if type(i) == Error:
+            return i
+    if type(tail) == Error:
+        return tail
+    if type(tail) != List:
+        return create_error(':type-error',
+                            ':msg', '`prep` second argument must be a list.')
+    return List(items) + tail
+
+def all_lists(values):
+    return all(type(i) == List for i in values)
+
+def native_append2(lisp, l1, l2):
+    if type(l1) != List:
+        return lisp(l1, l2)
+    if l1 == []:
+        return l2
+    return prep_all(l1, l2)
+
+def native_append(lisp, lists):
+    result = empty_list
+    for l in reversed(lists):
+        if type(l) != List:
+            return lisp(*lists)
+        if l != []:
+            result = prep_all(l, result)
+    return result
+
+def native_mapf(lisp, func, args):
+    if type(func) != Function or type(args) != List:
+        return lisp(func, args)
+    return prep_all([func.call(List([i])) for i in args], empty_list)
+
+def native_map1(lisp, func, args_list):
+    if type(args_list) != List or not all_lists(args_list):
+        return lisp(func, args_list)
+    if args_list == []:
+        return empty_list
+    if type(func) != Function:
+        return lisp(func, args_list)
+
+    n = min(len(i) for i in args_list)
+    results = []
+    for i in xrange(n):
+        args = List([args[i] for args in args_list])
+        results.append(func.call(args))
+    return prep_all(results, empty_list)
+
+def native_len(lisp, arg):
+    if type(arg) == List or type(arg) == String:
+        return make_integer(len(arg))
+    return create_error(':type-error',
+                        ':msg', '`len` argument should be either a list or a string.')
+
+def native_reduce(lisp, f, lst):
+    if type(f) != Function:
+        return create_error(':type-error')
+    if type(lst) != List:
+        return create_error(':type-error')
+    if lst == []:
+        return create_error(':value-error')
+
+    acc = lst[0]
+    for i in lst[1:]:
+        acc = f.call(List([acc, i]))
+    return acc
+
+def native_equal(lisp, v1, v2):
+    return true if equal(v1, v2) else false
+
+def integer_fold(prim, form, identity, values):
+    # (prim v0 (prim v1 ... (prim vn identity)))
+    prim = special_forms[prim]
+    acc = make_integer(identity)
+    for i in reversed(values):
+        acc = prim.apply([i, acc], form)
+    return acc
+
+def native_add(lisp, values):
+    if all(type(i) == Integer for i in values):
+        return make_integer(sum(values))
+    return integer_fold(Symbol('iadd'), iadd_form, 0, values)
+
+def native_multiply(lisp, values):
+    if all(type(i) == Integer for i in values):
+        result = 1
+        for i in values:
+            result *= i
+        return make_integer(result)
+    return integer_fold(Symbol('imul'), imul_form, 1, values)
+
+def native_max(lisp, lst):
+    if type(lst) != List or not all(type(i) == Integer for i in lst):
+        return lisp(lst)
+    if lst == []:
+        return create_error(':value-error',
+                            ':msg', 'Argument cannot be an empty list.')
+
+    # like the Lisp version, the first of equal elements wins.
+    m = lst[-1]
+    for i in reversed(lst[:-1]):
+        if not i < m:
+            m = i
+    return m
+
+def native_min(lisp, lst):
+    if type(lst) != List or not all(type(i) == Integer for i in lst):
+        return lisp(lst)
+    if lst == []:
+        return create_error(':value-error',
+                            ':msg', 'Argument cannot be an empty list.')
+
+    # like the Lisp version, the last of equal elements wins.
+    m = lst[-1]
+    for i in reversed(lst[:-1]):
+        if i < m:
+            m = i
+    return m
+
+def native_remove(lisp, item, lst):
+    if type(lst) != List:
+        return lisp(item, lst)
+    return prep_all([i for i in lst if not equal(item, i)], empty_list)
+
+def native_zip1(lisp, lists):
+    if type(lists) != List or not all_lists(lists):
+        return lisp(lists)
+    if lists == []:
+        return empty_list
+
+    n = min(len(i) for i in lists)
+    rows = [prep_all([l[i] for l in lists], empty_list) for i in xrange(n)]
+    return prep_all(rows, empty_list)
+
+def native_assoc(lisp, key, alist):
+    if type(alist) != List:
+        return Symbol(':#ERROR-INVALID#:')
+
+    for i in xrange(0, len(alist), 2):
+        if i + 1 == len(alist):
+            return Symbol(':#ERROR-INVALID#:')
+        if equal(alist[i], key):
+            return alist[i + 1]
+    return Symbol(':#ERROR-NOT-FOUND#:')
+
+# the backquote expander of bq.lisp. The items of a list template are
+# processed into (kind, x) pairs, the same as the tagged lists of the
+# Lisp version.
+QUOTE = Symbol('quote')
+LIST = Symbol('list')
+APPEND = Symbol('append')
+BACKQUOTE = Symbol('backquote')
+UNQUOTE = Symbol('unquote')
+UNQUOTE_SPLICING = Symbol('unquote-splicing')
+CONST = Symbol(':const')
+VALUE = Symbol(':value')
+SPLICE = Symbol(':splice')
+
+class BackquoteFallback(Exception):
+    # raised for templates the native expander leaves to the Lisp one.
+    pass
+
+def bq_head(form):
+    if type(form) != List or len(form) == 0:
+        return None
+    return form[0]
+
+def bq_second(form):
+    # what (second form) gives in Lisp for anything but a one element
+    # list, which gives an error the Lisp version keeps as a value.
+    if len(form) < 2:
+        raise BackquoteFallback()
+    return form[1]
+
+def bq_constant(item):
+    # the value of a constant item, or None if it is not one.
+    kind, x = item
+    if kind is CONST:
+        return (x,)
+    if type(x) == List and len(x) == 2 and x[0] is QUOTE:
+        return (x[1],)
+    return None
+
+def bq_list(run):
+    constants = [bq_constant(i) for i in run]
+    if all(c is not None for c in constants):
+        return List([QUOTE, List(c[0] for c in constants)])
+    return List([LIST] + [List([QUOTE, x]) if kind is CONST else x
+                          for kind, x in run])
+
+def bq_simplify(items):
+    parts = []
+    run = []
+    for item in items:
+        if item[0] is SPLICE:
+            if run:
+                parts.append(bq_list(run))
+                run = []
+            parts.append(item[1])
+        else:
+            run.append(item)
+    if run:
+        parts.append(bq_list(run))
+
+    if not parts:
+        return List([QUOTE, empty_list])
+    if len(parts) == 1 and items[0][0] is not SPLICE:
+        return parts[0]
+    return List([APPEND] + parts)
+
+def bq_process_list_item(form, level):
+    if type(form) != List:
+        return (CONST, form)
+
+    head = bq_head(form)
+    if head is UNQUOTE:
+        if level == 1:
+            return (VALUE, bq_second(form))
+        return (VALUE, bq_process_list(form, level - 1))
+    elif head is UNQUOTE_SPLICING:
+        return (SPLICE, bq_second(form))
+    elif head is BACKQUOTE:
+        return (VALUE, bq_process_list(form, level + 1))
+    return (VALUE, bq_process_list(form, level))
+
+def bq_process_list(form, level):
+    return bq_simplify([bq_process_list_item(i, level) for i in form])
+
+def bq_process(form, level):
+    if type(form) != List:
+        return List([QUOTE, form]) if level == 1 else form
+
+    head = bq_head(form)
+    if head is UNQUOTE:
+        if level == 1:
+            return bq_second(form)
+        return bq_process_list(form, level - 1)
+    elif head is UNQUOTE_SPLICING:
+        return create_error(':backquote-error',
+                            ':msg', 'unquote-splicing immediately inside backquote.')
+    elif head is BACKQUOTE:
+        return bq_process_list(form, level + 1)
+    return bq_process_list(form, level)
+
+def native_bq_process(lisp, form, level):
+    if type(level) != Integer:
+        return lisp(form, level)
+    try:
+        return bq_process(form, level)
+    except BackquoteFallback:
+        return lisp(form, level)
+
+# the native implementation of each function, and whether it takes its
+# arguments as a single rest list.
+natives = {
+    'append2': (native_append2, False),
+    'append': (native_append, True),
+    'mapf': (native_mapf, False),
+    'map1': (native_map1, False),
+    'len': (native_len, False),
+    'reduce': (native_reduce, False),
+    '=': (native_equal, False),
+    '+': (native_add, True),
+    '*': (native_multiply, True),
+    'max': (native_max, False),
+    'min': (native_min, False),
+    'remove': (native_remove, False),
+    'zip1': (native_zip1, False),
+    'assoc': (native_assoc, False),
+    'bq-process': (native_bq_process, False),
+}
+
+class Native(object):
+    '''The code of a native function: called with the frame the arguments
+    are bound in, it runs the Python implementation. In check mode it
+    runs the Lisp version as well, and returns a :native-mismatch
+    error if the two results differ.
+
+    '''
+
+    __slots__ = ['name', 'impl', 'rest', 'lisp', 'check']
+
+    def __init__(self, name, impl, rest, lisp, check):
+        self.name = name
+        self.impl = impl
+        self.rest = rest
+        self.lisp = lisp
+        self.check = check
+
+    def call_lisp(self, *args):
+        return self.lisp.call(List(args))
+
+    def __call__(self, env):
+        result = self.impl(self.call_lisp, *env.values)
+        if not self.check:
+            return result
+
+        if self.rest:
+            expected = self.call_lisp(*env.values[0])
+        else:
+            expected = self.call_lisp(*env.values)
+        if not equal(result, expected):
+            return create_error(':native-mismatch',
+                                ':msg', 'Native `{}` returned {} instead of {}.'.format(
+                                    self.name, result, expected))
+        return result
+
+def install(env, check=False):
+    '''Replaces the Lisp functions in env that have a native implementation
+    with it. With check set, the native functions also run the Lisp
+    version and compare the results.
+
+    '''
+
+    for name, (impl, rest) in natives.items():
+        lisp = env.get(Symbol(name))
+        if type(lisp) != Function:
+            continue
+        if type(lisp.code) == CompiledCode and type(lisp.code.run) == Native:
+            # already installed.
+            lisp = lisp.code.run.lisp
+
+        code = CompiledCode(Native(name, impl, rest, lisp, check))
+        env[Symbol(name)] = Function.compiled(lisp.params, lisp.body,
+                                              lisp.names, code, lisp.env)
@@ -1,5 +1,12 @@
 from cStringIO import StringIO
-from util import assoc
+from util import assoc, InvalidAssocList
+from array import array
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class ParamError(RuntimeError):
     def __init__(self, msg, form):
@@ -11,16 +18,128 @@ class ArgError(RuntimeError):
         self.form = form
         super(ArgError, self).__init__(msg)
 
-class Error(object):
-    def __init__(self, type, attrs):
+def location_field(shift):
+    mask = 0xffffffff << shift
+
+    def get(self):
+        return int((getattr(self, '_location', 0) & mask) >> shift)
+
+    def set(self, value):
+        location = getattr(self, '_location', 0) & ~mask
+        self._location = location | (value << shift)
+
+    return property(get, set)
+
+def set_filename(self, filename):
+    self._filename = intern(str(filename))
+
+class Located(object):
+    '''Gives a value a source location: the start and end row and column,
+    packed into a single integer, and the filename, interned so that
+    the nodes read from a file share it. Both are kept in slots the
+    subclass declares (`_location` and `_filename`) and are only set on
+    values that have a location, such as those made by the reader; the
+    others report an empty location.
+
+    '''
+
+    __slots__ = []
+
+    start_row = location_field(96)
+    start_col = location_field(64)
+    end_row = location_field(32)
+    end_col = location_field(0)
+    filename = property(lambda self: getattr(self, '_filename', ''),
+                        set_filename)
+
+    def set_location(self, filename, start_row, start_col, end_row, end_col):
+        self._location = start_row << 96 | start_col << 64 | \
+                         end_row << 32 | end_col
+        self._filename = intern(str(filename))
+
+class Location(Located):
+    '''The location of a value that cannot carry one of its own, being
+    shared: that of a symbol or boolean where it appears in a list read
+    from a file (see List.item_location).
+
+    '''
+
+    __slots__ = ['_location', '_filename']
+
+class Message(object):
+    '''An error message, formatted from fmt and args only when the error
+    attributes are looked at, so that errors which are only checked for
+    their type do not pay for it.
+
+    '''
+
+    __slots__ = ['fmt', 'args']
+
+    def __init__(self, fmt, *args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args)
+
+def attr_value(value):
+    return str(value) if type(value) == Message else value
+
+class Error(Located):
+    '''An error value. Errors made by create_error keep the attribute
+    names and values as given (`pairs`) and only build the attribute
+    list, format the message and look up the location of the :form
+    attribute when one of them is asked for.
+
+    '''
+
+    __slots__ = ['type', 'pairs', '_attrs', '_location', '_filename']
+
+    def __init__(self, type, attrs, pairs=None):
         self.type = type
-        self.attrs = attrs
+        self.pairs = pairs
+        self._attrs = attrs
+
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            pairs = self.pairs
+            items = []
+            for i in xrange(0, len(pairs), 2):
+                items.append(Symbol(pairs[i]))
+                items.append(attr_value(pairs[i + 1]))
+            self._attrs = List(items)
+        return self._attrs
+
+    def get(self, name, default=None):
+        '''Returns the value of the attribute with the given name (like
+        ':msg'), or default if there is none.
+
+        '''
+
+        if self._attrs is None:
+            pairs = self.pairs
+            for i in xrange(0, len(pairs), 2):
+                if pairs[i] == name:
+                    return attr_value(pairs[i + 1])
+            return default
 
-        self.start_row = 0
-        self.start_col = 0
-        self.end_row = 0
-        self.end_col = 0
-        self.filename = ''
+        try:
+            return assoc(self._attrs, Symbol(name))
+        except (KeyError, InvalidAssocList):
+            return default
+
+    def __getattr__(self, name):
+        # only called for the location slots while they are not set:
+        # an error made by create_error takes the location of its
+        # :form, the others have none.
+        if name != '_location' and name != '_filename':
+            raise AttributeError(name)
+
+        form = self.get(':form') if self.pairs is not None else None
+        self._location = getattr(form, '_location', 0)
+        self._filename = getattr(form, '_filename', '')
+        return getattr(self, name)
 
     def __eq__(self, other):
         if type(other) != Error:
@@ -31,48 +150,242 @@ class Error(object):
         return '<Error "{}" attrs={}>'.format(self.type.name, self.attrs)
 
 def create_error(typestr, *attrs):
-    def process_attrs(attrs, acc):
-        if attrs == ():
-            return Error(Symbol(typestr), List(acc))
-        elif len(attrs) >= 2:
-            acc.append(Symbol(attrs[0]))
-            acc.append(attrs[1])
-            return process_attrs(attrs[2:], acc)
-        else:
-            raise RuntimeError('Invalid error attributes.')
+    '''Returns an Error of the given type, with attributes given as
+    alternating names and values. A Message value is formatted when
+    the attributes are first looked at.
+
+    '''
 
     if type(typestr) not in [str, String]:
         raise RuntimeError('Invalid error type.')
+    if len(attrs) % 2 != 0:
+        raise RuntimeError('Invalid error attributes.')
+
+    return Error(Symbol(typestr), None, attrs)
+
+class LispError(Exception):
+    '''Carries an Error up the Python stack in the tree-walker, from where
+    it is made, or found where errors propagate (a primitive argument,
+    an `if` condition, the head of a call), to the nearest place that
+    keeps errors as values: a function argument, a `try` form, or the
+    caller of `eval`. Code that does not fail pays nothing for it.
+
+    '''
+
+    def __init__(self, error):
+        self.error = error
+
+def fail(typestr, *attrs):
+    '''Raises a LispError for a new error; see create_error.'''
+
+    raise LispError(create_error(typestr, *attrs))
+
+def lookup(env, key, default=None):
+    '''Looks up key in the environment chain starting at env, returning
+    default if it is not bound anywhere.
+
+    '''
+
+    while True:
+        t = type(env)
+        if t == Frame:
+            names = env.names
+            if key in names:
+                return env.values[names.index(key)]
+        elif t == Env:
+            vars = env.vars
+            if key in vars:
+                return vars[key]
+        elif env is None:
+            return default
+        else:
+            return env.get(key, default)
 
-    err = process_attrs(attrs, [])
-    try:
-        form = assoc(err.attrs, Symbol(':form'))
-        err.start_row = form.start_row
-        err.start_col = form.start_col
-        err.end_row = form.end_row
-        err.end_col = form.end_col
-        err.filename = form.filename
-    except:
-        pass
-
-    return err
-
-class Symbol(object):
-    def __init__(self, name):
-        self.name = name
+        env = env.parent
 
-    def __eq__(self, other):
-        return type(other) == Symbol and self.name == other.name
+def global_env(env):
+    '''Returns the outermost frame of the environment chain env; the one
+    top-level definitions live in.
 
-    def __ne__(self, other):
-        return type(other) != Symbol or self.name != other.name
+    '''
+
+    while type(env) in (Frame, Env) and env.parent is not None:
+        env = env.parent
+    return env
 
-    def __hash__(self):
-        return hash(self.name)
+class Env(object):
+    '''An environment frame. A frame only holds the bindings made in it;
+    lookups that miss fall through to the parent frame, which can be
+    another Env, a Frame or any mapping (like a plain dict). `loaded`
+    records the files loaded into the frame, in order, and `stdlib` the
+    values stdlib.lisp bound the derived forms to, if it was loaded into
+    it (see load.load and runs_natively).
+
+    '''
+
+    __slots__ = ['vars', 'parent', 'loaded', 'stdlib']
+
+    def __init__(self, vars=None, parent=None):
+        self.vars = {} if vars is None else vars
+        self.parent = parent
+        self.loaded = ()
+        self.stdlib = {}
+
+    def get(self, key, default=None):
+        return lookup(self, key, default)
+
+    def __getitem__(self, key):
+        value = lookup(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.vars[key] = value
+
+    def __contains__(self, key):
+        return lookup(self, key) is not None
+
+    def update(self, other):
+        if other is not self:
+            self.vars.update(other.vars if isinstance(other, Env) else other)
+
+    def __repr__(self):
+        return '<Env vars={}>'.format(self.vars)
+
+class Frame(object):
+    '''A frame of bindings stored by slot. `names` is a tuple shared by
+    all frames of the same shape (e.g. all calls of a function) and
+    `values` holds the value for each name in the same order, so that
+    lexically addressed code can read a variable with an index instead
+    of a dictionary lookup. Lookups by name still work, for code that
+    is not lexically addressed, like macro expansions.
+
+    '''
+
+    __slots__ = ['names', 'values', 'parent']
+
+    def __init__(self, names, values, parent):
+        self.names = names
+        self.values = values
+        self.parent = parent
+
+    def get(self, key, default=None):
+        return lookup(self, key, default)
+
+    def __getitem__(self, key):
+        value = lookup(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return lookup(self, key) is not None
+
+    def __repr__(self):
+        return '<Frame names={} values={}>'.format(self.names, self.values)
+
+class LocalRef(object):
+    '''A lexically addressed variable reference. The value lives in slot
+    `slot` of the Frame `depth` levels up the chain from the one the
+    reference is evaluated in. `symbol` is the symbol it stands for.
+    Like the symbol, it has no location of its own; the form it is in
+    keeps that of the symbol (see locate).
+
+    '''
+
+    __slots__ = ['depth', 'slot', 'symbol']
+
+    def __init__(self, depth, slot, symbol):
+        self.depth = depth
+        self.slot = slot
+        self.symbol = symbol
+
+    def __repr__(self):
+        return '<LocalRef {} ({}, {})>'.format(self.symbol.name, self.depth, self.slot)
+
+class TailCall(object):
+    '''Returned by the special form handlers instead of a value when the
+    rest of the work is evaluating `exp` in `env`. The `eval` loop
+    picks it up and carries on without growing the Python stack.
+
+    '''
+
+    __slots__ = ['exp', 'env']
+
+    def __init__(self, exp, env):
+        self.exp = exp
+        self.env = env
+
+class CompiledCode(object):
+    '''Code compiled to a Python callable by the closure compiler (see
+    compile.py). Evaluating it in an environment calls it with that
+    environment; like the special form handlers, it can return a
+    TailCall.
+
+    '''
+
+    __slots__ = ['run']
+
+    def __init__(self, run):
+        self.run = run
+
+class Symbol(Located):
+    '''Symbols are interned: there is only ever one Symbol with a given
+    name, so they are compared and hashed by identity. Being shared,
+    symbols carry no location; errors about a symbol use the location
+    of the enclosing form where one is available.
+
+    '''
+
+    # symbol kinds, so that eval does not need to look at the name.
+    PLAIN = 0
+    KEYWORD = 1
+    NIL = 2
+    COMPOSITION = 3
+
+    # a composition symbol also keeps its parts and the last function
+    # made from them (see eval_function_composition).
+    __slots__ = ['name', 'kind', 'parts', 'composed']
+
+    table = {}
+
+    def __new__(cls, name):
+        symbol = cls.table.get(name)
+        if symbol is None:
+            symbol = super(Symbol, cls).__new__(cls)
+            symbol.name = name
+            if name == 'nil':
+                symbol.kind = Symbol.NIL
+            elif name.startswith(':'):
+                symbol.kind = Symbol.KEYWORD
+            elif name.find(':') > 0:
+                symbol.kind = Symbol.COMPOSITION
+                symbol.parts = composition_parts(name)
+                symbol.composed = None
+            else:
+                symbol.kind = Symbol.PLAIN
+            cls.table[name] = symbol
+        return symbol
+
+    def __reduce__(self):
+        return (Symbol, (self.name,))
 
     def __repr__(self):
         return '<Symbol "{}">'.format(self.name)
 
+# symbols the evaluator itself looks for.
+FN = Symbol('fn')
+MAC = Symbol('mac')
+QUOTE = Symbol('quote')
+TRY = Symbol('try')
+LET = Symbol('let')
+LET_STAR = Symbol('let*')
+COND = Symbol('cond')
+
+# the names of the frame a try form runs a catch clause in.
+IT = (Symbol('it'),)
+
 def check_rest_parameters(params):
     if params.count(Symbol('&')) > 1:
         raise ParamError('More than one "&" in the argument list.', params)
@@ -80,54 +393,477 @@ def check_rest_parameters(params):
         if params.index(Symbol('&')) != len(params) - 2:
             raise ParamError('Rest argument not at the end of the list.', params)
     for p in params:
-        if isinstance(p, list):
+        if isinstance(p, List):
             check_rest_parameters(p)
 
-class Function(object):
-    def __init__(self, params, body, env):
-        if type(params) != List:
-            raise ParamError('Invalid argument list; not a list.', params)
+def arg_list(values, form):
+    '''Returns a List of the argument values of the call form, located
+    where the arguments are in it; for errors about the arguments.
 
-        if any(type(i) != Symbol for i in params):
-            raise ParamError(
-                'Function parameter list should only contain symbols.',
-                params)
+    '''
 
-        check_rest_parameters(params)
+    args = List(values)
+    if len(form) > 1:
+        span_location(args, form, 1, len(form) - 1)
+    else:
+        copy_location(args, form)
+    return args
+
+def copy_location(dest, src):
+    dest._location = getattr(src, '_location', 0)
+    dest._filename = getattr(src, '_filename', '')
+
+def copy_form_location(dest, src):
+    # for a copy of the form src with the same number of items: the
+    # items keep their locations too.
+    copy_location(dest, src)
+    locations = getattr(src, 'item_locations', None)
+    if locations is not None:
+        dest.item_locations = locations
+
+def located_item(form, i):
+    # item i of form, or its location in form if it has none of its own
+    # (see List.item_location).
+    location = form.item_location(i)
+    return form[i] if location is None else location
+
+def span_location(dest, form, first, last):
+    # from the start of item first of form to the end of item last, in
+    # the file of form; the location of form if either has none.
+    first = located_item(form, first)
+    last = located_item(form, last)
+    if not first.filename or not last.filename:
+        copy_location(dest, form)
+        return
+    dest.set_location(form.filename, first.start_row, first.start_col,
+                      last.end_row, last.end_col)
+
+def flatten_params(params, acc):
+    for p in params:
+        if type(p) == List:
+            flatten_params(p, acc)
+        else:
+            acc.append(p)
+    return acc
+
+def collect_references(exp, bound, acc):
+    '''Appends the symbols exp may refer to that are not in bound to acc,
+    each only once. This is conservative: anything that looks like a
+    symbol counts, including those in quoted data and in macro
+    arguments, since macros can turn them into code.
+
+    '''
+
+    t = type(exp)
+    if t == Symbol:
+        if exp.kind == Symbol.COMPOSITION:
+            # a function composition refers to each of its parts.
+            for name in exp.name.split(':'):
+                if name:
+                    collect_references(Symbol(name), bound, acc)
+        elif exp not in bound and exp not in acc:
+            acc.append(exp)
+    elif t == List and len(exp) == 3 and \
+         (exp[0] is FN or exp[0] is MAC) and type(exp[1]) == List:
+        # the parameters shadow outer variables inside the body.
+        bound = bound.union(flatten_params(exp[1], []))
+        collect_references(exp[2], bound, acc)
+    elif t == List:
+        for i in exp:
+            collect_references(i, bound, acc)
+
+    return acc
+
+def collect_heads(exp, bound, acc):
+    '''Appends the symbols called in exp (the heads of its forms) that are
+    not in bound to acc, each only once. Any of them may be a macro,
+    whose expansion can refer to variables exp does not mention; see
+    may_expand. Quoted data is left out, and the parameters of nested
+    fn and mac forms are bound in their bodies.
+
+    '''
 
-        # check if the parameter list is duplicate free
-        if len(params) != len(set(params)):
-            raise ParamError('Duplicate parameters.', params)
+    if type(exp) != List or len(exp) == 0:
+        return acc
+
+    head = exp[0]
+    if head is QUOTE:
+        return acc
+    if len(exp) == 3 and (head is FN or head is MAC) and type(exp[1]) == List:
+        return collect_heads(exp[2], bound.union(flatten_params(exp[1], [])), acc)
+
+    if type(head) == Symbol and head.kind == Symbol.PLAIN and \
+       head not in bound and head not in acc:
+        acc.append(head)
+    for i in exp:
+        collect_heads(i, bound, acc)
+    return acc
+
+def may_expand(heads, env):
+    '''Returns whether any of the symbols heads (see collect_heads) is, or
+    may become, a macro in env: bound to one, or not bound at all. A
+    closure whose body has such calls keeps the whole environment it
+    is made in.
+
+    '''
+
+    for head in heads:
+        if head in special_forms and head not in derived_forms:
+            continue
+        value = lookup(env, head)
+        if head in special_forms and \
+           runs_natively(head, value, global_env(env)):
+            continue
+        if value is None or isinstance(value, Macro):
+            return True
+    return False
+
+def resolve(exp, addresses, globals):
+    '''Returns a copy of exp in which references to the variables in
+    addresses are replaced by LocalRef objects with the (depth, slot)
+    address they map to. Quoted
+    data, nested fn and mac forms, and the arguments of macro calls are
+    left alone: they are not evaluated in this scope, or not as is.
+
+    '''
+
+    t = type(exp)
+    if t == Symbol:
+        if exp in addresses:
+            depth, slot = addresses[exp]
+            return LocalRef(depth, slot, exp)
+        return exp
 
+    if t != List or len(exp) == 0:
+        return exp
+
+    head = exp[0]
+    native = None
+    if type(head) == Symbol:
+        if head.name in ('quote', 'fn', 'mac'):
+            return exp
+        if head in derived_forms and head in special_forms:
+            # whether the form runs natively is decided here, once,
+            # rather than every time it is evaluated (see eval_sexp).
+            native = head not in addresses and \
+                     runs_natively(head, globals.get(head), globals)
+        if head in special_forms and (head not in derived_forms or native):
+            resolver = binding_forms.get(head, resolve_forms)
+            # special forms and primitives win over local variables.
+            ret = resolver(exp, addresses, globals)
+            if native:
+                ret.native = True
+            return ret
+        if head not in addresses and isinstance(globals.get(head), Macro):
+            return exp
+    elif isinstance(head, Macro):
+        return exp
+
+    ret = List(resolve(i, addresses, globals) for i in exp)
+    copy_form_location(ret, exp)
+    if native is not None:
+        ret.native = native
+    return ret
+
+def push_frame(addresses, names):
+    # the addresses seen from a new frame binding names on top of the
+    # frames addresses is for.
+    inner = dict((name, (depth + 1, slot))
+                 for name, (depth, slot) in addresses.iteritems())
+    inner.update((name, (0, i)) for i, name in enumerate(names))
+    return inner
+
+def resolve_items(exp, addresses, globals):
+    # each item of exp on its own, as opposed to exp as a form.
+    ret = List(resolve(i, addresses, globals) for i in exp)
+    copy_form_location(ret, exp)
+    return ret
+
+def resolve_forms(exp, addresses, globals):
+    # special forms whose parts are all evaluated in the current frame.
+    ret = List([exp[0]] + [resolve(i, addresses, globals) for i in exp[1:]])
+    copy_form_location(ret, exp)
+    return ret
+
+def resolve_try(exp, addresses, globals):
+    # the catch clauses run in a frame binding `it` on top of the
+    # current one; anything that is not a clause is left for eval_try
+    # to report.
+    if len(exp) < 2:
+        return resolve_forms(exp, addresses, globals)
+    inner = push_frame(addresses, IT)
+
+    items = [exp[0], resolve(exp[1], addresses, globals)]
+    for clause in exp[2:]:
+        if type(clause) == List:
+            clause = resolve_items(clause, inner, globals)
+        items.append(clause)
+
+    ret = List(items)
+    copy_form_location(ret, exp)
+    return ret
+
+def resolve_let(exp, addresses, globals):
+    # the values are evaluated in the current frame and the body in a
+    # frame of the bound names on top of it. Malformed forms are left
+    # for eval_let to report.
+    try:
+        names, forms = let_bindings(exp)
+    except LispError:
+        return exp
+
+    pairs = []
+    for pair, form in zip(exp[1], forms):
+        resolved = List([pair[0], resolve(form, addresses, globals)])
+        copy_form_location(resolved, pair)
+        pairs.append(resolved)
+    pairs = List(pairs)
+    copy_location(pairs, exp[1])
+
+    body = resolve(exp[2], push_frame(addresses, names), globals)
+    ret = List([exp[0], pairs, body])
+    copy_form_location(ret, exp)
+    return ret
+
+def resolve_let_star(exp, addresses, globals):
+    # like let, with a frame for each binding, on top of the ones before.
+    try:
+        names, forms = let_bindings(exp)
+    except LispError:
+        return exp
+
+    pairs = []
+    for pair, name, form in zip(exp[1], names, forms):
+        resolved = List([pair[0], resolve(form, addresses, globals)])
+        copy_form_location(resolved, pair)
+        pairs.append(resolved)
+        addresses = push_frame(addresses, name)
+    pairs = List(pairs)
+    copy_location(pairs, exp[1])
+
+    body = resolve(exp[2], addresses, globals)
+    ret = List([exp[0], pairs, body])
+    copy_form_location(ret, exp)
+    return ret
+
+def resolve_cond(exp, addresses, globals):
+    # a clause is not a form; its test and value are.
+    items = [exp[0]]
+    for clause in exp[1:]:
+        if type(clause) == List:
+            clause = resolve_items(clause, addresses, globals)
+        items.append(clause)
+
+    ret = List(items)
+    copy_form_location(ret, exp)
+    return ret
+
+def unresolve(exp):
+    '''The inverse of resolve: returns exp with any LocalRef objects in it
+    turned back into symbols. Returns exp itself if there are none.
+
+    '''
+
+    t = type(exp)
+    if t == LocalRef:
+        return exp.symbol
+
+    if t != List:
+        return exp
+
+    items = [unresolve(i) for i in exp]
+    if all(i is j for i, j in zip(items, exp)):
+        return exp
+
+    ret = List(items)
+    copy_form_location(ret, exp)
+    return ret
+
+class Analysis(object):
+    '''What is known about a function body, independent of the
+    environment it is closed over: the names of its frame slots, the
+    number of fixed parameters and whether there is a rest parameter,
+    the free symbols it refers to, and the lexically addressed body for
+    each set of captured variables seen so far. Making one checks the
+    parameter list, raising ParamError if it is not valid.
+
+    '''
+
+    def __init__(self, params, body):
+        check_function_params(params)
         self.params = params
         self.body = body
-        self.env = env
+        self.names = tuple(p for p in params if p != Symbol('&'))
+        self.rest = len(self.names) != len(params)
+        self.arity = len(self.names) - self.rest
+        self.refs = tuple(collect_references(body, frozenset(self.names), []))
+        self.heads = tuple(collect_heads(body, frozenset(self.names), []))
+        self.codes = {}
+
+    def code(self, captured, globals):
+        code = self.codes.get(captured)
+        if code is None:
+            addresses = dict((name, (0, i))
+                             for i, name in enumerate(self.names))
+            addresses.update((name, (1, i))
+                             for i, name in enumerate(captured))
+            code = resolve(self.body, addresses, globals)
+            self.codes[captured] = code
+        return code
+
+def analyse(params, body):
+    # the analysis only depends on the fn form, so it is kept on the
+    # body, or the parameter list if the body is an atom, and reused for
+    # every closure created from it; the parameter list is only checked
+    # once. Nothing is kept on the empty list, which all nil values
+    # share.
+    if type(body) == List and body is not empty_list:
+        node = body
+    elif type(params) == List and params is not empty_list:
+        node = params
+    else:
+        return Analysis(params, body)
 
-    def call(self, args):
-        params = self.params
-        if not isinstance(args, (List, list)):
+    analysis = getattr(node, 'analysis', None)
+    if analysis is None or analysis.params is not params or \
+       analysis.body is not body:
+        analysis = Analysis(params, body)
+        node.analysis = analysis
+    return analysis
+
+def check_function_params(params):
+    if type(params) != List:
+        raise ParamError('Invalid argument list; not a list.', params)
+
+    if any(type(i) != Symbol for i in params):
+        raise ParamError(
+            'Function parameter list should only contain symbols.',
+            params)
+
+    check_rest_parameters(params)
+
+    # check if the parameter list is duplicate free
+    if len(params) != len(set(params)):
+        raise ParamError('Duplicate parameters.', params)
+
+class Function(object):
+    def __init__(self, params, body, env):
+        analysis = analyse(params, body)
+
+        self.params = params
+        self.body = body
+        self.arity = analysis.arity
+        self.rest = analysis.rest
+
+        # a macro called in the body can expand to a reference to any
+        # local variable, so the body then runs in the whole environment,
+        # looking up everything but the parameters by name.
+        globals = global_env(env)
+        self.names = analysis.names
+        if env is not globals and may_expand(analysis.heads, env):
+            self.code = analysis.code((), globals)
+            self.env = env
+            return
+
+        # otherwise, only keep the values of the local variables the
+        # body actually refers to; anything else is looked up in the
+        # global environment.
+        captured = []
+        values = []
+        for name in analysis.refs:
+            frame = env
+            while frame is not globals:
+                if type(frame) == Frame:
+                    if name in frame.names:
+                        values.append(frame.values[frame.names.index(name)])
+                        break
+                elif name in frame.vars:
+                    values.append(frame.vars[name])
+                    break
+                frame = frame.parent
+            else:
+                continue
+            captured.append(name)
+
+        captured = tuple(captured)
+        self.code = analysis.code(captured, globals)
+        self.env = Frame(captured, values, globals) if captured else globals
+
+    @classmethod
+    def compiled(cls, params, body, names, code, env):
+        '''Creates a function whose parameter list has already been checked
+        and whose body has already been compiled to code, closed over the
+        environment env.
+
+        '''
+
+        func = cls.__new__(cls)
+        func.params = params
+        func.body = body
+        func.names = names
+        func.rest = len(names) != len(params)
+        func.arity = len(names) - func.rest
+        func.code = code
+        func.env = env
+        return func
+
+    def frame(self, values):
+        '''Returns the frame the function body runs in for a Python list
+        of argument values, or None if there are too many or too few of
+        them. The list becomes the slots of the frame, so the caller
+        must not hold on to it.
+
+        '''
+
+        arity = self.arity
+        if self.rest:
+            if len(values) < arity:
+                return None
+            values[arity:] = [List(values[arity:])]
+        elif len(values) != arity:
+            return None
+
+        return Frame(self.names, values, self.env)
+
+    def arg_error(self, args):
+        '''Returns the error for calling the function with the argument
+        list args, which frame has refused.
+
+        '''
+
+        if self.rest:
             return create_error(':arg-error',
-                                ':msg', 'Function argument list not a List.',
+                                ':msg', Message('Expected at least {} argument(s) but got {}.',
+                                                self.arity, len(args)),
                                 ':form', args)
-        args = List(args) if not isinstance(args, List) else args
+        return create_error(':arg-error',
+                            ':msg', Message('Expected {} argument(s) but got {}.',
+                                            self.arity, len(args)),
+                            ':form', args)
 
-        if len(params) >= 2 and params[-2] == Symbol('&'):
-            if len(args) < len(params) - 2:
-                return create_error(':arg-error',
-                                    ':msg', 'Expected at least {} argument(s) but got {}.'\
-                                            .format(len(params) - 2, len(args)),
-                                    ':form', args)
-        elif len(args) != len(params):
+    def bind(self, args):
+        '''Returns the environment in which the function body should be
+        evaluated for the given arguments, or an Error if the arguments
+        do not match the parameter list.
+
+        '''
+
+        if not isinstance(args, (List, list)):
             return create_error(':arg-error',
-                                ':msg', 'Expected {} argument(s) but got {}.' \
-                                        .format(len(params), len(args)),
+                                ':msg', 'Function argument list not a List.',
                                 ':form', args)
 
-        if len(params) >= 2 and params[-2] == Symbol('&'):
-            args = args[:len(params) - 2] + [args[len(params) - 2:]]
-            params = params[:-2] + params[-1:]
+        frame = self.frame(list(args))
+        if frame is None:
+            return self.arg_error(List(args) if type(args) != List else args)
+        return frame
+
+    def call(self, args):
+        env = self.bind(args)
+        if isinstance(env, Error):
+            return env
 
-        return eval(self.body, dict(self.env, **dict(zip(params, args))))
+        return eval(self.code, env)
 
     def __repr__(self):
         return '<Function params={} body={}>'.format(self.params, self.body)
@@ -142,11 +878,12 @@ class Macro(object):
         self.params = params
         self.body = body
         self.env = env
+        self.pattern = Pattern(params)
 
     def check_params(self, params):
         def flatten(l, acc=[]):
             for i in l:
-                if isinstance(i, list):
+                if isinstance(i, List):
                     flatten(i, acc)
                 else:
                     acc.append(i)
@@ -170,8 +907,9 @@ class Macro(object):
 
     def expand(self, args):
         try:
-            extra_env = destructure(self.params, args)
-            return eval(self.body, dict(self.env, **extra_env))
+            vars = {}
+            self.pattern.bind(args, vars)
+            return eval(self.body, Env(vars, self.env))
         except ArgError as e:
             return create_error(':arg-error',
                                 ':msg', str(e),
@@ -180,79 +918,245 @@ class Macro(object):
     def __repr__(self):
         return '<Macro params={} body={}>'.format(self.params, self.body)
 
-class List(list):
-    def __init__(self, *args, **kwargs):
-        super(List, self).__init__(*args, **kwargs)
-        self.start_row = 0
-        self.start_col = 0
-        self.end_row = 0
-        self.end_col = 0
-        self.filename = ''
+class List(Located):
+    '''A Lisp list. The items are kept in reverse order in a Python list,
+    of which a List only uses the first `end` items, so that a List and
+    its tails (`rest`, or any slice running to the end) share the same
+    Python list. Prepending an item appends it to the Python list when
+    no other List has done so already, so `prep` shares its second
+    argument too. Lists are never changed once made.
+
+    '''
+
+    # besides the location, forms keep the packed locations of the
+    # symbols and booleans among their items (see item_location), and
+    # the caches of the evaluator: the macro expansion of a macro call
+    # (see expand_macro_call), the catch table of a try form (see
+    # eval_try), the checked bindings of a let or let* form (see
+    # let_bindings), the clauses of a cond form (see eval_cond), whether
+    # a derived form runs natively (see resolve) and the analysis of a fn
+    # form on its body or parameter list (see analyse).
+    __slots__ = ['items', 'end', '_location', '_filename',
+                 'item_locations', 'expansion', 'catches', 'bindings',
+                 'clauses', 'native', 'analysis']
+
+    # lists are mutable to Python, and compare by value.
+    __hash__ = None
+
+    def __init__(self, items=()):
+        items = list(items)
+        items.reverse()
+        self.items = items
+        self.end = len(items)
+
+    def view(self, end):
+        '''Returns the last `end` items of the list, sharing them.'''
+
+        l = List.__new__(List)
+        l.items = self.items
+        l.end = end
+        return l
+
+    def item_location(self, i):
+        '''Returns the Location of item i of the list if it was read from a
+        file without one of its own, like a symbol or boolean; None
+        otherwise.
+
+        '''
+
+        locations = getattr(self, 'item_locations', None)
+        if locations is None or not locations[i]:
+            return None
+        location = Location()
+        location._location = locations[i]
+        location._filename = self.filename
+        return location
+
+    def prep(self, item):
+        '''Returns a list of item followed by the items of this one.'''
+
+        return self.prepend([item])
+
+    def prepend(self, items):
+        '''Returns a list of the given items followed by the items of this
+        one, in time proportional to the number of the given items.
+
+        '''
+
+        # an empty list (like empty_list, which is shared by all nil
+        # values) never gives away its items.
+        if self.end and self.end == len(self.items):
+            l = self.view(self.end + len(items))
+            l.items.extend(reversed(items))
+            return l
+
+        # the items after ours are someone else's; copy ours.
+        l = List.__new__(List)
+        l.items = self.items[:self.end]
+        l.items.extend(reversed(items))
+        l.end = len(l.items)
+        return l
+
+    def __len__(self):
+        return self.end
+
+    def __iter__(self):
+        if self.end == len(self.items):
+            return reversed(self.items)
+        return reversed(self.items[:self.end])
+
+    def __reversed__(self):
+        return iter(self.items[:self.end])
 
     def __getitem__(self, key):
-        if isinstance(key, slice):
-            l = super(List, self).__getitem__(key)
-            return List(l)
-        else:
-            return super(List, self).__getitem__(key)
-
-    def __setitem__(self, key, value):
-        super(List, self).__setitem__(key, value)
+        if type(key) == slice:
+            start, stop, step = key.indices(self.end)
+            if stop == self.end and step == 1:
+                return self.view(self.end - min(start, stop))
+            return List(list(self)[key])
+
+        if key < 0:
+            key += self.end
+        if key < 0 or key >= self.end:
+            raise IndexError('list index out of range')
+        return self.items[self.end - 1 - key]
 
     def __getslice__(self, i, j):
         return self.__getitem__(slice(i, j))
 
+    def __setitem__(self, key, value):
+        # other lists may share the items; change a copy of ours.
+        items = list(self)
+        items[key] = value
+        items.reverse()
+        self.items = items
+
+    def __contains__(self, item):
+        return item in self.items[:self.end]
+
+    def index(self, item):
+        for i, x in enumerate(self):
+            if x == item:
+                return i
+        raise ValueError('{} is not in list'.format(item))
+
+    def count(self, item):
+        return self.items[:self.end].count(item)
+
+    def __eq__(self, other):
+        if type(other) == List:
+            if self.end != other.end:
+                return False
+            if self.items is other.items:
+                return True
+            return self.items[:self.end] == other.items[:other.end]
+        if isinstance(other, list):
+            if self.end != len(other):
+                return False
+            return self.items[:self.end] == other[::-1]
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
     def __add__(self, other):
-        return List(super(List, self).__add__(other))
+        if type(other) != List:
+            other = List(other)
+        return other.prepend(list(self))
 
     def __radd__(self, other):
-        if not isinstance(other, List):
-            other = List(other)
-        return List(super(List, other).__add__(self))
+        return self.prepend(other)
+
+    def __reduce__(self):
+        # only the locations are pickled with the items, which are kept
+        # in their internal order so that loading an image or a cached
+        # file does not reverse every list; what the evaluator caches
+        # on a form (like its macro expansion) is not part of its value.
+        items = self.items[:self.end]
+        location = getattr(self, '_location', 0)
+        item_locations = getattr(self, 'item_locations', None)
+        if not location and item_locations is None:
+            return restore_list, (items,)
+        return restore_list, (items, location, self.filename, item_locations)
 
     def __repr__(self):
-        return 'L{}'.format(super(List, self).__repr__())
-
-class Bool(object):
-    def __init__(self, v):
-        self.value = v
-        self.start_row = 0
-        self.start_col = 0
-        self.end_row = 0
-        self.end_col = 0
-        self.filename = ''
+        return 'L{}'.format(list(self))
+
+def restore_list(items, location=0, filename='', item_locations=None):
+    # unpickles a List (see List.__reduce__).
+    l = List.__new__(List)
+    l.items = items
+    l.end = len(items)
+    if location or filename:
+        l._location = location
+        l.filename = filename
+    if item_locations is not None:
+        l.item_locations = item_locations
+    return l
+
+# the value of nil and of the empty list.
+empty_list = List()
+
+class Bool(Located):
+    '''There are only two Bools, `true` and `false`, so they are compared by
+    identity. Like symbols, being shared, they carry no location; the
+    lists they are read in keep it (see List.item_location).
+
+    '''
+
+    __slots__ = ['value']
+
+    table = {}
+
+    def __new__(cls, value):
+        value = bool(value)
+        b = cls.table.get(value)
+        if b is None:
+            b = super(Bool, cls).__new__(cls)
+            b.value = value
+            cls.table[value] = b
+        return b
 
     def __eq__(self, other):
-        if type(other) != Bool:
-            other = Bool(other)
-        return self.value == other.value
+        if type(other) == Bool:
+            return self is other
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        return (Bool, (self.value,))
 
     def __repr__(self):
         return 'B{}'.format(self.value)
 
-class Integer(int):
-    def __new__(cls, *args, **kwargs):
-        return super(Integer, cls).__new__(cls, *args, **kwargs)
+true = Bool(True)
+false = Bool(False)
 
-    def __init__(self, n):
-        self.start_row = 0
-        self.start_col = 0
-        self.end_row = 0
-        self.end_col = 0
-        self.filename = ''
+class Integer(Located, int):
+    __slots__ = ['_location', '_filename']
 
     def __repr__(self):
         return 'N{}'.format(super(Integer, self).__repr__())
 
-class String(str):
-    def __new__(cls, *args, **kwargs):
-        obj = super(String, cls).__new__(cls, *args, **kwargs)
-        obj.start_row = 0
-        obj.start_col = 0
-        obj.end_row = 0
-        obj.end_col = 0
-        obj.filename = ''
-        return obj
+# the Integers of small values, shared by the values the primitives
+# return; being shared, they must not be given a location.
+small_integers = [Integer(i) for i in xrange(-5, 257)]
+
+def make_integer(n):
+    '''Returns an Integer with the value n, without making a new one for
+    small values. Only for values with no location of their own.
+
+    '''
+
+    if -5 <= n <= 256:
+        return small_integers[n + 5]
+    return Integer(n)
+
+class String(Located, str):
+    # str subclasses cannot have slots of their own; the location goes
+    # in the instance dict, which is only made for strings that have one.
 
     def __add__(self, other):
         return String(str(self) + str(other))
@@ -263,38 +1167,347 @@ class String(str):
     def __repr__(self):
         return 'S{}'.format(super(String, self).__repr__())
 
-def destructure(params, args):
-    if type(params) == List and type(args) != List:
-        raise ArgError('Parameter list and the provided arguments do not match.\n'
-                       '    Expected a list in the arguments, got: {}'
-                       .format(args),
-                       args)
+# vectors hold C longs, the integers Integer is made of: vector_bits
+# wide, which is 64 bits, except on Windows, where it is 32.
+vector_bits = array('l').itemsize * 8
+
+class Vector(Located):
+    '''A vector of C longs (see vector_bits), kept in a NumPy array when
+    NumPy is installed and in an array('l') otherwise, so that the
+    vector primitives work on the whole vector in C instead of
+    evaluating one element at a time. Creating a vector from integers
+    that do not fit raises OverflowError. The results of the arithmetic
+    primitives (vadd, vmul, vsum and vdot) wrap around on overflow with
+    NumPy, as NumPy's fixed size arithmetic does; without it they are a
+    :value-error.
+
+    '''
+
+    # vectors are only ever made at run time, so they have no location.
+    __slots__ = ['items']
+
+    def __init__(self, items):
+        if numpy is not None:
+            self.items = numpy.asarray(items, dtype=numpy.dtype('l'))
+        elif type(items) == array:
+            self.items = items
+        else:
+            self.items = array('l', items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        # the elements as python integers, whatever the storage.
+        return (int(i) for i in self.items)
+
+    def __eq__(self, other):
+        return type(other) == Vector and len(self) == len(other) and \
+            all(i == j for i, j in zip(self, other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'V{}'.format(list(self))
+
+class PrimitiveError(RuntimeError):
+    '''Raised by the Python function of a primitive to make it return an
+    error of the given type, with the primitive form as its :form, or
+    item `item` of it if given.
+
+    '''
+
+    def __init__(self, type, msg, item=None):
+        self.type = type
+        self.item = item
+        super(PrimitiveError, self).__init__(msg)
+
+# the names typeof returns for each type of value.
+type_names = {
+    List: 'list',
+    Error: 'error',
+    Symbol: 'symbol',
+    Function: 'function',
+    Macro: 'macro',
+    Bool: 'bool',
+    Integer: 'int',
+    String: 'str',
+    Vector: 'vec',
+}
+
+# the handlers of special forms and primitives by name; eval_sexp
+# dispatches on this before trying a function call.
+special_forms = {}
+
+class Primitive(object):
+    '''A Lisp form implemented by a Python function. The function is
+    called with the evaluated arguments once the number of arguments
+    has been checked, Error arguments have been propagated (unless
+    propagate_errors is false) and each argument has been checked
+    against its entry in arg_types (None accepts any value).
+
+    The messages of the errors the checks make can be given: arity_msg
+    is formatted with the number of arguments given, and type_msg with
+    the type of the argument that failed its check, or is a sequence of
+    one message per argument. A type error is about the whole form, or
+    item type_item of it if given; without a type_msg, it is about the
+    argument that failed.
+
+    '''
+
+    __slots__ = ['name', 'func', 'arg_types', 'propagate_errors',
+                 'arity_msg', 'type_msg', 'type_item',
+                 'typed', 'untyped', 'catching']
+
+    def __init__(self, name, func, arg_types, propagate_errors=True,
+                 arity_msg=None, type_msg=None, type_item=None):
+        self.name = name
+        self.func = func
+        self.arg_types = tuple(arg_types)
+        self.propagate_errors = propagate_errors
+        self.arity_msg = arity_msg
+        self.type_msg = type_msg
+        self.type_item = type_item
+
+        # an Error never passes for another type, so propagating errors
+        # only takes a look of its own at the arguments of any type; the
+        # others are only looked at again when they fail their check.
+        self.typed = tuple((i, t) for i, t in enumerate(self.arg_types)
+                           if t is not None)
+        self.untyped = tuple(i for i, t in enumerate(self.arg_types)
+                             if t is None and propagate_errors)
+
+        # for each argument, whether an error in it is a value to the
+        # primitive (instead of the error of the whole form), or None if
+        # there are no such arguments.
+        catching = tuple(not propagate_errors or t is Error
+                         for t in self.arg_types)
+        self.catching = catching if any(catching) else None
+
+    def call(self, args, form):
+        '''Calls the primitive with a list of evaluated arguments, after
+        the error and type checks, raising a LispError if one of them
+        fails or the primitive does. form is the primitive form the
+        arguments come from, used for error locations.
+
+        '''
+
+        for i, arg_type in self.typed:
+            if not isinstance(args[i], arg_type):
+                self.reject(args, form)
+        for i in self.untyped:
+            if type(args[i]) == Error:
+                raise LispError(args[i])
+
+        try:
+            return self.func(*args)
+        except PrimitiveError as e:
+            self.fail(e.type, str(e), form, e.item)
+
+    def reject(self, args, form):
+        # an error among the arguments wins over a type error.
+        if self.propagate_errors:
+            for arg, arg_type in zip(args, self.arg_types):
+                if type(arg) == Error and arg_type is not Error:
+                    raise LispError(arg)
+
+        for i, (arg, arg_type) in enumerate(zip(args, self.arg_types)):
+            if arg_type is None or isinstance(arg, arg_type):
+                continue
+
+            msg = self.type_msg
+            if msg is None:
+                self.fail(':type-error',
+                          Message('`{}` argument {} must be of type {}; got {}.',
+                                  self.name, i + 1, type_names[arg_type],
+                                  type_names.get(type(arg), type(arg).__name__)),
+                          form, i + 1)
+            if type(msg) != str:
+                msg = msg[i]
+            self.fail(':type-error', Message(msg, type(arg)), form, self.type_item)
+
+    def fail(self, typestr, msg, form, item):
+        # raises an error about the whole form, or item `item` of it,
+        # which takes its location in form if it has none of its own
+        # (see locate).
+        if item is None:
+            fail(typestr, ':msg', msg, ':form', form)
+        error = create_error(typestr, ':msg', msg, ':form', form[item])
+        locate(error, form)
+        raise LispError(error)
+
+    def apply(self, args, form):
+        '''Like call, but returns the error instead of raising it; for
+        the engines that keep errors as values.
+
+        '''
+
+        try:
+            return self.call(args, form)
+        except LispError as e:
+            return e.error
+
+    def check_arity(self, form):
+        '''Returns an Error if form does not have as many arguments as
+        the primitive accepts, None otherwise.
+
+        '''
+
+        nargs = len(self.arg_types)
+        if len(form) == nargs + 1:
+            return None
+
+        if self.arity_msg is not None:
+            msg = Message(self.arity_msg, len(form) - 1)
+        else:
+            msg = Message('`{}` form accepts exactly {} argument{}; {} given.',
+                          self.name, nargs, '' if nargs == 1 else 's', len(form) - 1)
+        return create_error(':arg-error',
+                            ':msg', msg,
+                            ':form', form)
+
+    def __call__(self, sexp, env):
+        error = self.check_arity(sexp)
+        if error is not None:
+            raise LispError(error)
+
+        catching = self.catching
+        if catching is None:
+            args = [evaluate(i, env) for i in sexp[1:]]
+        else:
+            args = [eval(i, env) if c else evaluate(i, env)
+                    for c, i in zip(catching, sexp[1:])]
+        return self.call(args, sexp)
+
+    def __repr__(self):
+        return '<Primitive {}>'.format(self.name)
+
+def register_primitive(name, func, arg_types, propagate_errors=True,
+                       **messages):
+    '''Makes the Python function func available as the Lisp form name,
+    taking one argument for each entry in arg_types. See Primitive for
+    the checks made before func is called and the messages of the
+    errors they make.
+
+    '''
+
+    prim = Primitive(name, func, arg_types, propagate_errors, **messages)
+    special_forms[Symbol(name)] = prim
+    return prim
+
+def primitive(name, *arg_types, **kwargs):
+    '''A decorator version of register_primitive; the decorated function
+    is returned unchanged.
+
+        @primitive('iadd', Integer, Integer)
+        def prim_iadd(first, second):
+            return make_integer(first + second)
+
+    '''
+
+    def decorator(func):
+        register_primitive(name, func, arg_types, **kwargs)
+        return func
+    return decorator
 
-    if len(params) >= 2 and params[-2] == Symbol('&'):
-        if len(args) < len(params) - 2:
+class Pattern(object):
+    '''A macro parameter list, compiled once for binding arguments to it:
+    the positions of the parameters that are symbols, the patterns of
+    those that are lists, and the rest parameter if there is one.
+
+    '''
+
+    __slots__ = ['arity', 'symbols', 'lists', 'rest']
+
+    def __init__(self, params):
+        rest = None
+        if len(params) >= 2 and params[-2] == Symbol('&'):
+            rest = params[-1]
+            params = params[:-2]
+
+        for p in params if rest is None else list(params) + [rest]:
+            if type(p) != Symbol and type(p) != List:
+                raise ParamError('Only symbols and lists allowed in parameter list; got an {} instead.'.format(type(p).__name__), p)
+
+        self.arity = len(params)
+        self.symbols = tuple((i, p) for i, p in enumerate(params)
+                             if type(p) == Symbol)
+        self.lists = tuple((i, Pattern(p)) for i, p in enumerate(params)
+                           if type(p) == List)
+        self.rest = Pattern(rest) if type(rest) == List else rest
+
+    def bind(self, args, vars):
+        '''Adds the bindings of the parameters to the matching parts of
+        args to the dictionary vars. Raises ArgError if args does not
+        have the shape of the parameter list.
+
+        '''
+
+        if type(args) != List:
             raise ArgError('Parameter list and the provided arguments do not match.\n'
-                           '    Expected at least {} argument(s) but got {}.'
-                           .format(len(params) - 2, len(args)),
+                           '    Expected a list in the arguments, got: {}'
+                           .format(args),
                            args)
 
-        args = args[:len(params) - 2] + [args[len(params) - 2:]]
-        params = params[:-2] + params[-1:]
-    elif len(params) != len(args):
-        raise ArgError('Parameter list and the provided arguments do not match.\n'
-                       '    Expected {} argument(s) but got {}.'
-                       .format(len(params), len(args)),
-                       args)
-
-    env = {}
-    for p, a in zip(params, args):
-        if type(p) == Symbol:
-            env[p] = a
-        elif type(p) == List:
-            env.update(destructure(p, a))
-        else:
-            raise ParamError('Only symbols and lists allowed in parameter list; got an {} instead.'.format(type(p).__name__), p)
+        n = args.end
+        if self.rest is not None:
+            if n < self.arity:
+                raise ArgError('Parameter list and the provided arguments do not match.\n'
+                               '    Expected at least {} argument(s) but got {}.'
+                               .format(self.arity, n),
+                               args)
+        elif n != self.arity:
+            raise ArgError('Parameter list and the provided arguments do not match.\n'
+                           '    Expected {} argument(s) but got {}.'
+                           .format(self.arity, n),
+                           args)
 
-    return env
+        # the items of a List are stored last first.
+        items = args.items
+        last = n - 1
+        for i, name in self.symbols:
+            vars[name] = items[last - i]
+        for i, pattern in self.lists:
+            pattern.bind(items[last - i], vars)
+
+        rest = self.rest
+        if rest is not None:
+            value = args.view(n - self.arity)
+            if type(rest) == Symbol:
+                vars[rest] = value
+            else:
+                rest.bind(value, vars)
+
+# how many macro calls were served from the expansion cache (hits) and
+# how many had to run the macro (misses).
+macro_stats = {'hits': 0, 'misses': 0}
+
+def expand_macro_call(macro, sexp):
+    '''Returns the expansion of the macro call sexp, where macro is the
+    value of its head. The expansion is cached on the call form, along
+    with the macro it came from, so running the same code again does
+    not re-run the macro; binding the name to another macro makes the
+    next call expand again.
+
+    '''
+
+    cached = getattr(sexp, 'expansion', None)
+    if cached is not None and cached[0] is macro:
+        macro_stats['hits'] += 1
+        return cached[1]
+
+    macro_stats['misses'] += 1
+
+    # the arguments are lexically addressed if the call site was
+    # compiled while the head was not a macro; macros should see plain
+    # symbols.
+    args = List(sexp[1:])
+    copy_location(args, sexp)
+    expanded = macro.expand(unresolve(args))
+
+    sexp.expansion = (macro, expanded)
+    return expanded
 
 def macro_expand_1(exp, env):
     if type(exp) != List or len(exp) == 0:
@@ -307,8 +1520,7 @@ def macro_expand_1(exp, env):
     if not isinstance(macro, Macro):
         return exp, False
 
-    args = exp[1:]
-    expanded = macro.expand(args)
+    expanded = expand_macro_call(macro, exp)
 
     if isinstance(expanded, Error):
         return expanded, False
@@ -328,608 +1540,825 @@ def macro_expand(exp, env):
 def eval_error(sexp, env):
     assert sexp[0].name == 'error'
     if len(sexp) < 2:
-        return create_error(':arg-error',
-                            ':msg', 'error expects at least one argument; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
+        fail(':arg-error',
+             ':msg', 'error expects at least one argument; {} given.'.format(len(sexp) - 1),
+             ':form', sexp)
 
+    # errors are values to the error form, like to a function.
     error_type = eval(sexp[1], env)
     if type(error_type) != Symbol:
-        return create_error(':type-error',
-                            ':msg', 'Invalid error type.',
-                            ':form', sexp[1])
+        fail(':type-error',
+             ':msg', 'Invalid error type.',
+             ':form', sexp[1])
     attrs = List(eval(i, env) for i in sexp[2:])
     err = Error(error_type, attrs)
+    copy_location(err, sexp)
 
-    err.filename = sexp.filename
-    err.start_row = sexp.start_row
-    err.start_col = sexp.start_col
-    err.end_row = sexp.end_row
-    err.end_col = sexp.end_col
-
-    return err
-
-def eval_error_type(sexp, env):
-    assert sexp[0].name == 'error-type'
-    if len(sexp) != 2:
-        return create_error(':arg-error',
-                            ':msg', 'error-type expects exactly one argument; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    error = eval(sexp[1], env)
-    if type(error) != Error:
-        return create_error(':type-error',
-                            ':msg', 'error-type argument must be an Error; {} given.'.format(str(type(error))),
-                            ':form', sexp)
-
-    return error.type
-
-def eval_error_attrs(sexp, env):
-    assert sexp[0].name == 'error-attrs'
-    if len(sexp) != 2:
-        return create_error(':arg-error',
-                            ':msg', 'error-attrs expects exactly one argument; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    error = eval(sexp[1], env)
-    if type(error) != Error:
-        return create_error(':type-error',
-                            ':msg', 'error-attrs argument must be an Error; {} given.'.format(str(type(error))),
-                            ':form', sexp)
-
-    return error.attrs
+    raise LispError(err)
 
 def eval_if(sexp, env):
     assert sexp[0].name == 'if'
     if len(sexp) != 4:
-        return create_error(':arg-error',
-                            ':msg', '`if` form accepts exactly 3 arguments; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    cond = eval(sexp[1], env)
+        fail(':arg-error',
+             ':msg', '`if` form accepts exactly 3 arguments; {} given.'.format(len(sexp) - 1),
+             ':form', sexp)
 
-    if isinstance(cond, Error):
-        return cond
+    cond = evaluate(sexp[1], env)
+    if cond is not true and cond is not false:
+        cond = condition(cond, sexp[1])
 
-    if cond == Bool(True):
-        return eval(sexp[2], env)
-    elif cond == Bool(False):
-        return eval(sexp[3], env)
-    else:
-        return create_error(':type-error',
-                            ':msg', '`if` condition can only be a boolean; got a {} instead.'.format(type(cond).__name__),
-                            ':form', sexp[1])
+    if cond is true:
+        return TailCall(sexp[2], env)
+    return TailCall(sexp[3], env)
 
 def eval_quote(sexp, env):
     assert sexp[0].name == 'quote'
     if len(sexp) != 2:
-        return create_error(':arg-error',
-                            ':msg', '`quote` form accepts exactly one argument; got {} instead.'.format(len(sexp) - 1),
-                            ':form', sexp)
+        fail(':arg-error',
+             ':msg', '`quote` form accepts exactly one argument; got {} instead.'.format(len(sexp) - 1),
+             ':form', sexp)
     return sexp[1]
 
-def eval_typeof(sexp, env):
-    assert sexp[0].name == 'typeof'
-    if len(sexp) != 2:
-        return create_error(':arg-error',
-                            ':msg', '`typeof` form accepts exactly 1 argument; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    val = eval(sexp[1], env)
-    val_type = {List: Symbol('list'),
-                Error: Symbol('error'),
-                Symbol: Symbol('symbol'),
-                Function: Symbol('function'),
-                Macro: Symbol('macro'),
-                Bool: Symbol('bool'),
-                Integer: Symbol('int'),
-                String: Symbol('str')}.get(type(val), None)
-    assert val_type != None
-    return val_type
-
-def eval_first(sexp, env):
-    assert sexp[0].name == 'first'
-    if len(sexp) != 2:
-        return create_error(':arg-error',
-                            ':msg', '`first` form accepts exactly 1 argument; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-    ret = eval(sexp[1], env)
-    if isinstance(ret, Error):
-        return ret
-    if type(ret) != List:
-        return create_error(':type-error',
-                            ':msg', '`first` argument must be a list.',
-                            ':form', sexp[1])
-    if ret == []:
-        return create_error(':value-error',
-                            ':msg', '`first` argument cannot be an empty list.',
-                            ':form', sexp[1])
-    return ret[0]
-
-def eval_rest(sexp, env):
-    assert sexp[0].name == 'rest'
-    if len(sexp) != 2:
-        return create_error(':arg-error',
-                            ':msg', '`rest` form accepts exactly 1 argument; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-    ret = eval(sexp[1], env)
-    if type(ret) == Error:
-        return ret
-    if type(ret) != List:
-        return create_error(':type-error',
-                            ':msg', '`rest` argument must be a list.',
-                            ':form', sexp)
-    return ret[1:]
-
-def eval_prep(sexp, env):
-    assert sexp[0].name == 'prep'
+def eval_apply(sexp, env):
+    assert sexp[0].name == 'apply'
     if len(sexp) != 3:
-        return create_error(':arg-error',
-                            ':msg', '`prep` form accepts exactly 2 arguments; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-    first = eval(sexp[1], env)
-    rest = eval(sexp[2], env)
-    if isinstance(first, Error):
-        return first
-    if isinstance(rest, Error):
-        return rest
-    if type(rest) != List:
-        return create_error(':type-error',
-                            ':msg', '`prep` second argument must be a list.',
-                            ':form', sexp)
-    return [first] + rest
+        fail(':arg-error',
+             ':msg', '`apply` expects 2 arguments; {} given.'.format(len(sexp) - 1),
+             ':form', sexp)
 
-def eval_iadd(sexp, env):
-    assert sexp[0].name == 'iadd'
-    if len(sexp) != 3:
-        return create_error(':arg-error',
-                            ':msg', '`iadd` form accepts exactly 2 arguments; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
+    func = evaluate(sexp[1], env)
+    if not isinstance(func, Function):
+        if type(func) == Error:
+            raise LispError(func)
+        fail(':type-error',
+             ':msg', '`apply` first argument must be a function; got {}.'.format(func),
+             ':form', sexp[1])
+    args = evaluate(sexp[2], env)
+    if not isinstance(args, (list, List)):
+        if type(args) == Error:
+            raise LispError(args)
+        fail(':type-error',
+             ':msg', 'A list not passed as function argument list.',
+             ':form', args)
 
-    first = eval(sexp[1], env)
-    second = eval(sexp[2], env)
+    env = func.bind(args)
+    if type(env) == Error:
+        raise LispError(env)
 
-    if isinstance(first, Error):
-        return first
-    if isinstance(second, Error):
-        return second
+    return TailCall(func.code, env)
 
-    if not isinstance(first, Integer) or not isinstance(second, Integer):
-        return create_error(':type-error',
-                            ':msg', '`iadd` only accepts integers.',
-                            ':form', sexp)
+def check_try(sexp):
+    '''Returns an Error if the try form sexp is not well formed: a form
+    followed by catch clauses, each a list of an error type and the form
+    to evaluate if the error is of that type. Returns None otherwise.
 
-    return Integer(first + second)
+    '''
 
-def eval_imul(sexp, env):
-    assert sexp[0].name == 'imul'
-    if len(sexp) != 3:
+    if len(sexp) < 2:
         return create_error(':arg-error',
-                            ':msg', '`imul` form accepts exactly 2 arguments; {} given.'.format(len(sexp) - 1),
+                            ':msg', '`try` form expects at least one argument; 0 given.',
                             ':form', sexp)
 
-    first = eval(sexp[1], env)
-    second = eval(sexp[2], env)
-
-    if isinstance(first, Error):
-        return first
-    if isinstance(second, Error):
-        return second
-
-    if not isinstance(first, Integer) or not isinstance(second, Integer):
-        return create_error(':type-error',
-                            ':msg', '`imul` only accepts integers.',
-                            ':form', sexp)
+    for clause in sexp[2:]:
+        if type(clause) != List:
+            return create_error(':form-error',
+                                ':msg', 'try catch clauses must be lists.',
+                                ':form', clause)
+        if len(clause) < 2:
+            return create_error(':form-error',
+                                ':msg', 'try catch clauses must be two element lists.',
+                                ':form', clause)
+    return None
+
+def catch_table(clauses):
+    '''Returns a dictionary from the error types of clauses to the forms
+    to evaluate for them, if all the types are keywords, so that finding
+    the clause of an error does not take evaluating anything. Returns
+    None otherwise; the types then have to be evaluated in order.
+
+    '''
+
+    table = {}
+    for clause in clauses:
+        error_type = clause[0]
+        if type(error_type) != Symbol or error_type.kind != Symbol.KEYWORD:
+            return None
+        table.setdefault(error_type, clause[1])
+    return table
+
+def no_catch_error(sexp):
+    clauses = List(sexp[2:])
+    if len(clauses) > 0:
+        span_location(clauses, sexp, 2, len(sexp) - 1)
+    else:
+        copy_location(clauses, sexp)
+    return create_error(':catch-error',
+                        ':msg', 'No catch clause matched.',
+                        ':form', clauses)
+
+def eval_try(sexp, env):
+    assert sexp[0].name == 'try'
+
+    # the catch table, or False if there is none.
+    table = getattr(sexp, 'catches', None)
+    if table is None:
+        error = check_try(sexp)
+        if error is not None:
+            raise LispError(error)
+        table = catch_table(sexp[2:])
+        if table is None:
+            table = False
+        sexp.catches = table
 
-    return Integer(first * second)
+    try:
+        value = evaluate(sexp[1], env)
+    except LispError as e:
+        value = e.error
+    else:
+        if type(value) != Error:
+            return value
+
+    # catch clauses see the type of the error as `it`.
+    error_type = value.type
+    frame = Frame(IT, [error_type], env)
+    if table:
+        form = table.get(error_type)
+        if form is not None:
+            return TailCall(form, frame)
+    elif table is False:
+        for clause in sexp[2:]:
+            if eval(clause[0], frame) is error_type:
+                return TailCall(clause[1], frame)
+
+    raise LispError(no_catch_error(sexp))
+
+def let_bindings(sexp):
+    '''Returns the names a let or let* form sexp binds and the forms of
+    their values, raising a LispError if it is not well formed. The
+    names of a let form are a tuple, the names of the frame it makes;
+    those of a let* form are a tuple of such tuples, one per frame.
+
+    '''
+
+    bindings = getattr(sexp, 'bindings', None)
+    if bindings is not None:
+        return bindings
 
-def eval_idiv(sexp, env):
-    assert sexp[0].name == 'idiv'
     if len(sexp) != 3:
-        return create_error(':arg-error',
-                            ':msg', '`idiv` form accepts exactly 2 arguments; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    first = eval(sexp[1], env)
-    second = eval(sexp[2], env)
-
-    if isinstance(first, Error):
-        return first
-    if isinstance(second, Error):
-        return second
-
-    if not isinstance(first, Integer) or not isinstance(second, Integer):
-        return create_error(':type-error',
-                            ':msg', '`idiv` only accepts integers.',
-                            ':form', sexp)
-
-    if second == 0:
-        return create_error(':value-error',
-                            ':msg', 'Division by zero.',
-                            ':form', sexp)
-
-    return Integer(first / second)
-
-def eval_imod(sexp, env):
-    assert sexp[0].name == 'imod'
+        fail(':arg-error',
+             ':msg', '`{}` form accepts exactly 2 arguments; {} given.'.format(sexp[0].name, len(sexp) - 1),
+             ':form', sexp)
+
+    pairs = sexp[1]
+    if type(pairs) != List:
+        fail(':form-error',
+             ':msg', '`{}` bindings must be a list.'.format(sexp[0].name),
+             ':form', pairs)
+    for pair in pairs:
+        if type(pair) != List or len(pair) != 2:
+            fail(':form-error',
+                 ':msg', '`{}` bindings must be two element lists.'.format(sexp[0].name),
+                 ':form', pair)
+
+    # the names are checked like the parameters of the functions the
+    # Lisp versions expand to.
+    names = List(pair[0] for pair in pairs)
+    try:
+        if sexp[0] is LET_STAR:
+            for name in names:
+                check_function_params(List([name]))
+            names = tuple((name,) for name in names)
+        else:
+            check_function_params(names)
+            names = tuple(names)
+    except ParamError as e:
+        fail(':param-error',
+             ':msg', str(e),
+             ':form', pairs)
+
+    bindings = (names, tuple(pair[1] for pair in pairs))
+    sexp.bindings = bindings
+    return bindings
+
+def condition(cond, form):
+    '''Returns the Bool a condition that is not one itself stands for:
+    the one it is equal to, as with the integers 1 and 0. Raises the
+    error for any other value.
+
+    '''
+
+    if type(cond) == Error:
+        raise LispError(cond)
+    if cond == true:
+        return true
+    if cond == false:
+        return false
+    fail(':type-error',
+         ':msg', Message('`if` condition can only be a boolean; got a {} instead.', type(cond).__name__),
+         ':form', form)
+
+def eval_let(sexp, env):
+    assert sexp[0].name == 'let'
+    names, forms = let_bindings(sexp)
+
+    # the values are evaluated like function arguments: an error is a
+    # value, bound like any other.
+    return TailCall(sexp[2], Frame(names, [eval(i, env) for i in forms], env))
+
+def eval_let_star(sexp, env):
+    assert sexp[0].name == 'let*'
+    names, forms = let_bindings(sexp)
+
+    for name, form in zip(names, forms):
+        env = Frame(name, [eval(form, env)], env)
+    return TailCall(sexp[2], env)
+
+def eval_cond(sexp, env):
+    assert sexp[0].name == 'cond'
+
+    clauses = getattr(sexp, 'clauses', None)
+    if clauses is None:
+        for clause in sexp[1:]:
+            if type(clause) != List or len(clause) < 2:
+                fail(':form-error',
+                     ':msg', 'cond clauses must be two element lists.',
+                     ':form', clause)
+        clauses = tuple((clause[0], clause[1]) for clause in sexp[1:])
+        sexp.clauses = clauses
+
+    for test, form in clauses:
+        cond = evaluate(test, env)
+        if cond is not true and cond is not false:
+            cond = condition(cond, test)
+        if cond is true:
+            return TailCall(form, env)
+    return false
+
+def eval_when(sexp, env):
+    assert sexp[0].name == 'when'
     if len(sexp) != 3:
-        return create_error(':arg-error',
-                            ':msg', '`imod` form accepts exactly 2 arguments; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    first = eval(sexp[1], env)
-    second = eval(sexp[2], env)
-
-    if isinstance(first, Error):
-        return first
-    if isinstance(second, Error):
-        return second
+        fail(':arg-error',
+             ':msg', '`when` form accepts exactly 2 arguments; {} given.'.format(len(sexp) - 1),
+             ':form', sexp)
+
+    cond = evaluate(sexp[1], env)
+    if cond is not true and cond is not false:
+        cond = condition(cond, sexp[1])
+
+    if cond is true:
+        return TailCall(sexp[2], env)
+    return empty_list
+
+def eval_and(sexp, env):
+    assert sexp[0].name == 'and'
+    for i in sexp[1:]:
+        value = evaluate(i, env)
+        if value is not true and value is not false:
+            value = condition(value, i)
+        if value is false:
+            return false
+    return true
+
+def eval_or(sexp, env):
+    assert sexp[0].name == 'or'
+    for i in sexp[1:]:
+        value = evaluate(i, env)
+        if value is not true and value is not false:
+            value = condition(value, i)
+        if value is true:
+            return true
+    return false
+
+# primitives: Lisp forms implemented by a Python function of the
+# evaluated arguments. The arity, error propagation and type checks are
+# generated from the declaration.
+
+@primitive('typeof', None, propagate_errors=False)
+def prim_typeof(val):
+    val_type = type_names.get(type(val), None)
+    assert val_type != None
+    return Symbol(val_type)
 
-    if not isinstance(first, Integer) or not isinstance(second, Integer):
-        return create_error(':type-error',
-                            ':msg', '`imod` only accepts integers.',
-                            ':form', sexp)
+@primitive('eq', None, None, propagate_errors=False,
+           arity_msg='`eq` form accepts exactly two arguments; {} given.')
+def prim_eq(first, second):
+    if type(first) != List and type(second) != List:
+        return true if first == second else false
+    elif first == second == []:
+        return true
+    else:
+        return false
+
+@primitive('first', List,
+           type_msg='`first` argument must be a list.', type_item=1)
+def prim_first(lst):
+    if lst == []:
+        raise PrimitiveError(':value-error',
+                             '`first` argument cannot be an empty list.', 1)
+    return lst[0]
+
+@primitive('rest', List,
+           type_msg='`rest` argument must be a list.')
+def prim_rest(lst):
+    return lst[1:]
+
+@primitive('prep', None, List,
+           type_msg='`prep` second argument must be a list.')
+def prim_prep(first, rest):
+    return rest.prep(first)
+
+@primitive('error-type', Error,
+           arity_msg='error-type expects exactly one argument; {} given.',
+           type_msg='error-type argument must be an Error; {} given.')
+def prim_error_type(error):
+    return error.type
 
+@primitive('error-attrs', Error,
+           arity_msg='error-attrs expects exactly one argument; {} given.',
+           type_msg='error-attrs argument must be an Error; {} given.')
+def prim_error_attrs(error):
+    return unresolve(error.attrs)
+
+@primitive('iadd', Integer, Integer,
+           type_msg='`iadd` only accepts integers.')
+def prim_iadd(first, second):
+    return make_integer(first + second)
+
+@primitive('imul', Integer, Integer,
+           type_msg='`imul` only accepts integers.')
+def prim_imul(first, second):
+    return make_integer(first * second)
+
+@primitive('idiv', Integer, Integer,
+           type_msg='`idiv` only accepts integers.')
+def prim_idiv(first, second):
     if second == 0:
-        return create_error(':value-error',
-                            ':msg', 'Division by zero.',
-                            ':form', sexp)
-
-    return Integer(first % second)
-
-def eval_ineg(sexp, env):
-    assert sexp[0].name == 'ineg'
-    if len(sexp) != 2:
-        return create_error(':arg-error',
-                            ':msg', '`ineg` form accepts exactly 1 argument; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    first = eval(sexp[1], env)
-
-    if isinstance(first, Error):
-        return first
-
-    if not isinstance(first, Integer):
-        return create_error(':type-error',
-                            ':msg', '`ineg` only accepts integers.',
-                            ':form', sexp)
-
-    return Integer(-first)
-
-def eval_ilt(sexp, env):
-    assert sexp[0].name == 'ilt'
-    if len(sexp) != 3:
-        return create_error(':arg-error',
-                            ':msg', '`ilt` form accepts exactly 2 arguments; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    first = eval(sexp[1], env)
-    second = eval(sexp[2], env)
-
-    if isinstance(first, Error):
-        return first
-    if isinstance(second, Error):
-        return second
-
-    if not isinstance(first, Integer):
-        return create_error(':type-error')
-    if not isinstance(second, Integer):
-        return create_error(':type-error')
-
-    return Bool(first < second)
-
-def eval_scat(sexp, env):
-    assert sexp[0].name == 'scat'
-    if len(sexp) != 3:
-        return create_error(':arg-error',
-                            ':msg', '`scat` form accepts exactly 2 arguments: {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    first = eval(sexp[1], env)
-    second = eval(sexp[2], env)
-
-    if isinstance(first, Error):
-        return first
-    if isinstance(second, Error):
-        return second
-
-    if not isinstance(first, String):
-        return create_error(':type-error',
-                            ':msg', 'Arguments to `scat` form must be a string.',
-                            ':form', sexp)
-    if not isinstance(second, String):
-        return create_error(':type-error',
-                            ':msg', 'Arguments to `scat` form must be a string.',
-                            ':form', sexp)
+        raise PrimitiveError(':value-error', 'Division by zero.')
+    return make_integer(first / second)
 
+@primitive('imod', Integer, Integer,
+           type_msg='`imod` only accepts integers.')
+def prim_imod(first, second):
+    if second == 0:
+        raise PrimitiveError(':value-error', 'Division by zero.')
+    return make_integer(first % second)
+
+@primitive('ineg', Integer,
+           type_msg='`ineg` only accepts integers.')
+def prim_ineg(first):
+    return make_integer(-first)
+
+@primitive('ilt', Integer, Integer,
+           type_msg='`ilt` only accepts integers.')
+def prim_ilt(first, second):
+    return true if first < second else false
+
+@primitive('scat', String, String,
+           arity_msg='`scat` form accepts exactly 2 arguments: {} given.',
+           type_msg='Arguments to `scat` form must be a string.')
+def prim_scat(first, second):
     return String(first + second)
 
-def eval_slen(sexp, env):
-    assert sexp[0].name == 'slen'
-    if len(sexp) != 2:
-        return create_error(':arg-error',
-                            ':msg', '`slen` form accepts exactly 1 argument: {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    arg = eval(sexp[1], env)
-
-    if isinstance(arg, Error):
-        return arg
-
-    if not isinstance(arg, String):
-        return create_error(':type-error',
-                            ':msg', 'Argument to `slen` form must be a string.',
-                            ':form', sexp)
-
-    return Integer(len(arg))
-
-def eval_sslice(sexp, env):
-    assert sexp[0].name == 'sslice'
-    if len(sexp) != 4:
-        return create_error(':arg-error',
-                            ':msg', '`sslice` form accepts exactly 3 arguments: {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-
-    arg1 = eval(sexp[1], env)
-    arg2 = eval(sexp[2], env)
-    arg3 = eval(sexp[3], env)
-
-    if isinstance(arg1, Error):
-        return arg1
-
-    if isinstance(arg2, Error):
-        return arg2
-
-    if isinstance(arg3, Error):
-        return arg3
-
-    if not isinstance(arg1, String):
-        return create_error(':type-error',
-                            ':msg', 'First argument to `sslice` form must be a string.',
-                            ':form', sexp)
-
-    if not isinstance(arg2, Integer):
-        return create_error(':type-error',
-                            ':msg', 'Second argument to `sslice` form must be an integer.',
-                            ':form', sexp)
-
-    if not isinstance(arg3, Integer):
-        return create_error(':type-error',
-                            ':msg', 'Third argument to `sslice` form must be an integer.',
-                            ':form', sexp)
+@primitive('slen', String,
+           arity_msg='`slen` form accepts exactly 1 argument: {} given.',
+           type_msg='Argument to `slen` form must be a string.')
+def prim_slen(arg):
+    return make_integer(len(arg))
+
+@primitive('sslice', String, Integer, Integer,
+           arity_msg='`sslice` form accepts exactly 3 arguments: {} given.',
+           type_msg=('First argument to `sslice` form must be a string.',
+                     'Second argument to `sslice` form must be an integer.',
+                     'Third argument to `sslice` form must be an integer.'))
+def prim_sslice(arg, start, length):
+    return String(arg[start:start+length])
+
+def vector_op(name, a, b, op):
+    if len(a) != len(b):
+        raise PrimitiveError(':value-error',
+                             '`{}` arguments must have the same length.'.format(name))
+    if numpy is not None:
+        return Vector(op(a.items, b.items))
+    try:
+        return Vector(array('l', map(op, a.items, b.items)))
+    except OverflowError:
+        raise PrimitiveError(':value-error',
+                             'Integer overflow in `{}`.'.format(name))
+
+def vector_integer(name, n):
+    # the sum of the elements of a vector (without NumPy, a Python long)
+    # can be too large for an Integer.
+    try:
+        return make_integer(n)
+    except OverflowError:
+        raise PrimitiveError(':value-error',
+                             'Integer overflow in `{}`.'.format(name))
+
+@primitive('vec', List)
+def prim_vec(lst):
+    if any(type(i) != Integer for i in lst):
+        raise PrimitiveError(':type-error',
+                             '`vec` argument must be a list of integers.')
+    try:
+        return Vector(lst)
+    except OverflowError:
+        raise PrimitiveError(':value-error',
+                             '`vec` argument has an integer too large for a vector.')
+
+@primitive('vlist', Vector)
+def prim_vlist(vec):
+    return List(make_integer(i) for i in vec)
+
+@primitive('vlen', Vector)
+def prim_vlen(vec):
+    return make_integer(len(vec))
+
+@primitive('vadd', Vector, Vector)
+def prim_vadd(first, second):
+    # NumPy wraps around on overflow instead of failing; see Vector.
+    return vector_op('vadd', first, second, operator.add)
+
+@primitive('vmul', Vector, Vector)
+def prim_vmul(first, second):
+    return vector_op('vmul', first, second, operator.mul)
+
+@primitive('vsum', Vector)
+def prim_vsum(vec):
+    if numpy is not None:
+        return make_integer(vec.items.sum())
+    return vector_integer('vsum', sum(vec.items))
+
+@primitive('vdot', Vector, Vector)
+def prim_vdot(first, second):
+    if len(first) != len(second):
+        raise PrimitiveError(':value-error',
+                             '`vdot` arguments must have the same length.')
+    if numpy is not None:
+        return make_integer(numpy.dot(first.items, second.items))
+    return vector_integer('vdot', sum(map(operator.mul, first.items, second.items)))
+
+@primitive('vmin', Vector)
+def prim_vmin(vec):
+    if len(vec) == 0:
+        raise PrimitiveError(':value-error',
+                             '`vmin` argument cannot be an empty vector.')
+    return make_integer(min(vec.items))
+
+@primitive('vmax', Vector)
+def prim_vmax(vec):
+    if len(vec) == 0:
+        raise PrimitiveError(':value-error',
+                             '`vmax` argument cannot be an empty vector.')
+    return make_integer(max(vec.items))
+
+@primitive('vslice', Vector, Integer, Integer)
+def prim_vslice(vec, start, length):
+    return Vector(vec.items[start:start+length])
+
+def composition_parts(name):
+    '''Returns the parts of the function composition name, as Symbols and
+    Integers, or None if it has an empty part.
+
+    '''
+
+    parts = []
+    for part in name.split(':'):
+        if part == '':
+            return None
+        try:
+            int(part)
+        except ValueError:
+            parts.append(Symbol(part))
+        else:
+            parts.append(Integer(part))
+    return tuple(parts)
 
-    return String(arg1[arg2:arg2+arg3])
+class Composition(object):
+    '''The code of a composed function whose parts are all functions:
+    calls them one after the other, from the last to the first, the
+    way the body of the function would.
 
-def eval_eq(sexp, env):
-    assert sexp[0].name == 'eq'
-    if len(sexp) != 3:
-        return create_error(':arg-error',
-                            ':msg', '`eq` form accepts exactly two arguments; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
-    first = eval(sexp[1], env)
-    second = eval(sexp[2], env)
+    '''
 
-    if type(first) != List and type(second) != List:
-        return Bool(True) if first == second else Bool(False)
-    elif first == second == []:
-        return Bool(True)
-    else:
-        return Bool(False)
+    __slots__ = ['funcs', 'form']
 
-def eval_apply(sexp, env):
-    assert sexp[0].name == 'apply'
-    if len(sexp) != 3:
-        return create_error(':arg-error',
-                            ':msg', '`apply` expects 2 arguments; {} given.'.format(len(sexp) - 1),
-                            ':form', sexp)
+    def __init__(self, funcs, form):
+        self.funcs = funcs
+        self.form = form
 
-    func = eval(sexp[1], env)
-    if isinstance(func, Error):
-        return func
-    if not isinstance(func, Function):
-        return create_error(':type-error',
-                            ':msg', '`apply` first argument must be a function; got {}.'.format(func),
-                            ':form', sexp[1])
-    args = eval(sexp[2], env)
-    if isinstance(args, Error):
-        return args
-    if not isinstance(args, (list, List)):
-        return create_error(':type-error',
-                            ':msg', 'A list not passed as function argument list.',
-                            ':form', args)
-    return func.call(args)
+    def __call__(self, env):
+        value = env.values[0]
+        for func in self.funcs:
+            frame = func.frame([value])
+            if frame is None:
+                args = List([value])
+                copy_location(args, self.form)
+                return func.arg_error(args)
+            value = eval(func.code, frame)
+        return value
+
+def compose(values, env):
+    # (fn (x) (f0 (f1 ... (fn x))))
+    x = Symbol('x')
+    params = List([x])
+    body = x
+    for value in reversed(values):
+        body = List([value, body])
+
+    if all(type(i) == Function for i in values):
+        code = CompiledCode(Composition(tuple(reversed(values)), body))
+        return Function.compiled(params, body, (x,), code, env)
+    return eval(List([FN, params, body]), env)
 
 def eval_function_composition(exp, env):
-    def compose(names):
-        if len(names) == 1:
-            return names[0]
-        else:
-            # (fn (x) (f0 (fr x)))
-            nexp = List([Symbol('fn'), List([Symbol('x')]), List([env[names[0]] if isinstance(names[0], Symbol) else names[0], List([compose(names[1:]), Symbol('x')])])])
-            lists = [nexp, nexp[0], nexp[1], nexp[2], nexp[1][0], nexp[2][0], nexp[2][1], nexp[2][1][0], nexp[2][1][1]]
-            for i in lists:
-                i.filename = exp.filename
-                i.start_row = exp.start_row
-                i.start_col = exp.start_col
-                i.end_row = exp.end_row
-                i.end_col = exp.end_col
-
-            return eval(nexp, env)
-
-    def str_to_int_or_sym(s):
-        try:
-            int(s)
-        except ValueError:
-            return Symbol(s)
-        else:
-            return Integer(s)
-
-    names = exp.name.split(':')
-    if any(name == '' for name in names):
+    # the parts of a composition are parsed once per symbol, and the
+    # composed function is kept on the symbol along with the values of
+    # the parts it was made from, until one of them changes.
+    parts = exp.parts
+    if parts is None:
         return create_error(':composition-error',
-                            ':msg', 'Invalid function composition: {}'.format(exp.name),
+                            ':msg', Message('Invalid function composition: {}', exp.name),
                             ':form', exp)
 
-    names = List(str_to_int_or_sym(name) for name in names)
-    for i in names:
-        i.filename = exp.filename
-        i.start_row = exp.start_row
-        i.start_col = exp.start_col
-        i.end_row = exp.end_row
-        i.end_col = exp.end_col
-
-    names = [eval(i, env) if isinstance(i, Symbol) else i for i in names]
+    values = tuple(eval(i, env) if type(i) == Symbol else i for i in parts)
+    composed = exp.composed
+    if composed is not None and \
+       all(i is j for i, j in zip(values, composed[0])):
+        return composed[1]
+
+    func = compose(values, env)
+    exp.composed = (values, func)
+    return func
+
+def evaluate(exp, env):
+    '''Returns the value of exp in env, like eval, except that errors
+    can also be raised as a LispError: the tree-walker raises the
+    errors it makes and propagates.
+
+    '''
+
+    # tail calls come back from eval_sexp as TailCall objects; keep
+    # evaluating them here so that tail recursion runs in constant
+    # Python stack space. The last form evaluated is kept for locating
+    # errors (see locate).
+    form = None
+    while True:
+        t = type(exp)
+        if t == List:
+            form = exp
+            try:
+                exp = eval_sexp(exp, env)
+            except LispError as e:
+                locate(e.error, form)
+                raise
+        elif t == CompiledCode:
+            exp = exp.run(env)
+        else:
+            break
+
+        if type(exp) != TailCall:
+            return exp
+        exp, env = exp.exp, exp.env
+
+    if t == Symbol:
+        kind = exp.kind
+        if kind == Symbol.PLAIN:
+            # no parable value is ever None, so None means unbound here.
+            value = env.get(exp)
+            if value is None:
+                error = create_error(':variable-error',
+                                     ':msg', Message('Unbound variable: {}', exp.name),
+                                     ':form', exp)
+                if form is not None:
+                    # a symbol in tail position of form.
+                    locate(error, form)
+                return error
+            return value
+        elif kind == Symbol.NIL:
+            return empty_list
+        elif kind == Symbol.KEYWORD:
+            return exp
+        else:
+            return eval_function_composition(exp, env)
+    elif t == LocalRef:
+        depth = exp.depth
+        while depth:
+            env = env.parent
+            depth -= 1
+        return env.values[exp.slot]
 
-    return compose(names)
+    # everything else evaluates to itself.
+    return exp
 
 def eval(exp, env):
-    if type(exp) == List:
-        return eval_sexp(exp, env)
-    elif type(exp) == Integer:
-        return exp
-    elif type(exp) == String:
-        return exp
-    elif type(exp) == Bool:
-        return exp
-    elif type(exp) == Error:
-        return exp
-    elif isinstance(exp, Function):
-        return exp
-    elif isinstance(exp, Macro):
-        return exp
-    elif exp == Symbol('nil'):
-        return List()
-    elif type(exp) == Symbol and exp.name.startswith(':'):
-        return exp
+    '''Returns the value of exp in env; an Error if evaluating it
+    fails.
 
-    if exp.name.find(':') > 0:
-        return eval_function_composition(exp, env)
+    '''
 
-    if exp not in env:
-        return create_error(':variable-error',
-                            ':msg', 'Unbound variable: {}'.format(exp.name),
-                            ':form', exp)
+    try:
+        return evaluate(exp, env)
+    except LispError as e:
+        return e.error
 
-    return env[exp]
+def eval_item(form, i, env):
+    '''Like eval, for item i of form; an error about that item gets its
+    location in form (see locate).
+
+    '''
+
+    try:
+        value = evaluate(form[i], env)
+    except LispError as e:
+        value = e.error
+    if type(value) == Error:
+        locate(value, form)
+    return value
+
+def locate(error, form):
+    '''Gives error, if it has no location and its :form is a symbol,
+    boolean or local variable reference among the items of form (like
+    the unbound variable of a :variable-error, or the argument of a
+    primitive), the location of that item in form. Symbols and
+    booleans are shared, so the reader keeps their locations in the
+    lists they appear in instead; the lexically addressed copies of
+    the lists keep them too.
+
+    '''
+
+    if error.filename:
+        return
+    value = error.get(':form')
+    t = type(value)
+    if t != Symbol and t != Bool and t != LocalRef:
+        return
+    for i, item in enumerate(form):
+        if item is value:
+            location = form.item_location(i)
+            if location is not None:
+                copy_location(error, location)
+            return
+
+special_forms.update({
+    Symbol('if'): eval_if,
+    Symbol('quote'): eval_quote,
+    Symbol('error'): eval_error,
+    Symbol('apply'): eval_apply,
+    Symbol('try'): eval_try,
+})
+
+# the forms stdlib.lisp defines as macros or functions that are also
+# special forms, for speed: eval_sexp runs them without expanding or
+# calling anything, unless their names are bound to something else (see
+# runs_natively). See lisp_forms.
+derived_forms = {
+    LET: eval_let,
+    LET_STAR: eval_let_star,
+    COND: eval_cond,
+    Symbol('when'): eval_when,
+    Symbol('and'): eval_and,
+    Symbol('or'): eval_or,
+}
+
+special_forms.update(derived_forms)
+
+def runs_natively(head, value, globals):
+    '''Returns whether a form whose head is one of the derived forms runs
+    natively, where value is what head is bound to as a variable and
+    globals the global environment: when it is not bound at all, or
+    bound to the very value stdlib.lisp defined it as when it was loaded
+    into globals (see Env). A local variable or a definition of the
+    user's with the same name is used like any other.
+
+    '''
+
+    if value is None:
+        return True
+    return type(globals) == Env and globals.stdlib.get(head) is value
+
+# how resolve addresses the variables of the special forms that bind
+# any, or whose arguments are not all forms.
+binding_forms = {
+    TRY: resolve_try,
+    LET: resolve_let,
+    LET_STAR: resolve_let_star,
+    COND: resolve_cond,
+}
+
+def lisp_forms(enabled):
+    '''With enabled true, leaves the derived forms to their definitions
+    in stdlib.lisp instead of evaluating them natively, so the two can
+    be checked against each other; with enabled false, goes back to the
+    native versions. Only to be used before any code is run, since
+    lexically addressed code depends on which versions are in use.
+
+    '''
+
+    for name, handler in derived_forms.iteritems():
+        if enabled:
+            special_forms.pop(name, None)
+        else:
+            special_forms[name] = handler
 
 def eval_sexp(sexp, env):
-    if sexp == []:
-        return List()
+    if len(sexp) == 0:
+        return empty_list
 
     first = sexp[0]
 
-    if first == Symbol('fn'):
+    if first is FN:
         if len(sexp) != 3:
-            return create_error(':form-error',
-                                ':msg', 'Invalid fn expression.',
-                                ':form', sexp)
+            fail(':form-error',
+                 ':msg', 'Invalid fn expression.',
+                 ':form', sexp)
         try:
             return Function(sexp[1], sexp[2], env)
         except ParamError as e:
-            return create_error(':param-error',
-                                ':msg', str(e),
-                                ':form', sexp[1])
-    if first == Symbol('mac'):
+            fail(':param-error',
+                 ':msg', str(e),
+                 ':form', sexp[1])
+    if first is MAC:
         if len(sexp) != 3:
-            return create_error(':form-error',
-                                ':msg', 'Invalid mac expression.',
-                                ':form', sexp)
+            fail(':form-error',
+                 ':msg', 'Invalid mac expression.',
+                 ':form', sexp)
         try:
             return Macro(sexp[1], sexp[2], env)
         except ParamError as e:
-            return create_error(':param-error',
-                                ':msg', 'Invalid macro parameter list: ' + str(e),
-                                ':form', sexp[1])
-
-    map = {
-        Symbol('if'): eval_if,
-        Symbol('quote'): eval_quote,
-        Symbol('prep'): eval_prep,
-        Symbol('typeof'): eval_typeof,
-        Symbol('first'): eval_first,
-        Symbol('rest'): eval_rest,
-        Symbol('eq'): eval_eq,
-        Symbol('error'): eval_error,
-        Symbol('error-type'): eval_error_type,
-        Symbol('error-attrs'): eval_error_attrs,
-        Symbol('apply'): eval_apply,
-        Symbol('iadd'): eval_iadd,
-        Symbol('imul'): eval_imul,
-        Symbol('idiv'): eval_idiv,
-        Symbol('imod'): eval_imod,
-        Symbol('ilt'): eval_ilt,
-        Symbol('ineg'): eval_ineg,
-        Symbol('scat'): eval_scat,
-        Symbol('slen'): eval_slen,
-        Symbol('sslice'): eval_sslice,
-    }
-
-    if type(first) == Symbol and first in map:
-        return map[first](sexp, env)
+            fail(':param-error',
+                 ':msg', 'Invalid macro parameter list: ' + str(e),
+                 ':form', sexp[1])
+
+    if type(first) == Symbol:
+        handler = special_forms.get(first)
+        if handler is not None:
+            if first not in derived_forms:
+                return handler(sexp, env)
+            native = getattr(sexp, 'native', None)
+            if native is None:
+                # a form that was not resolved, like a top-level form or
+                # a macro expansion; decide on its first evaluation.
+                native = runs_natively(first, lookup(env, first),
+                                       global_env(env))
+                sexp.native = native
+            if native:
+                return handler(sexp, env)
 
     # it must be a function or macro call, or an integer index.
 
-    first = eval(sexp[0], env)
+    first = evaluate(sexp[0], env)
+
+    if isinstance(first, Function):
+        # evaluate the arguments straight into the slots of the frame of
+        # the call, spelling out the common arities; an error is a value
+        # to the function.
+        n = len(sexp)
+        if n == 1:
+            values = []
+        elif n == 2:
+            values = [eval_item(sexp, 1, env)]
+        elif n == 3:
+            values = [eval_item(sexp, 1, env), eval_item(sexp, 2, env)]
+        elif n == 4:
+            values = [eval_item(sexp, 1, env), eval_item(sexp, 2, env),
+                      eval_item(sexp, 3, env)]
+        else:
+            values = [eval_item(sexp, i, env) for i in xrange(1, n)]
+
+        frame = first.frame(values)
+        if frame is None:
+            raise LispError(first.arg_error(arg_list(values, sexp)))
+
+        return TailCall(first.code, frame)
+    elif isinstance(first, Macro):
+        # evaluate the result of expansion.
+        return TailCall(expand_macro_call(first, sexp), env)
 
     if isinstance(first, Integer):
         if len(sexp) != 2:
-            return create_error(':arg-error',
-                                ':msg', 'Index form with more than one argument.',
-                                ':form', sexp)
+            fail(':arg-error',
+                 ':msg', 'Index form with more than one argument.',
+                 ':form', sexp)
 
         second = eval(sexp[1], env)
         if not isinstance(second, (List, String)):
-            return create_error(':type-error',
-                                ':msg', 'Only lists and strings can be indexed.',
-                                ':form', sexp[1])
+            fail(':type-error',
+                 ':msg', 'Only lists and strings can be indexed.',
+                 ':form', sexp[1])
 
         if first < 0 or first > len(second) - 1:
-            return create_error(':index-error',
-                                ':msg', 'Index {} not valid for the given argument.'.format(first),
-                                ':form', sexp[0])
+            fail(':index-error',
+                 ':msg', 'Index {} not valid for the given argument.'.format(first),
+                 ':form', sexp[0])
 
         if isinstance(second, List):
             return second[first]
         else:
             return String(second[first])
 
-    if isinstance(first, Error):
-        return first
-
-    if not isinstance(first, (Function, Macro)):
-        return create_error(':value-error',
-                            ':msg', 'Not a function or a macro: {}'.format(first),
-                            ':form', sexp[0])
-
-    args = List(sexp[1:])
-    args.filename = sexp.filename
-    args.start_row = sexp.start_row
-    args.start_col = sexp.start_col
-    args.end_row = sexp.end_row
-    args.end_col = sexp.end_col
-
-    if isinstance(first, Function):
-        # evaluate arguments.
-        args = List([eval(i, env) for i in args])
-        if len(sexp) > 1:
-            args.start_row = sexp[1].start_row
-            args.start_col = sexp[1].start_col
-            args.end_row = sexp[-1].end_row
-            args.end_col = sexp[-1].end_col
-        else:
-            args.start_row = sexp.start_row
-            args.start_col = sexp.start_col
-            args.end_row = sexp.end_row
-            args.end_col = sexp.end_col
-        args.filename = sexp.filename
-
-        return first.call(args)
-    elif isinstance(first, Macro):
-        # now expand the macro.
-        expanded = first.expand(args)
+    if type(first) == Error:
+        raise LispError(first)
 
-        # evaluate the result of expansion.
-        return eval(expanded, env)
-    else:
-        return create_error(':value-error',
-                            ':msg', 'Expected a macro or a function, got: {}'.format(first),
-                            ':form', first)
+    fail(':value-error',
+         ':msg', 'Not a function or a macro: {}'.format(first),
+         ':form', sexp[0])
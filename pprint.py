@@ -1,4 +1,5 @@
-from parable import Error, Symbol, String, Integer, List, Function, Macro, Bool
+from parable import Error, Symbol, String, Integer, List, Function, Macro, Bool, LocalRef, \
+    Vector
 
 def pprint_error(form):
     if len(form.attrs) > 0:
@@ -14,12 +15,18 @@ def pprint_bool(form):
 def pprint_symbol(form):
     return form.name
 
+def pprint_local_ref(form):
+    return form.symbol.name
+
 def pprint_string(form):
     return '"{}"'.format(form.replace('"', '\\"'))
 
 def pprint_integer(form):
     return '{}'.format(form)
 
+def pprint_vector(form):
+    return '#v({})'.format(' '.join(str(i) for i in form))
+
 def pprint_function(form):
     if form.params == List():
         return '(fn () {})'.format(pprint(form.body))
@@ -58,10 +65,12 @@ def pprint(form):
 
     result = {
         Symbol: pprint_symbol,
+        LocalRef: pprint_local_ref,
         Error: pprint_error,
         Bool: pprint_bool,
         Integer: pprint_integer,
         String: pprint_string,
+        Vector: pprint_vector,
         Function: pprint_function,
         Macro: pprint_macro,
         List: pprint_list
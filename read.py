@@ -1,6 +1,60 @@
+import re
+import os
+import mmap
+from bisect import bisect_right
 from parable import Symbol, List, Bool, Integer, String
 from cStringIO import StringIO
 
+# The reader pulls its input from the file a line (or a chunk of a long
+# line) at a time, as it needs it, so it can read from a pipe or socket
+# that is still open; each top-level form is returned as soon as all of
+# it has arrived. The input read so far is kept in a buffer, which is
+# cut down between top-level forms. Before a form is read, the lines it
+# spans are waited for and added to the buffer all at once (see
+# Reader.wait), so that a form of many lines is not copied once for
+# each of them.
+#
+# Compiled regular expressions match runs of whitespace, atoms and
+# string literal characters in the buffer, and the position in it is a
+# single offset. A match running to the end of the buffer is repeated
+# once more input is read. Rows and columns are only computed for the
+# nodes that carry a location, from a table of the offsets the lines
+# start at.
+
+# whitespace and comments, which run from a semicolon to the end of the
+# line.
+skip_re = re.compile(r'(?:[ \t\r\n]+|;[^\n]*)*')
+
+# the characters of an atom; any other character ends it.
+atom_re = re.compile(r'[^() \'\n\t\r;]*')
+
+# whitespace and comments followed by an atom, if there is one; the
+# items of a list are read with a single match each.
+item_re = re.compile(r'(?:[ \t\r\n]+|;[^\n]*)*([^() \'\n\t\r;]*)')
+
+# the characters of a string literal that are taken as they are: all but
+# the closing quote, escapes and line breaks.
+string_re = re.compile(r'[^"\\\n]*')
+
+newline_re = re.compile(r'\n')
+
+# the next token in the scan for the end of a form (see Reader.scan),
+# after any whitespace and comments: a parenthesis, the opening quote of
+# a string literal, a quote character or an atom. There is none at the
+# end of the text.
+scan_re = re.compile(r'''
+    (?:[ \t\r\n]+|;[^\n]*)*
+    (?:([()])|(")|(,@|[\'`,])|([^() \'\n\t\r;]+))?
+''', re.X)
+
+# the rest of a string literal up to its closing quote, or the end of
+# the text; the whitespace and comments after a line break in it are
+# skipped, as read_string does.
+scan_string_re = re.compile(r'(?:[^"\\\n]+|\\[^\n]|\\?\n(?:[ \t\r\n]+|;[^\n]*)*)*')
+
+# the first characters of the atoms int() might accept.
+integer_start = frozenset('0123456789+-\x0b\x0c')
+
 class ReadError(RuntimeError):
     pass
 
@@ -8,213 +62,337 @@ class EofReadError(ReadError):
     pass
 
 class Reader(object):
+    # the most read from the file at a time.
+    chunk_size = 65536
+
     def __init__(self, file, filename):
         self.file = file
         self.filename = filename
+
+        # the input read and not yet thrown away, the offset of its
+        # start in the whole input, and whether the file has no more.
+        self.text = ''
+        self.base = 0
+        self.eof = False
         if isinstance(file, (str, unicode)):
             self.file = StringIO(file)
+            self.text = self.file.read()
+            self.eof = True
+
+        self.pos = 0
 
+        # the offset of the last atom, string or quote character read.
+        self.mark = 0
+
+        # the offsets in the buffer the lines start at, and the row of
+        # the first of them. That line may start before the buffer.
         self.row = 0
-        self.col = 0
+        self.lines = [0] + [m.end() for m in newline_re.finditer(self.text)]
 
-        self.__lines = self.file.readlines()
+    def fill(self):
+        '''Reads more of the file into the buffer. Returns False if the end
+        of the file has been reached.
 
-        self.skip_whitespace()
+        '''
 
-    def current(self):
-        if self.row >= len(self.__lines) or \
-           self.col >= len(self.__lines[self.row]):
-            return ''
+        if self.eof:
+            return False
 
-        return self.__lines[self.row][self.col]
+        chunk = self.file.readline(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
 
-    def next(self):
-        if self.row >= len(self.__lines):
-            return
+        self.append(chunk)
+        return True
 
-        self.col += 1
-        if self.col >= len(self.__lines[self.row]):
-            self.col = 0
-            self.row += 1
-            self.skip_whitespace()
+    def append(self, chunk):
+        size = len(self.text)
+        self.lines.extend(size + m.end() for m in newline_re.finditer(chunk))
+        self.text += chunk
+
+    def wait(self):
+        # reads the lines the next top-level form spans, if they have not
+        # all been read yet, and adds them to the buffer together.
+        if self.eof:
+            return
 
-    def go_back(self):
-        if self.row == 0 and self.col == 0:
+        self.depth = 0
+        self.in_string = False
+        if self.scan(self.text, self.pos):
             return
 
-        self.col -= 1
-        if self.col < 0:
-            self.row -= 1
-            if self.row < 0:
-                self.row = 0
-                self.col = 0
-                return
-            self.col = len(self.__lines[self.row]) - 1
-
-    def skip_whitespace(self):
-        b = self.current()
-        while b:
-            if b not in '; \t\r\n':
+        chunks = []
+        while True:
+            chunk = self.file.readline(self.chunk_size)
+            if not chunk:
+                self.eof = True
+                break
+            chunks.append(chunk)
+            if self.scan(chunk, 0):
                 break
+        self.append(''.join(chunks))
 
-            if b == ';':
-                while b and b != '\n':
-                    self.next()
-                    b = self.current()
-                self.go_back()
+    def scan(self, text, pos):
+        '''Follows the nesting of the form starting at pos in text, and then
+        of each text given after it. Returns True once the form is
+        complete, or if text does not end in a line break (the end of
+        the file, or a line longer than the chunk size), leaving the
+        rest for the reader to fill in as it goes.
 
-            self.next()
-            b = self.current()
+        '''
 
-    def mark(self):
-        self.__start_row = self.row
-        self.__start_col = self.col
+        size = len(text)
+        if size and text[-1] != '\n':
+            return True
 
-    def add_metadata(self, value):
-        value.start_row = self.__start_row
-        value.start_col = self.__start_col
-        value.end_row = self.row
-        value.end_col = self.col
-        value.filename = self.filename
+        while True:
+            if self.in_string:
+                if pos == 0:
+                    # the text before ended in a line break in the string.
+                    pos = skip_re.match(text).end()
+                pos = scan_string_re.match(text, pos).end()
+                if pos == size:
+                    return False
+                pos += 1
+                self.in_string = False
+                if not self.depth:
+                    return True
+                continue
+
+            m = scan_re.match(text, pos)
+            pos = m.end()
+            token = m.lastindex
+            if token is None:
+                return False
+            elif token == 1:
+                if text[pos - 1] == '(':
+                    self.depth += 1
+                    continue
+                # a closing parenthesis ends a list, or is read on its
+                # own outside of one.
+                if self.depth:
+                    self.depth -= 1
+                if not self.depth:
+                    return True
+            elif token == 2:
+                self.in_string = True
+            elif token == 4 and not self.depth:
+                return True
+
+    def discard(self):
+        # throw away the input before the current position, once that is
+        # at least half the buffer, so each character is copied at most
+        # once on average.
+        pos = self.pos
+        if not pos or pos < len(self.text) - pos:
+            return
 
-    def read_atom(self):
-        self.skip_whitespace()
+        first = bisect_right(self.lines, pos) - 1
+        self.row += first
+        self.lines = [i - pos for i in self.lines[first:]]
+        self.text = self.text[pos:]
+        self.base += pos
+        self.mark -= pos
+        self.pos = 0
+
+    def at(self, pos):
+        '''Returns the character at pos, or an empty string if that is past
+        the end of the file.
+
+        '''
+
+        while pos >= len(self.text):
+            if not self.fill():
+                return ''
+        return self.text[pos]
+
+    def match(self, regex, pos):
+        m = regex.match(self.text, pos)
+        while m.end() == len(self.text) and self.fill():
+            m = regex.match(self.text, pos)
+        return m
+
+    def position(self, offset):
+        lines = self.lines
+        if offset >= len(self.text) and not self.at(offset):
+            # the end of the file is at the start of the line after the
+            # last one.
+            if lines[-1] == len(self.text):
+                return self.row + len(lines) - 1, 0
+            return self.row + len(lines), 0
+
+        row = bisect_right(lines, offset) - 1
+        return self.row + row, offset - lines[row]
+
+    def add_metadata(self, value, start, end):
+        start_row, start_col = self.position(start)
+        end_row, end_col = self.position(end)
+        value.set_location(self.filename, start_row, start_col,
+                           end_row, end_col)
+
+    def read_quoted(self, name, start):
+        # the form starts at the last mark made while reading it, which
+        # is inside the quoted value if that has atoms, and ends where
+        # the reader is left after the value.
+        self.mark = start
+        self.pos = start + 1
+        form = List([Symbol(name), self.read_form()])
+        self.add_metadata(form, self.mark, self.pos)
+        return form
+
+    def read_string(self):
+        start = self.mark = self.pos
+        pos = start + 1
+        chunks = []
+        while True:
+            m = self.match(string_re, pos)
+            chunks.append(m.group())
+            pos = m.end()
 
-        atom = ''
-        b = self.current()
-        if b == "'":
-            quote = Symbol('quote')
-            self.mark()
-            self.add_metadata(quote)
+            b = self.at(pos)
+            if not b:
+                raise EofReadError('Unexpected end of file inside string literal.')
+            if b == '"':
+                break
 
-            self.mark()
-            self.next()
-            value = self.read()
-            form = List([quote, value])
-            self.add_metadata(form)
-            return form
+            if b == '\\':
+                # the escaped character is taken as it is.
+                pos += 1
+                b = self.at(pos)
+                if not b:
+                    raise EofReadError('Unexpected end of file inside string literal.')
+
+            chunks.append(b)
+            pos += 1
+            if b == '\n':
+                # whitespace and comments at the start of the lines
+                # after a line break are not part of the string.
+                pos = self.match(skip_re, pos).end()
+
+        string = String(''.join(chunks))
+        self.add_metadata(string, start, pos)
+        self.pos = pos + 1
+        return string
 
-        if b == "`":
-            backquote = Symbol('backquote')
-            self.mark()
-            self.add_metadata(backquote)
+    def read_atom(self):
+        b = self.text[self.pos]
+        if b == "'":
+            return self.read_quoted('quote', self.pos)
 
-            self.mark()
-            self.next()
-            value = self.read()
-            form = List([backquote, value])
-            self.add_metadata(form)
-            return form
+        if b == "`":
+            return self.read_quoted('backquote', self.pos)
 
         if b == ",":
-            self.next()
-            if self.current() == '@':
-                name = 'unquote-splicing'
-            else:
-                self.go_back()
-                name = 'unquote'
-            unquote = Symbol(name)
-            self.mark()
-            self.add_metadata(unquote)
-
-            self.mark()
-            self.next()
-            value = self.read()
-            form = List([unquote, value])
-            self.add_metadata(form)
-            return form
-
-        self.mark()
+            if self.at(self.pos + 1) == '@':
+                return self.read_quoted('unquote-splicing', self.pos + 1)
+            return self.read_quoted('unquote', self.pos)
 
         # is it a string literal?
         if b == '"':
-            self.mark()
-            self.next()
-            b = self.current()
-            while b and b != '"':
-                if b == '\\':
-                    self.next()
-                    b = self.current()
-                    if not b:
-                        continue
-
-                    atom += b
-                    self.next()
-                    b = self.current()
-                    b = self.current()
-                    if not b:
-                        continue
-                else:
-                    atom += b
-                    self.next()
-                    b = self.current()
-            if not b:
-                raise EofReadError('Unexpected end of file inside string literal.')
-            string = String(atom)
-            self.add_metadata(string)
-            self.next()
-            return string
-
-        while b and b not in '() \'\n\t\r;':
-            atom += b
-            self.next()
-            b = self.current()
-
-        if b:
-            self.go_back()
-
-        try:
-            # is this an integer?
-            integer = int(atom)
-            integer = Integer(integer)
-
-            # yes, it is.
-            self.add_metadata(integer)
-            self.next()
-            return integer
-        except ValueError:
-            pass # not an integer
-
+            return self.read_string()
+
+        start = self.mark = self.pos
+        end = self.match(atom_re, start).end()
+        atom = self.text[start:end]
+
+        if not atom:
+            # a closing parenthesis with no list to close; it is read as
+            # an empty symbol, and left in place unless it is the very
+            # first character.
+            if self.base + start == 0:
+                self.pos = 1
+            return Symbol(atom)
+
+        self.pos = end
+        return self.make_atom(atom, start, end)
+
+    def make_atom(self, atom, start, end):
+        if atom[0] in integer_start:
+            try:
+                # is this an integer?
+                integer = int(atom)
+                integer = Integer(integer)
+
+                # yes, it is. Its location ends at its last character,
+                # or at the end of the file if nothing follows it.
+                if self.at(end):
+                    end -= 1
+                self.add_metadata(integer, start, end)
+                return integer
+            except ValueError:
+                pass # not an integer
+
+        # booleans and symbols are shared, so they do not carry a
+        # location; read_list keeps their locations in the list.
         if atom == '#t':
-            ret = Bool(True)
+            return Bool(True)
         elif atom == '#f':
-            ret = Bool(False)
+            return Bool(False)
         else:
-            ret = Symbol(atom)
-        self.add_metadata(ret)
-        self.next()
-        return ret
+            return Symbol(atom)
 
     def read_list(self):
-        b = self.current()
-        if not b or b != '(':
-            raise ReadError('Expected "(".')
+        start = self.pos
+        items = []
 
-        items = List()
-        items.filename = self.filename
-        items.start_row = self.row
-        items.start_col = self.col
+        # the index and location of each symbol or boolean among the
+        # items.
+        locations = None
 
-        self.next()
+        pos = start + 1
         while True:
-            self.skip_whitespace()
-            b = self.current()
-
-            if not b:
+            m = item_re.match(self.text, pos)
+            if m.end() == len(self.text) and self.fill():
+                continue
+
+            atom = m.group(1)
+            pos = m.start(1)
+            if atom and atom[0] not in '`,"':
+                self.mark = pos
+                item = self.make_atom(atom, pos, m.end())
+                if type(item) != Integer:
+                    # the atom is on a single line, from its first to its
+                    # last character; see Located for the packing.
+                    lines = self.lines
+                    row = bisect_right(lines, pos) - 1
+                    col = pos - lines[row]
+                    row += self.row
+                    if locations is None:
+                        locations = []
+                    locations.append((len(items), row << 96 | col << 64 |
+                                      row << 32 | col + len(atom) - 1))
+                items.append(item)
+                pos = m.end()
+                continue
+
+            if pos == len(self.text):
                 raise EofReadError('Unexpected end of file.')
 
+            b = self.text[pos]
             if b == ')':
-                items.end_row = self.row
-                items.end_col = self.col
-                self.next()
-                return items
-
-            items.append(self.read())
-            #self.next()
+                break
 
-    def read(self):
-        self.skip_whitespace()
-        b = self.current()
+            self.pos = pos
+            if b == '(':
+                items.append(self.read_list())
+            else:
+                items.append(self.read_atom())
+            pos = self.pos
+
+        lst = List(items)
+        self.add_metadata(lst, start, pos)
+        if locations is not None:
+            packed = [0] * len(items)
+            for i, location in locations:
+                packed[i] = location
+            lst.item_locations = tuple(packed)
+        self.pos = pos + 1
+        return lst
+
+    def read_form(self):
+        self.pos = self.match(skip_re, self.pos).end()
+        b = self.at(self.pos)
         if not b:
             return None
 
@@ -222,3 +400,350 @@ class Reader(object):
             return self.read_list()
         else:
             return self.read_atom()
+
+    def read(self):
+        '''Reads the next top-level form, and returns it; or None at the end
+        of the file.
+
+        '''
+
+        self.discard()
+        self.wait()
+        return self.read_form()
+
+# Files of data, rather than code, can be read with read_data, which
+# leaves out the locations and makes plain Python values: tuples for
+# lists, ints for integers and strs for strings. Symbols and booleans
+# are read as usual. The values are the same the reader makes, and
+# errors are raised the same way.
+
+# the tokens of data, all but whitespace: parentheses, quote characters,
+# comments, string literals with no line breaks, and atoms. A double
+# quote on its own starts a string literal with a line break in it, or
+# one that is not closed.
+data_token_re = re.compile(r'''[()'`]|,@?|;[^\n]*|"(?:[^"\\\n]|\\[^\n])*"|"|[^() '\n\t\r;"`,][^() '\n\t\r;]*''')
+
+# the next token, after any whitespace and comments, with its kind told
+# apart by group: a parenthesis, a quote character, or an atom. There
+# is none at the end of the text. String literals are read with
+# read_string_data.
+data_next_re = re.compile(r'''
+    (?:[ \t\r\n]+|;[^\n]*)*
+    (?:(\()|(\))|(")|(,@|[\'`,])|([^() \'\n\t\r;]+))?
+''', re.X)
+
+escape_re = re.compile(r'\\(.)')
+
+quote_names = {
+    "'": Symbol('quote'),
+    '`': Symbol('backquote'),
+    ',': Symbol('unquote'),
+    ',@': Symbol('unquote-splicing'),
+}
+
+def data_atom(atom):
+    if atom[0] in integer_start:
+        try:
+            return int(atom)
+        except ValueError:
+            pass
+
+    if atom == '#t':
+        return Bool(True)
+    elif atom == '#f':
+        return Bool(False)
+    else:
+        return Symbol(atom)
+
+def add_data(stack, value):
+    # adds value to the innermost list being read, under the quote
+    # characters in front of it.
+    while type(stack[-1]) == Symbol:
+        value = (stack.pop(), value)
+    stack[-1].append(value)
+
+def end_data(stack):
+    # quote characters at the end of the text quote nothing.
+    if type(stack[-1]) == Symbol:
+        add_data(stack, None)
+    if len(stack) > 1:
+        raise EofReadError('Unexpected end of file.')
+    return stack[0]
+
+def read_string_data(text, pos):
+    # reads a string literal with its contents starting at pos, the same
+    # way Reader.read_string does; returns it along with the offset
+    # after it.
+    size = len(text)
+    chunks = []
+    while True:
+        m = string_re.match(text, pos)
+        chunks.append(m.group())
+        pos = m.end()
+        if pos == size:
+            raise EofReadError('Unexpected end of file inside string literal.')
+
+        b = text[pos]
+        if b == '"':
+            return ''.join(chunks), pos + 1
+
+        if b == '\\':
+            pos += 1
+            if pos == size:
+                raise EofReadError('Unexpected end of file inside string literal.')
+            b = text[pos]
+
+        chunks.append(b)
+        pos += 1
+        if b == '\n':
+            pos = skip_re.match(text, pos).end()
+
+def parse_data_slowly(text):
+    # the stack holds the lists being read, innermost last, each under
+    # the quote characters in front of it; the first one is for the
+    # top-level forms.
+    stack = [[]]
+    pos = 0
+    match = data_next_re.match
+    while True:
+        m = match(text, pos)
+        token = m.lastindex
+        if token is None:
+            return end_data(stack)
+        pos = m.end()
+
+        if token == 1:
+            stack.append([])
+        elif token == 2:
+            if type(stack[-1]) == Symbol:
+                # a quote character right before the closing
+                # parenthesis quotes an empty symbol.
+                add_data(stack, Symbol(''))
+            if len(stack) == 1:
+                # there is no list to close.
+                add_data(stack, Symbol(''))
+            else:
+                add_data(stack, tuple(stack.pop()))
+        elif token == 3:
+            value, pos = read_string_data(text, pos)
+            add_data(stack, value)
+        elif token == 4:
+            stack.append(quote_names[m.group(4)])
+        else:
+            add_data(stack, data_atom(m.group(5)))
+
+def parse_data(text):
+    '''Returns the list of the top-level forms in text, read as data.'''
+
+    tokens = data_token_re.findall(text)
+    if '"' in tokens:
+        # a string literal with a line break needs the whitespace and
+        # comments after the line break skipped.
+        return parse_data_slowly(text)
+
+    # the same as parse_data_slowly, with the common cases first.
+    stack = [[]]
+    for token in tokens:
+        b = token[0]
+        if b == '(':
+            stack.append([])
+            continue
+        elif b == ')':
+            if type(stack[-1]) == Symbol:
+                add_data(stack, Symbol(''))
+            if len(stack) == 1:
+                value = Symbol('')
+            else:
+                value = tuple(stack.pop())
+        elif b == '"':
+            value = token[1:-1]
+            if '\\' in value:
+                value = escape_re.sub(r'\1', value)
+        elif b == ';':
+            continue
+        elif token in quote_names:
+            stack.append(quote_names[token])
+            continue
+        else:
+            value = data_atom(token)
+
+        top = stack[-1]
+        if type(top) == list:
+            top.append(value)
+        else:
+            add_data(stack, value)
+
+    return end_data(stack)
+
+# what the nesting of lists is found from: parentheses, comments and
+# string literals, which can have parentheses in them. A double quote on
+# its own starts a string literal with a line break or an escape in it,
+# or one that is not closed.
+structure_re = re.compile(r'[()]|;[^\n]*|"[^"\\\n]*"|"')
+
+def at_token_start(text, pos, string_end):
+    # a character starts a token if it follows whitespace, a parenthesis,
+    # the string literal ending at string_end, or a quote character that
+    # does.
+    while pos > 0 and pos != string_end:
+        b = text[pos - 1]
+        if b in '() \'\n\t\r;':
+            return True
+        elif b in '`,':
+            pos -= 1
+        elif b == '@' and pos > 1 and text[pos - 2] == ',':
+            pos -= 2
+        else:
+            return False
+    return True
+
+# a string literal or comment, which the parentheses in are not counted.
+literal_re = re.compile(r'[";]')
+
+def split_forms(text, size):
+    '''Returns the offsets text can be split at into pieces of about size
+    characters, each made of whole top-level forms. Only the ends of
+    top-level lists are considered.
+
+    '''
+
+    # away from the split points, the parentheses between string
+    # literals and comments are counted all at once; only the lists
+    # ending past each split point are followed a token at a time.
+    # Counting cannot tell a closing parenthesis with no list to close,
+    # so text that does not end at the top level, with its parentheses
+    # balanced, is left to split_forms_slowly, which follows every
+    # token.
+    offsets = []
+    depth = 0
+    pos = 0
+    string_end = 0
+    target = size
+    search = structure_re.search
+    literal = literal_re.search
+    while True:
+        # a list ending right at target is a split point.
+        if pos < target - 1:
+            m = literal(text, pos, target - 1)
+            stop = target - 1 if m is None else m.start()
+            if stop > pos:
+                gap = text[pos:stop]
+                depth += gap.count('(') - gap.count(')')
+                pos = stop
+            if m is None:
+                if pos >= len(text):
+                    break
+                continue
+
+        m = search(text, pos)
+        if m is None:
+            break
+
+        b = m.group()
+        pos = m.end()
+        if b == '(':
+            depth += 1
+        elif b == ')':
+            depth -= 1
+            if not depth and pos >= target:
+                offsets.append(pos)
+                target = pos + size
+        elif b[0] == '"':
+            start = m.start()
+            if start and text[start - 1] not in ' (\n' and \
+               not at_token_start(text, start, string_end):
+                # a double quote in an atom.
+                pos = start + 1
+                continue
+            if b == '"':
+                try:
+                    pos = read_string_data(text, pos)[1]
+                except EofReadError:
+                    return split_forms_slowly(text, size)
+            string_end = pos
+
+    if depth:
+        return split_forms_slowly(text, size)
+    return offsets
+
+def split_forms_slowly(text, size):
+    # the same as split_forms, a token at a time.
+    offsets = []
+    depth = 0
+    pos = 0
+    string_end = 0
+    target = size
+    search = structure_re.search
+    while True:
+        m = search(text, pos)
+        if m is None:
+            return offsets
+
+        b = m.group()
+        pos = m.end()
+        if b == '(':
+            depth += 1
+        elif b == ')':
+            if depth:
+                depth -= 1
+                if not depth and pos >= target:
+                    offsets.append(pos)
+                    target = pos + size
+        elif b[0] == '"':
+            start = m.start()
+            if start and text[start - 1] not in ' (\n' and \
+               not at_token_start(text, start, string_end):
+                # a double quote in an atom.
+                pos = start + 1
+                continue
+            if b == '"':
+                try:
+                    pos = read_string_data(text, pos)[1]
+                except EofReadError:
+                    return offsets
+            string_end = pos
+
+def read_data_piece(args):
+    filename, start, end = args
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        text = data[start:end]
+    finally:
+        data.close()
+    return parse_data(text)
+
+def read_data(filename, processes=None, piece_size=1 << 22):
+    '''Reads all the top-level forms in a file of data. The file is mapped
+    into memory and split into pieces of about piece_size characters at
+    the ends of top-level lists, which are read in parallel by a pool of
+    processes.
+
+    '''
+
+    with open(filename, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return []
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offsets = [0] + split_forms(data, piece_size)
+        if offsets[-1] != len(data):
+            offsets.append(len(data))
+    finally:
+        data.close()
+
+    pieces = [(filename, start, end)
+              for start, end in zip(offsets, offsets[1:])]
+    if len(pieces) == 1 or processes == 1:
+        results = map(read_data_piece, pieces)
+    else:
+        # only imported here, since it takes a while.
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(read_data_piece, pieces, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [form for forms in results for form in forms]
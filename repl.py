@@ -1,36 +1,95 @@
 #!/usr/bin/env python2
 
-from parable import eval as eval_form, Error, Symbol
+from parable import Error, Symbol, Env, lisp_forms
 from read import Reader, ReadError, EofReadError
-from load import print_exception, print_error, LoadError, LoadWarning, load
+from load import print_exception, print_error, LoadError, LoadWarning, load, \
+    load_image, engines, engine
 from pprint import pprint
+import native
 import readline
 
+class Prompt(object):
+    '''A file the reader reads the lines typed at the prompt from. A form
+    can span several lines; the lines after the first one of a form get
+    a continuation prompt.
+
+    '''
+
+    def __init__(self):
+        self.prompt = '* '
+        self.closed = False
+
+    def readline(self, size=-1):
+        if self.closed:
+            return ''
+        try:
+            line = raw_input(self.prompt)
+        except EOFError:
+            print
+            self.closed = True
+            return ''
+        if line.strip():
+            self.prompt = '  '
+        return line + '\n'
+
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Interactive parable prompt.')
+    parser.add_argument('--engine', type=str, dest='engine',
+                        choices=sorted(engines), default='tree',
+                        help='The engine to evaluate code with.')
+    parser.add_argument('--native', type=str, dest='native',
+                        choices=['on', 'off', 'check'], default='on',
+                        help='Use the native versions of stdlib functions, '
+                        'or check them against the Lisp versions.')
+    parser.add_argument('--lisp-forms', action='store_true',
+                        dest='lisp_forms',
+                        help='Use the stdlib definitions of let, let*, '
+                        'cond, when, and and or instead of the native '
+                        'special forms.')
+    parser.add_argument('--image', type=str, dest='image', metavar='FILE',
+                        help='Start from the environment in an image file '
+                        'instead of loading the libraries.')
+    args = parser.parse_args()
+
+    eval_form = engine(args.engine)
+    lisp_forms(args.lisp_forms)
+
     try:
-        env = {}
-        for lib in ['stdlib.lisp', 'bq.lisp']:
-            with open(lib) as f:
-                try:
-                    env.update(load(f, lib, env))
-                except (LoadError, LoadWarning) as e:
-                    print_exception(e)
-                    exit(2)
+        if args.image:
+            try:
+                env = load_image(args.image)
+            except (IOError, LoadError) as e:
+                print_exception(e)
+                exit(2)
+        else:
+            env = Env()
+            for lib in ['stdlib.lisp', 'bq.lisp']:
+                with open(lib) as f:
+                    try:
+                        env.update(load(f, lib, env, eval_form))
+                    except (LoadError, LoadWarning) as e:
+                        print_exception(e)
+                        exit(2)
+
+        if args.native != 'off':
+            native.install(env, check=args.native == 'check')
 
+        prompt = Prompt()
+        reader = Reader(prompt, '<stdin>')
         while True:
+            prompt.prompt = '* '
             try:
-                expr = raw_input('* ')
-            except (KeyboardInterrupt, EOFError):
-                print
-                break
-            if not expr:
-                continue
-            try:
-                form = Reader(expr, '<string>').read()
-                result = eval_form(form, env)
+                form = reader.read()
             except ReadError as e:
                 print_exception(e)
+                # start over with the next line.
+                reader = Reader(prompt, '<stdin>')
                 continue
+            if form is None:
+                break
+            result = eval_form(form, env)
             if isinstance(result, Error):
                 print_error(result)
             print pprint(result)
@@ -1,3 +1,11 @@
 #!/bin/sh
 
-python test.py && python load.py -l stdlib.lisp bq.lisp -t test-stdlib.lisp test-bq.lisp test-composition.lisp
+LISP_TESTS="-l stdlib.lisp bq.lisp -t test-stdlib.lisp test-bq.lisp test-composition.lisp"
+
+python test.py && \
+    python load.py $LISP_TESTS && \
+    python load.py --engine closure $LISP_TESTS && \
+    python load.py --engine vm $LISP_TESTS && \
+    python load.py --native off $LISP_TESTS && \
+    python load.py --lisp-forms $LISP_TESTS && \
+    python load.py --native check $LISP_TESTS
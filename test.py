@@ -1,9 +1,21 @@
 import parable
-from parable import Error, Symbol, Function, Macro, List, Bool, Integer, String, create_error
+import compile
+import vm
+import load
+import native
+from parable import Error, Symbol, Function, Macro, List, Bool, Integer, String, Env, create_error
+import read
 from read import Reader, ReadError, EofReadError
 from pprint import pprint
 
 import unittest
+import cPickle
+from cStringIO import StringIO
+import subprocess
+import tempfile
+import shutil
+import sys
+import os
 
 class SymbolTest(unittest.TestCase):
     def test_equal(self):
@@ -23,6 +35,17 @@ class SymbolTest(unittest.TestCase):
         self.assertEqual(d[Symbol('foo')], 2000)
         self.assertEqual(d[Symbol('bar')], 3000)
 
+    def test_interned(self):
+        self.assertTrue(Symbol('foo') is Symbol('foo'))
+        self.assertTrue(read_str('(foo foo)')[0] is Symbol('foo'))
+
+    def test_kind(self):
+        self.assertEqual(Symbol('foo').kind, Symbol.PLAIN)
+        self.assertEqual(Symbol(':foo').kind, Symbol.KEYWORD)
+        self.assertEqual(Symbol(':foo:bar').kind, Symbol.KEYWORD)
+        self.assertEqual(Symbol('nil').kind, Symbol.NIL)
+        self.assertEqual(Symbol('foo:bar').kind, Symbol.COMPOSITION)
+
     def test_repr(self):
         self.assertEqual(repr(Symbol('x')), '<Symbol "x">')
 
@@ -56,6 +79,35 @@ class ListTest(unittest.TestCase):
         self.assertEqual(self.list[5:], [])
         self.assertEqual(type(self.list[5:]), List)
 
+    def test_shared_tail(self):
+        rest = self.list[1:]
+        self.assertEqual(rest, [2, 3, 4, 5])
+        self.assertTrue(rest.items is self.list.items)
+
+        l1 = rest.prep(10)
+        l2 = rest.prep(20)
+        self.assertEqual(l1, [10, 2, 3, 4, 5])
+        self.assertEqual(l2, [20, 2, 3, 4, 5])
+        self.assertEqual(self.list, [1, 2, 3, 4, 5])
+        self.assertTrue(self.list.prep(0).items is self.list.items)
+
+        l1[1] = 30
+        self.assertEqual(l1, [10, 30, 3, 4, 5])
+        self.assertEqual(rest, [2, 3, 4, 5])
+
+        self.assertEqual(List([1]) + rest, [1, 2, 3, 4, 5])
+        self.assertEqual([1] + rest, [1, 2, 3, 4, 5])
+        self.assertEqual(rest + [6], [2, 3, 4, 5, 6])
+
+    def test_pickle(self):
+        rest = self.list[2:]
+        rest.start_row = 4
+        rest.expansion = None
+        copy = cPickle.loads(cPickle.dumps(rest, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy, [3, 4, 5])
+        self.assertEqual(copy.start_row, 4)
+        self.assertFalse(hasattr(copy, 'expansion'))
+
     def test_repr(self):
         self.assertEqual(repr(List([])), 'L[]')
         self.assertEqual(repr(List([Symbol('x')])), 'L[<Symbol "x">]')
@@ -76,6 +128,27 @@ class IntegerTest(unittest.TestCase):
         self.assertEqual(repr(Integer(0)), 'N0')
         self.assertEqual(repr(Integer(-4)), 'N-4')
 
+    def test_small_values(self):
+        self.assertTrue(parable.make_integer(10) is parable.make_integer(10))
+        self.assertTrue(parable.make_integer(-5) is parable.make_integer(-5))
+        self.assertFalse(parable.make_integer(1000) is parable.make_integer(1000))
+        self.assertEqual(parable.make_integer(1000), 1000)
+        self.assertFalse(Integer(10) is parable.make_integer(10))
+
+class BoolTest(unittest.TestCase):
+    def test_canonical(self):
+        self.assertTrue(Bool(True) is parable.true)
+        self.assertTrue(Bool(False) is parable.false)
+        self.assertTrue(read_str('#t') is parable.true)
+        copy = cPickle.loads(cPickle.dumps(parable.true, cPickle.HIGHEST_PROTOCOL))
+        self.assertTrue(copy is parable.true)
+
+    def test_equality(self):
+        self.assertEqual(Bool(True), Bool(True))
+        self.assertEqual(Bool(True), True)
+        self.assertNotEqual(Bool(True), Bool(False))
+        self.assertNotEqual(Bool(False), List())
+
 class StringTest(unittest.TestCase):
     def test_equality(self):
         self.assertEqual(String('foo'), String('foo'))
@@ -93,6 +166,41 @@ class StringTest(unittest.TestCase):
     def test_repr(self):
         self.assertEqual(repr(String("foo")), "S'foo'")
 
+class EnvTest(unittest.TestCase):
+    def test_lookup(self):
+        env = Env({Symbol('x'): 10}, Env({Symbol('x'): 20, Symbol('y'): 30}))
+        self.assertEqual(env[Symbol('x')], 10)
+        self.assertEqual(env[Symbol('y')], 30)
+        self.assertTrue(Symbol('y') in env)
+        self.assertFalse(Symbol('z') in env)
+        self.assertEqual(env.get(Symbol('z')), None)
+
+        with self.assertRaises(KeyError):
+            env[Symbol('z')]
+
+    def test_dict_parent(self):
+        env = Env({Symbol('x'): 10}, {Symbol('y'): 20})
+        self.assertEqual(env[Symbol('x')], 10)
+        self.assertEqual(env[Symbol('y')], 20)
+        self.assertFalse(Symbol('z') in env)
+
+    def test_set_item(self):
+        parent = Env({Symbol('x'): 10})
+        env = Env({}, parent)
+        env[Symbol('x')] = 20
+        self.assertEqual(env[Symbol('x')], 20)
+        self.assertEqual(parent[Symbol('x')], 10)
+
+    def test_function_frame(self):
+        globals = Env({Symbol('x'): 10, Symbol('y'): 20})
+        func = Function(List([Symbol('x')]), Symbol('x'), globals)
+        env = func.bind(List([Integer(30)]))
+        self.assertEqual(env.names, (Symbol('x'),))
+        self.assertEqual(env.values, [30])
+        self.assertTrue(env.parent is globals)
+        self.assertEqual(env[Symbol('x')], 30)
+        self.assertEqual(env[Symbol('y')], 20)
+
 def read_str(s):
     return Reader(s, '<string>').read()
 
@@ -278,16 +386,113 @@ class ReaderTest(unittest.TestCase):
         self.assertEqual(result[0].end_row, 0)
         self.assertEqual(result[0].end_col, 3)
 
-        self.assertEqual(result[1].start_row, 0)
-        self.assertEqual(result[1].start_col, 5)
-        self.assertEqual(result[1].end_row, 0)
-        self.assertEqual(result[1].end_col, 7)
+        # symbols are shared, so the list keeps their locations.
+        location = result.item_location(1)
+        self.assertEqual(location.start_row, 0)
+        self.assertEqual(location.start_col, 5)
+        self.assertEqual(location.end_row, 0)
+        self.assertEqual(location.end_col, 7)
+        self.assertEqual(result.item_location(0), None)
+
+        # and those of booleans.
+        location = read_str('(if #t\n    #f 1)').item_location(2)
+        self.assertEqual((location.start_row, location.start_col,
+                          location.end_row, location.end_col), (1, 4, 1, 5))
 
         self.assertEqual(result[2].start_row, 0)
         self.assertEqual(result[2].start_col, 9)
         self.assertEqual(result[2].end_row, 0)
         self.assertEqual(result[2].end_col, 13)
 
+    def test_compact_location(self):
+        result = Reader('(100\n  7 "bar")', 'foo.lisp').read()
+
+        self.assertFalse(hasattr(result, '__dict__'))
+        self.assertFalse(hasattr(result[0], '__dict__'))
+        self.assertFalse(hasattr(result[1], '__dict__'))
+        self.assertTrue(result.filename is result[0].filename)
+
+        copy = cPickle.loads(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+        for node, original in zip([copy] + list(copy), [result] + list(result)):
+            self.assertEqual(node.filename, 'foo.lisp')
+            self.assertEqual((node.start_row, node.start_col,
+                              node.end_row, node.end_col),
+                             (original.start_row, original.start_col,
+                              original.end_row, original.end_col))
+        self.assertEqual((copy[2].start_row, copy[2].start_col,
+                          copy[2].end_row, copy[2].end_col), (1, 4, 1, 8))
+
+        # so do the locations of the symbols in a list.
+        result = Reader('(foo\n  bar)', 'foo.lisp').read()
+        copy = cPickle.loads(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+        location = copy.item_location(1)
+        self.assertEqual(location.filename, 'foo.lisp')
+        self.assertEqual((location.start_row, location.start_col,
+                          location.end_row, location.end_col), (1, 2, 1, 4))
+
+        # values made at run time have no location.
+        self.assertEqual(String('x').filename, '')
+        self.assertEqual(Integer(1).end_col, 0)
+
+    def test_long_input(self):
+        exp = '(\n' + ' '.join(str(i) for i in range(20000)) + '\n"end")\n'
+        result = read_str(exp)
+
+        self.assertEqual(len(result), 20001)
+        self.assertEqual(result[19999], 19999)
+        self.assertEqual((result[1].start_row, result[1].start_col,
+                          result[1].end_row, result[1].end_col), (1, 2, 1, 2))
+        self.assertEqual((result[-1].start_row, result[-1].start_col,
+                          result[-1].end_row, result[-1].end_col), (2, 0, 2, 4))
+        self.assertEqual((result.end_row, result.end_col), (2, 5))
+
+    def test_stream(self):
+        class Pipe(object):
+            # hands out one line at a time, like a pipe being written to.
+            def __init__(self, lines):
+                self.lines = lines
+                self.count = 0
+
+            def readline(self, size=-1):
+                if self.count == len(self.lines):
+                    return ''
+                self.count += 1
+                return self.lines[self.count - 1]
+
+        pipe = Pipe(['(foo\n', ' 1) "bar"\n', '  (x\n', ')'])
+        reader = Reader(pipe, 'foo.lisp')
+
+        result = reader.read()
+        self.assertEqual(result, [Symbol('foo'), 1])
+        self.assertEqual(pipe.count, 2)
+        self.assertEqual((result.start_row, result.start_col,
+                          result.end_row, result.end_col), (0, 0, 1, 2))
+
+        result = reader.read()
+        self.assertEqual(result, 'bar')
+        self.assertEqual(pipe.count, 2)
+        self.assertEqual((result.start_row, result.start_col,
+                          result.end_row, result.end_col), (1, 4, 1, 8))
+
+        result = reader.read()
+        self.assertEqual(result, [Symbol('x')])
+        self.assertEqual((result.start_row, result.start_col,
+                          result.end_row, result.end_col), (2, 2, 3, 0))
+        self.assertEqual(reader.read(), None)
+
+        # the lines of a form are all read before it is; the parentheses
+        # and quotes in strings and comments do not count.
+        pipe = Pipe(['(a "(b\n', '  ; ") (\n', '  c" ; (\n', ')\n', '(d)\n'])
+        reader = Reader(pipe, 'foo.lisp')
+        self.assertEqual(reader.read(), [Symbol('a'), '(b\nc'])
+        self.assertEqual(pipe.count, 4)
+
+        # the input is read in chunks of at most chunk_size characters.
+        exp = "(a 100 'b\n\"x y\" ,@(c))"
+        reader = Reader(StringIO(exp), '<string>')
+        reader.chunk_size = 2
+        self.assertEqual(reader.read(), read_str(exp))
+
     def test_unexpected_end_of_file_in_list(self):
         with self.assertRaises(EofReadError):
             exp = '(100 foo "bar"'
@@ -298,9 +503,81 @@ class ReaderTest(unittest.TestCase):
             exp = '"bar'
             result = read_str(exp)
 
+def plain(value):
+    # a value as read.parse_data reads it.
+    if type(value) == List:
+        return tuple(plain(i) for i in value)
+    elif type(value) == Integer:
+        return int(value)
+    elif type(value) == String:
+        return str(value)
+    return value
+
+class DataTest(unittest.TestCase):
+    def test_values(self):
+        result = read.parse_data('(a 10 "x\\"y" #t (b)) \'c ,@d')
+        self.assertEqual(result, [
+            (Symbol('a'), 10, 'x"y', Bool(True), (Symbol('b'),)),
+            (Symbol('quote'), Symbol('c')),
+            (Symbol('unquote-splicing'), Symbol('d'))])
+        self.assertEqual(type(result[0][1]), int)
+        self.assertEqual(type(result[0][2]), str)
+
+        self.assertEqual(read.parse_data('"a\n   b"'), ['a\nb'])
+
+    def test_same_as_reader(self):
+        with open('stdlib.lisp') as f:
+            text = f.read()
+
+        reader = Reader(text, 'stdlib.lisp')
+        forms = []
+        while True:
+            form = reader.read()
+            if form is None:
+                break
+            forms.append(plain(form))
+
+        self.assertEqual(read.parse_data(text), forms)
+
+    def test_errors(self):
+        with self.assertRaises(EofReadError):
+            read.parse_data('(a (b)')
+
+        with self.assertRaises(EofReadError):
+            read.parse_data('(a "b)')
+
+    def test_read_data(self):
+        text = ''.join('(item {} "a (string)" ; a comment )\n  x)\n'.format(i)
+                       for i in range(100))
+        self.assertEqual(read.split_forms(text, 100)[:2], [119, 239])
+        self.assertEqual(read.split_forms(text, 100),
+                         read.split_forms_slowly(text, 100))
+        self.assertEqual(read.split_forms(text, 119)[:2], [119, 239])
+
+        # a closing parenthesis with no list to close.
+        odd = ') (a (b)) (c)\n' * 20
+        self.assertEqual(read.split_forms(odd, 30),
+                         read.split_forms_slowly(odd, 30))
+
+        d = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(d, 'data.lisp')
+            with open(filename, 'w') as f:
+                f.write(text)
+            result = read.read_data(filename, processes=2, piece_size=100)
+        finally:
+            shutil.rmtree(d)
+
+        self.assertEqual(result, read.parse_data(text))
+        self.assertEqual(result[99], (Symbol('item'), 99, 'a (string)', Symbol('x')))
+
+# the evaluator used by eval_str; the closure engine tests swap it
+# out to run the same tests against compile.eval.
+evaluate = parable.eval
+
 def eval_str(s, env={}):
     exp = read_str(s)
-    return parable.eval(exp, env)
+    return evaluate(exp, env)
 
 class ParableCoreTest(unittest.TestCase):
     def test_bool(self):
@@ -410,6 +687,11 @@ class ParableCoreTest(unittest.TestCase):
         result = eval_str(exp)
         self.assertEqual(result, create_error(':type-error'))
 
+        # integers equal to the booleans pass for them.
+        self.assertEqual(eval_str("(if 1 :a :b)"), Symbol(':a'))
+        self.assertEqual(eval_str("(if 0 :a :b)"), Symbol(':b'))
+        self.assertEqual(eval_str("(if 2 :a :b)"), create_error(':type-error'))
+
     def test_quote(self):
         exp = '(quote x)'
         result = eval_str(exp)
@@ -911,6 +1193,45 @@ class ParableCoreTest(unittest.TestCase):
         result = eval_str(exp)
         self.assertEqual(result, create_error(':arg-error'))
 
+    def test_function_call_arities(self):
+        for n in range(6):
+            args = ' '.join(str(i) for i in range(n))
+            exp = "((fn (& r) r) {})".format(args)
+            self.assertEqual(eval_str(exp), range(n))
+
+            params = ' '.join('p{}'.format(i) for i in range(n))
+            exp = "((fn ({}) (prep {} '())) {})".format(params, n, args)
+            self.assertEqual(eval_str(exp), [n])
+
+            exp = "((fn (a & r) r) -1 {})".format(args)
+            self.assertEqual(eval_str(exp), range(n))
+
+    def test_arguments_error_details(self):
+        exp = "((fn (x & y) x))"
+        result = eval_str(exp)
+        self.assertEqual(result.get(':msg'),
+                         'Expected at least 1 argument(s) but got 0.')
+
+        exp = "((fn (x y) x)\n (iadd 1 2))"
+        result = eval_str(exp)
+        self.assertEqual(result.get(':msg'),
+                         'Expected 2 argument(s) but got 1.')
+        self.assertEqual(result.get(':form'), [3])
+        self.assertEqual((result.start_row, result.start_col,
+                          result.end_row, result.end_col), (1, 1, 1, 10))
+
+    def test_symbol_arguments_error_location(self):
+        # symbols have no location of their own; the span of the
+        # arguments is taken from where they are in the call.
+        env = {Symbol('f'): eval_str('(fn (x) x)'),
+               Symbol('a'): 1,
+               Symbol('b'): 2}
+        result = eval_str('(f a\n   a b)', env)
+        self.assertEqual(result.get(':msg'),
+                         'Expected 1 argument(s) but got 3.')
+        self.assertEqual((result.start_row, result.start_col,
+                          result.end_row, result.end_col), (0, 3, 1, 5))
+
     def test_macro_call(self):
         exp = "((mac (a b c) b) (a b) (if #t 'a 'b) (p q))"
         result = eval_str(exp)
@@ -962,6 +1283,50 @@ class ParableCoreTest(unittest.TestCase):
         result = eval_str(exp, {Symbol('x'): 20, Symbol('foo'): func})
         self.assertEqual(result, 10)
 
+    def test_composition_cache(self):
+        env = Env()
+        env[Symbol('inc')] = eval_str('(fn (x) (iadd x 1))', env)
+        env[Symbol('dbl')] = eval_str('(fn (x) (imul x 2))', env)
+
+        composed = eval_str('inc:dbl', env)
+        self.assertEqual(type(composed), Function)
+        self.assertTrue(eval_str('inc:dbl', env) is composed)
+        self.assertEqual(eval_str('(inc:dbl 5)', env), 11)
+        self.assertEqual(eval_str('(inc:dbl 5 6)', env), create_error(':arg-error'))
+        self.assertEqual(eval_str('(inc:dbl "x")', env), create_error(':type-error'))
+
+        env[Symbol('dbl')] = eval_str('(fn (x) (imul x 3))', env)
+        self.assertFalse(eval_str('inc:dbl', env) is composed)
+        self.assertEqual(eval_str('(inc:dbl 5)', env), 16)
+
+        self.assertEqual(eval_str("(inc:1 '(1 2))", env), 3)
+        self.assertEqual(eval_str("(inc:5 '(1 2))", env), create_error(':index-error'))
+
+    def test_shared_values(self):
+        self.assertTrue(eval_str('nil') is parable.empty_list)
+        self.assertTrue(eval_str('()') is parable.empty_list)
+        self.assertTrue(eval_str('(iadd 1 2)') is parable.make_integer(3))
+        self.assertTrue(eval_str('(eq 1 1)') is parable.true)
+        self.assertTrue(eval_str('(ilt 2 1)') is parable.false)
+        self.assertEqual(eval_str('(prep 1 nil)'), [1])
+        self.assertEqual(eval_str('(prep 2 nil)'), [2])
+        self.assertEqual(parable.empty_list.items, [])
+
+    def test_tail_call(self):
+        # a tail-recursive loop this long would overflow the Python
+        # stack if tail calls were not run in constant space.
+        exp = "((fn (loop) (loop loop 1000000)) " \
+              "(fn (loop n) (if (eq n 0) 'done (loop loop (iadd n -1)))))"
+        result = eval_str(exp)
+        self.assertEqual(result, Symbol('done'))
+
+        # tail calls through a macro expansion and through apply.
+        exp = "((fn (loop) (loop loop 10000)) " \
+              "(fn (loop n) ((mac (c a b) (prep 'if (prep c (prep a (prep b '()))))) " \
+              "(eq n 0) 'done (apply loop (prep loop (prep (iadd n -1) '()))))))"
+        result = eval_str(exp)
+        self.assertEqual(result, Symbol('done'))
+
     def test_integer_index_on_list(self):
         exp = "(0 '(a b c))"
         result = eval_str(exp)
@@ -1020,6 +1385,83 @@ class ParableCoreTest(unittest.TestCase):
         result = eval_str(exp)
         self.assertEqual(result, create_error(':arg-error'))
 
+class LexicalAddressingTest(unittest.TestCase):
+    def test_closure_capture(self):
+        # only the free variables the body refers to are kept.
+        exp = "((fn (x y) (fn () x)) 10 20)"
+        func = eval_str(exp)
+        self.assertEqual(func.env.names, (Symbol('x'),))
+        self.assertEqual(func.env.values, [10])
+        self.assertEqual(func.call(List()), 10)
+
+        # a closure with nothing to capture only refers to the global
+        # environment.
+        env = Env()
+        func = eval_str("((fn (x) (fn (y) y)) 10)", env)
+        self.assertTrue(func.env is env)
+
+        exp = "((((fn (x) (fn (y) (fn () (prep x (prep y '()))))) 1) 2))"
+        result = eval_str(exp)
+        self.assertEqual(result, [1, 2])
+
+    def test_macro_capture(self):
+        # a macro can expand to variables the body does not mention, so
+        # a closure calling one keeps the whole environment.
+        env = Env()
+        env[Symbol('getx')] = eval_str("(mac () 'x)", env)
+        env[Symbol('f')] = eval_str("(fn (x) ((fn () (getx))))", env)
+        self.assertEqual(eval_str("(f 5)", env), 5)
+
+        # the same goes for calls to names that are not bound yet.
+        func = eval_str("((fn (x y) (fn () (gety))) 1 2)", env)
+        env[Symbol('gety')] = eval_str("(mac () 'y)", env)
+        self.assertEqual(func.call(List()), 2)
+
+        # calls to functions do not.
+        env[Symbol('g')] = eval_str("(fn (a) a)", env)
+        func = eval_str("((fn (x y) (fn () (g x))) 1 2)", env)
+        self.assertEqual(func.env.names, (Symbol('x'),))
+
+    def test_lexical_addressing(self):
+        exp = "((fn (x) (fn (y) (prep x (prep y '())))) 10)"
+        func = eval_str(exp)
+        self.assertEqual(pprint(func), "(fn (y) (prep x (prep y 'nil)))")
+        self.assertEqual(type(func.code[1]), parable.LocalRef)
+        self.assertEqual((func.code[1].depth, func.code[1].slot), (1, 0))
+        self.assertEqual((func.code[2][1].depth, func.code[2][1].slot), (0, 0))
+
+        # shadowing
+        exp = "((fn (x) ((fn (x) x) 2)) 1)"
+        result = eval_str(exp)
+        self.assertEqual(result, 2)
+
+        # macros called through a local variable still get symbols.
+        exp = "((fn (x) ((fn (m) (m x)) (mac (a) (prep 'quote (prep a '()))))) 5)"
+        result = eval_str(exp)
+        self.assertEqual(result, Symbol('x'))
+
+    def test_parameter_spec(self):
+        # the parameter list is checked and summed up once per fn form.
+        params = read_str('(a b & c)')
+        func = Function(params, Symbol('a'), {})
+        self.assertEqual((func.arity, func.rest), (2, True))
+        self.assertTrue(Function(params, Symbol('a'), {}).names is func.names)
+
+        func = eval_str('(fn (a b) a)')
+        self.assertEqual((func.arity, func.rest), (2, False))
+
+        params = read_str('(a a)')
+        for i in range(2):
+            with self.assertRaises(parable.ParamError):
+                Function(params, Symbol('a'), {})
+
+        # nothing is kept on the shared empty list.
+        body = read_str('(prep 1 nil)')
+        func = Function(parable.empty_list, body, {})
+        self.assertTrue(Function(parable.empty_list, body, {}).code is func.code)
+        self.assertEqual(Function(parable.empty_list, Symbol('a'), {}).arity, 0)
+        self.assertFalse(hasattr(parable.empty_list, 'analysis'))
+
 class ParableUtilsTest(unittest.TestCase):
     def test_macro_expand_single(self):
         exp = "((mac (a) 'a) 'x))"
@@ -1094,6 +1536,110 @@ class ParableUtilsTest(unittest.TestCase):
         self.assertEqual(result, create_error(':arg-error'))
         self.assertEqual(expanded, False)
 
+    def test_macro_pattern(self):
+        pattern = parable.Pattern(read_str('(a (b & c) & (d e))'))
+        vars = {}
+        pattern.bind(read_str('(1 (2 3 4) 5 6)'), vars)
+        self.assertEqual(vars, {Symbol('a'): 1, Symbol('b'): 2, Symbol('c'): [3, 4],
+                                Symbol('d'): 5, Symbol('e'): 6})
+
+        for args, msg in [('(1 2 5 6)', 'Expected a list in the arguments, got: 2'),
+                          ('(1 () 5 6)', 'Expected at least 1 argument(s) but got 0.'),
+                          ('(1 (2) 5)', 'Expected 2 argument(s) but got 1.')]:
+            with self.assertRaises(parable.ArgError) as cm:
+                pattern.bind(read_str(args), {})
+            self.assertEqual(str(cm.exception).split('\n')[1].strip(), msg)
+
+    def test_expansion_cache(self):
+        env = Env()
+        env[Symbol('m')] = eval_str("(mac (x) (prep 'iadd (prep x '(1))))", env)
+        env[Symbol('f')] = eval_str("(fn (x) (m x))", env)
+
+        stats = dict(parable.macro_stats)
+        self.assertEqual(eval_str("(f 1)", env), 2)
+        self.assertEqual(eval_str("(f 2)", env), 3)
+        self.assertEqual(parable.macro_stats['misses'], stats['misses'] + 1)
+        self.assertEqual(parable.macro_stats['hits'], stats['hits'] + 1)
+
+        # redefining the macro invalidates the cached expansion.
+        env[Symbol('m')] = eval_str("(mac (x) (prep 'imul (prep x '(10))))", env)
+        self.assertEqual(eval_str("(f 2)", env), 20)
+        self.assertEqual(parable.macro_stats['misses'], stats['misses'] + 2)
+
+class LazyErrorTest(unittest.TestCase):
+    def test_lazy_attrs(self):
+        form = read_str('(iadd 1\n      "x")')
+        err = create_error(':type-error',
+                           ':msg', parable.Message('bad {} {}', 1, 'x'),
+                           ':form', form[2])
+        self.assertEqual(err.type, Symbol(':type-error'))
+        self.assertEqual(err.get(':msg'), 'bad 1 x')
+        self.assertEqual(err.get(':foo', 10), 10)
+        self.assertTrue(err._attrs is None)
+
+        self.assertEqual((err.start_row, err.start_col, err.end_row, err.end_col),
+                         (1, 6, 1, 8))
+        self.assertEqual(err.filename, '<string>')
+
+        self.assertEqual(err.attrs, [Symbol(':msg'), 'bad 1 x',
+                                     Symbol(':form'), form[2]])
+        self.assertTrue(err.attrs is err.attrs)
+        self.assertEqual(err.get(':msg'), 'bad 1 x')
+
+    def test_symbol_location(self):
+        # an error about a symbol, which has no location of its own, is
+        # located where the symbol appears in the form it is found in.
+        err = parable.eval(read_str('(iadd 1\n      undefined-var)'), {})
+        self.assertEqual(err.type, Symbol(':variable-error'))
+        self.assertEqual((err.start_row, err.start_col, err.end_row, err.end_col),
+                         (1, 6, 1, 18))
+        self.assertEqual(err.filename, '<string>')
+
+        env = Env({Symbol('f'): eval_str('(fn (x y) y)')})
+        err = parable.eval(read_str('(f 1 undefined-var)'), env)
+        self.assertEqual((err.start_col, err.end_col), (5, 17))
+
+        err = parable.eval(read_str('(first #t)'), {})
+        self.assertEqual(err.type, Symbol(':type-error'))
+        self.assertEqual((err.start_col, err.end_col), (7, 8))
+
+        # inside a function body too.
+        err = parable.eval(read_str('((fn (x) (if x undefined-var 0)) #t)'), {})
+        self.assertEqual((err.start_col, err.end_col), (15, 27))
+
+    def test_parameter_location(self):
+        # a type error about a function parameter is located where the
+        # parameter is used, although the body is lexically addressed.
+        exp = '((fn (x) (first x)) 1)'
+        for evaluate in [parable.eval, compile.eval, vm.eval]:
+            err = evaluate(read_str(exp), {})
+            self.assertEqual(err.type, Symbol(':type-error'))
+            self.assertEqual((err.start_col, err.end_col), (16, 16))
+            self.assertEqual(err.filename, '<string>')
+
+        env = Env()
+        env[Symbol('f')] = parable.eval(read_str('(fn (x) (iadd x 1))'), env)
+        env[Symbol('g')] = parable.eval(read_str('(fn (y) (f "s"))'), env)
+        err = parable.eval(read_str('(g 1)'), env)
+        self.assertEqual(err.type, Symbol(':type-error'))
+        self.assertEqual((err.start_col, err.end_col), (8, 17))
+
+    def test_no_form(self):
+        err = create_error(':value-error', ':msg', 'foo')
+        self.assertEqual(err.start_row, 0)
+        self.assertEqual(err.filename, '')
+        self.assertEqual(err.get(':form'), None)
+
+        err = Error(Symbol(':foo'), List([Symbol(':form'), read_str('(x)')]))
+        self.assertEqual(err.end_col, 0)
+        self.assertEqual(err.get(':form'), [Symbol('x')])
+
+    def test_pickle(self):
+        err = create_error(':value-error', ':msg', parable.Message('{}', 1))
+        copy = cPickle.loads(cPickle.dumps(err, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy, err)
+        self.assertEqual(copy.attrs, [Symbol(':msg'), '1'])
+
 class PrettyPrintTest(unittest.TestCase):
     def test_pprint_nil(self):
         self.assertEqual(pprint([]), 'nil')
@@ -1620,5 +2166,731 @@ class ErrorTest(unittest.TestCase):
         result = eval_str(exp)
         self.assertEqual(result, create_error(':arg-error'))
 
+    def test_symbol_error_location(self):
+        # errors about a symbol are located where it appears, whichever
+        # engine runs the form.
+        result = eval_str('((fn (x) (iadd x\n   undefined-var)) 1)')
+        self.assertEqual(result, create_error(':variable-error'))
+        self.assertEqual((result.start_row, result.start_col,
+                          result.end_row, result.end_col), (1, 3, 1, 15))
+
+        result = eval_str('((fn (x) (if x 1 2)) "s")')
+        self.assertEqual(result, create_error(':type-error'))
+        self.assertEqual((result.start_col, result.end_col), (13, 13))
+
+class TryTest(unittest.TestCase):
+    def test_catch(self):
+        exp = '(try (error :value-error) (:value-error 10) (:type-error 20))'
+        self.assertEqual(eval_str(exp), 10)
+
+        exp = '(try (iadd 1 nil) (:value-error 10) (:type-error 20))'
+        self.assertEqual(eval_str(exp), 20)
+
+        exp = '(try (error :foo) (:foo 1) (:foo 2))'
+        self.assertEqual(eval_str(exp), 1)
+
+    def test_no_error(self):
+        exp = '(try (iadd 1 2) (:value-error 10))'
+        self.assertEqual(eval_str(exp), 3)
+
+    def test_it(self):
+        exp = '(try (error :foo) (:foo it))'
+        self.assertEqual(eval_str(exp), Symbol(':foo'))
+
+        exp = "((fn (x it) (try (error :foo) (:foo (list x it)))) 1 2)"
+        self.assertEqual(eval_str(exp, {Symbol('list'): eval_str('(fn (& r) r)')}),
+                         [1, Symbol(':foo')])
+
+    def test_evaluated_types(self):
+        exp = "((fn (t) (try (error :foo) (:bar 1) (t 2))) :foo)"
+        self.assertEqual(eval_str(exp), 2)
+
+    def test_no_match(self):
+        exp = '(try (error :foo) (:bar 1))'
+        self.assertEqual(eval_str(exp), create_error(':catch-error'))
+
+        exp = '(try (error :foo))'
+        self.assertEqual(eval_str(exp), create_error(':catch-error'))
+
+    def test_bad_try(self):
+        self.assertEqual(eval_str('(try)'), create_error(':arg-error'))
+        self.assertEqual(eval_str('(try 1 :foo)'), create_error(':form-error'))
+        self.assertEqual(eval_str('(try 1 (:foo))'), create_error(':form-error'))
+
+    def test_error_value(self):
+        # an error passed around as a value is caught like a raised one.
+        exp = '((fn (e) (try e (:foo 1))) (error :foo))'
+        self.assertEqual(eval_str(exp), 1)
+
+class DerivedFormTest(unittest.TestCase):
+    def stdlib(self):
+        env = Env()
+        for lib in ['stdlib.lisp', 'bq.lisp']:
+            with open(lib) as f:
+                load.load(f, lib, env, use_cache=False)
+        return env
+
+    def test_let(self):
+        self.assertEqual(eval_str('(let ((x 1) (y 2)) (iadd x y))'), 3)
+        self.assertEqual(eval_str('(let () 10)'), 10)
+        self.assertEqual(eval_str('(let ((x (error :foo))) (typeof x))'),
+                         Symbol('error'))
+        self.assertEqual(eval_str('(let ((x 1) (y x)) y)'),
+                         create_error(':variable-error'))
+
+    def test_let_star(self):
+        self.assertEqual(eval_str('(let* ((x 1) (y (iadd x 1)) (x (iadd y 1))) x)'), 3)
+        self.assertEqual(eval_str('(let* () 10)'), 10)
+
+    def test_let_lexical_addressing(self):
+        # the bindings shadow the parameters and captured variables of
+        # the function they are in.
+        exp = """((fn (x y)
+                    ((fn (z)
+                       (let ((y 10) (w x))
+                         (let* ((x (iadd w z)) (x (iadd x y)))
+                           (iadd x y))))
+                     100))
+                  1 2)"""
+        self.assertEqual(eval_str(exp), 121)
+
+        exp = "(((fn (x) (let ((y 1)) (fn (z) (iadd x (iadd y z))))) 10) 100)"
+        self.assertEqual(eval_str(exp), 111)
+
+    def test_bad_let(self):
+        self.assertEqual(eval_str('(let ((x 1)))'), create_error(':arg-error'))
+        self.assertEqual(eval_str('(let x 1)'), create_error(':form-error'))
+        self.assertEqual(eval_str('(let ((x)) 1)'), create_error(':form-error'))
+        self.assertEqual(eval_str('(let ((x 1) (x 2)) 1)'), create_error(':param-error'))
+        self.assertEqual(eval_str('(let ((1 1)) 1)'), create_error(':param-error'))
+        self.assertEqual(eval_str('(let* ((x 1) (x 2)) x)'), 2)
+
+    def test_cond(self):
+        exp = '(cond (#f 1) ((eq 1 1) 2) (#t 3))'
+        self.assertEqual(eval_str(exp), 2)
+        self.assertEqual(eval_str('(cond (#f 1))'), Bool(False))
+        self.assertEqual(eval_str('(cond)'), Bool(False))
+        self.assertEqual(eval_str('(cond (0 1) (1 2))'), 2)
+        self.assertEqual(eval_str('(cond (2 1))'), create_error(':type-error'))
+        self.assertEqual(eval_str('(cond ((error :foo) 1))'), create_error(':foo'))
+        self.assertEqual(eval_str('(cond (#t))'), create_error(':form-error'))
+
+    def test_when(self):
+        self.assertEqual(eval_str('(when #t 1)'), 1)
+        self.assertEqual(eval_str('(when #f 1)'), [])
+        self.assertEqual(eval_str('(when 1 2)'), 2)
+        self.assertEqual(eval_str('(when #t)'), create_error(':arg-error'))
+
+    def test_and_or(self):
+        self.assertEqual(eval_str('(and)'), Bool(True))
+        self.assertEqual(eval_str('(or)'), Bool(False))
+        self.assertEqual(eval_str('(and #t #t)'), Bool(True))
+        self.assertEqual(eval_str('(or #f #t)'), Bool(True))
+        self.assertEqual(eval_str('(and #t 1)'), Bool(True))
+        self.assertEqual(eval_str('(and 1 0)'), Bool(False))
+        self.assertEqual(eval_str('(or 1 2)'), Bool(True))
+        self.assertEqual(eval_str('(or 0 :x)'), create_error(':type-error'))
+
+        # the arguments after the one that decides are not evaluated.
+        self.assertEqual(eval_str('(and #f (error :foo))'), Bool(False))
+        self.assertEqual(eval_str('(or #t (error :foo))'), Bool(True))
+        self.assertEqual(eval_str('(and #t (error :foo))'), create_error(':foo'))
+
+    def test_tail_calls(self):
+        exp = """((fn (loop) (loop loop 100000))
+                  (fn (self n)
+                    (cond ((eq n 0) :done)
+                          (#t (let ((m (iadd n -1)))
+                                (when #t (self self m)))))))"""
+        self.assertEqual(eval_str(exp), Symbol(':done'))
+
+    def test_redefinition(self):
+        # the native forms stand for the stdlib definitions; local
+        # variables and definitions of the user's with the same names
+        # are used like any other.
+        env = self.stdlib()
+        exp = "((fn (and) (and 1 2)) (fn (a b) (+ a b)))"
+        self.assertEqual(parable.eval(read_str(exp), env), 3)
+        exp = "((fn (let) ((fn (x) (let x 2)) 5)) (fn (a b) (+ a b)))"
+        self.assertEqual(parable.eval(read_str(exp), env), 7)
+
+        # like a macro call, a form in a function body is decided on
+        # when the function is made.
+        env[Symbol('f')] = parable.eval(read_str('(fn (x) (when x 1))'), env)
+        self.assertEqual(parable.eval(read_str('(f #t)'), env), 1)
+        env[Symbol('when')] = parable.eval(read_str('(mac (c b) 42)'), env)
+        self.assertEqual(parable.eval(read_str('(when #t 1)'), env), 42)
+        self.assertEqual(parable.eval(read_str('(f #t)'), env), 1)
+        env[Symbol('g')] = parable.eval(read_str('(fn (x) (when x 1))'), env)
+        self.assertEqual(parable.eval(read_str('(g #t)'), env), 42)
+
+    def test_stdlib_definitions(self):
+        # only the values stdlib.lisp defined the derived forms as when
+        # loaded into the environment are taken for them, not any with
+        # the same code or read from a file of the same name.
+        env = self.stdlib()
+        self.assertTrue(env.stdlib[Symbol('when')] is env[Symbol('when')])
+
+        other = Env()
+        reader = Reader('(mac (c b) 42)', 'stdlib.lisp')
+        other[Symbol('when')] = parable.eval(reader.read(), other)
+        self.assertEqual(parable.eval(read_str('(when #t 1)'), other), 42)
+
+        # a malformed let is a :form-error natively, a :type-error to the
+        # stdlib macro (see test_lisp_forms).
+        exp = '(let (x) x)'
+        self.assertEqual(parable.eval(read_str(exp), env),
+                         create_error(':form-error'))
+        other[Symbol('let')] = env[Symbol('let')]
+        self.assertEqual(parable.eval(read_str(exp), other),
+                         create_error(':type-error'))
+
+        with open('stdlib.lisp') as f:
+            env = load.load(f, '<stdin>', Env(), use_cache=False)
+        self.assertEqual(env.stdlib, {})
+
+    def test_lisp_forms(self):
+        # the stdlib definitions give the same results.
+        exps = [
+            '(let ((x 1) (y 2)) (list x y))',
+            '(let* ((x 1) (y (+ x 1))) (list x y))',
+            '(let ((x (error :foo))) (typeof x))',
+            '(cond (#f 1) ((= 1 1) 2))',
+            '(cond (#f 1))',
+            '(when #f 1)',
+            '(list (and #t #f) (and) (or #f #t) (or))',
+            '(and #t (error :foo))',
+            '(let ((x 1) (x 2)) x)',
+            '(list (if 1 :a :b) (cond (0 1) (1 2)) (when 1 2))',
+            '(list (or 1 2) (and #t 1) (and 1 0))',
+        ]
+        # malformed forms are errors either way, but not of the same
+        # type: the native forms check their shape and report a
+        # :form-error (or :arg-error), while the stdlib definitions fail
+        # on whatever primitive the shape breaks first; for (let (x) x),
+        # `rest` of the symbol x, a :type-error.
+        malformed = [
+            ('(let (x) x)', ':form-error', ':type-error'),
+            ('(let ((x)) 1)', ':form-error', ':value-error'),
+            ('(cond 1)', ':form-error', ':type-error'),
+            ('(when #t)', ':arg-error', ':arg-error'),
+        ]
+        malformed_exps = [exp for exp, _, _ in malformed]
+
+        env = self.stdlib()
+        native = [parable.eval(read_str(i), env) for i in exps]
+        native_malformed = [parable.eval(read_str(i), env) for i in malformed_exps]
+        parable.lisp_forms(True)
+        try:
+            env = self.stdlib()
+            lisp = [parable.eval(read_str(i), env) for i in exps]
+            lisp_malformed = [parable.eval(read_str(i), env) for i in malformed_exps]
+        finally:
+            parable.lisp_forms(False)
+        self.assertEqual(native, lisp)
+        self.assertEqual(native_malformed,
+                         [create_error(t) for _, t, _ in malformed])
+        self.assertEqual(lisp_malformed,
+                         [create_error(t) for _, _, t in malformed])
+
+class PrimitiveTest(unittest.TestCase):
+    def setUp(self):
+        @parable.primitive('test-repeat', String, Integer)
+        def prim_repeat(s, n):
+            if n < 0:
+                raise parable.PrimitiveError(':value-error', 'Negative count.')
+            return String(s * n)
+
+    def tearDown(self):
+        del parable.special_forms[Symbol('test-repeat')]
+
+    def test_call(self):
+        for evaluate in [parable.eval, compile.eval]:
+            result = evaluate(read_str('(test-repeat "ab" (iadd 1 2))'), {})
+            self.assertEqual(result, String('ababab'))
+
+    def test_checks(self):
+        for evaluate in [parable.eval, compile.eval]:
+            result = evaluate(read_str('(test-repeat "ab")'), {})
+            self.assertEqual(result, create_error(':arg-error'))
+
+            result = evaluate(read_str('(test-repeat 1 2)'), {})
+            self.assertEqual(result, create_error(':type-error'))
+            self.assertEqual(result.start_col, 13)
+
+            result = evaluate(read_str('(test-repeat "ab" (error :foo))'), {})
+            self.assertEqual(result, create_error(':foo'))
+
+            result = evaluate(read_str('(test-repeat "ab" -1)'), {})
+            self.assertEqual(result, create_error(':value-error'))
+            self.assertEqual(result.attrs[1], 'Negative count.')
+
+    def test_messages(self):
+        # the built-in primitives declare their own messages, and which
+        # part of the form their errors are about.
+        for evaluate in [parable.eval, compile.eval, vm.eval]:
+            result = evaluate(read_str('(iadd 1 "s")'), {})
+            self.assertEqual(result.get(':msg'), '`iadd` only accepts integers.')
+            self.assertEqual((result.start_col, result.end_col), (0, 11))
+
+            result = evaluate(read_str("(first '())"), {})
+            self.assertEqual(result.get(':msg'), '`first` argument cannot be an empty list.')
+            self.assertEqual((result.start_col, result.end_col), (7, 10))
+
+            result = evaluate(read_str('(sslice "abc" 0 "1")'), {})
+            self.assertEqual(result.get(':msg'), 'Third argument to `sslice` form must be an integer.')
+
+            result = evaluate(read_str('(eq 1)'), {})
+            self.assertEqual(result.get(':msg'), '`eq` form accepts exactly two arguments; 1 given.')
+
+    def test_local_shadowing(self):
+        # primitives take precedence over local variables with the same
+        # name, just like they do over global ones.
+        exp = "((fn (first) (first '(1 2))) 10)"
+        for evaluate in [parable.eval, compile.eval]:
+            self.assertEqual(evaluate(read_str(exp), {}), 1)
+
+class EngineMixin(object):
+    # runs the tests of the class it is mixed into with the eval
+    # function of another engine.
+    engine = None
+
+    def setUp(self):
+        global evaluate
+        evaluate = self.engine
+
+    def tearDown(self):
+        global evaluate
+        evaluate = parable.eval
+
+class ClosureEngineCoreTest(EngineMixin, ParableCoreTest):
+    engine = staticmethod(compile.eval)
+
+class ClosureEngineErrorTest(EngineMixin, ErrorTest):
+    engine = staticmethod(compile.eval)
+
+class ClosureEngineTryTest(EngineMixin, TryTest):
+    engine = staticmethod(compile.eval)
+
+class VMEngineCoreTest(EngineMixin, ParableCoreTest):
+    engine = staticmethod(vm.eval)
+
+class VMEngineErrorTest(EngineMixin, ErrorTest):
+    engine = staticmethod(vm.eval)
+
+class CompilerTest(unittest.TestCase):
+    def test_compiled_code(self):
+        code = compile.compile(read_str("(iadd 1 2)"), None, True)
+        self.assertEqual(code({}), 3)
+        code = parable.CompiledCode(code)
+        self.assertEqual(parable.eval(code, {}), 3)
+
+    def test_compiled_function(self):
+        env = Env()
+        func = compile.eval(read_str("((fn (x) (fn (y) (iadd x y))) 10)"), env)
+        self.assertEqual(type(func), Function)
+        self.assertEqual(func.env.values, [10])
+        self.assertEqual(func.call(List([Integer(5)])), 15)
+
+        # compiled functions can be called by the tree-walker and
+        # vice versa.
+        env[Symbol('f')] = func
+        self.assertEqual(parable.eval(read_str("(f 1)"), env), 11)
+        env[Symbol('g')] = parable.eval(read_str("(fn (x) (f x))"), env)
+        self.assertEqual(compile.eval(read_str("(g 2)"), env), 12)
+
+    def test_macro_redefinition(self):
+        env = Env()
+        env[Symbol('m')] = compile.eval(read_str("(mac () 1)"), env)
+        env[Symbol('f')] = compile.eval(read_str("(fn () (m))"), env)
+        self.assertEqual(compile.eval(read_str("(f)"), env), 1)
+        env[Symbol('m')] = compile.eval(read_str("(mac () 2)"), env)
+        self.assertEqual(compile.eval(read_str("(f)"), env), 2)
+
+    def test_macro_capture(self):
+        env = Env()
+        env[Symbol('getx')] = compile.eval(read_str("(mac () 'x)"), env)
+        env[Symbol('f')] = compile.eval(read_str("(fn (x) ((fn () (getx))))"), env)
+        self.assertEqual(compile.eval(read_str("(f 5)"), env), 5)
+
+        func = compile.eval(read_str("((fn (x y) (fn () (gety))) 1 2)"), env)
+        env[Symbol('gety')] = compile.eval(read_str("(mac () 'y)"), env)
+        self.assertEqual(func.call(List()), 2)
+
+class VMTest(unittest.TestCase):
+    def test_code(self):
+        code = vm.assemble(read_str("(iadd 1 2)"), None, True)
+        self.assertEqual(list(code.ops), [vm.CONST, 0, vm.CONST, 1,
+                                          vm.PRIM, 2, 2, vm.RETURN])
+        self.assertEqual(code(Env()), 3)
+
+    def test_deep_recursion(self):
+        # non-tail recursion only grows the VM call stack.
+        exp = "((fn (f) (f f 20000)) " \
+              "(fn (f n) (if (eq n 0) 0 (iadd 1 (f f (iadd n -1))))))"
+        self.assertEqual(vm.eval(read_str(exp), Env()), 20000)
+
+    def test_unbounded_recursion(self):
+        # it stops at vm.max_depth calls, with an error for the call that
+        # would go past it.
+        exp = "((fn (f) (f f 1)) (fn (self x) (iadd 1 (self self x))))"
+        result = vm.eval(read_str(exp), Env())
+        self.assertEqual(result, create_error(':recursion-error'))
+        self.assertEqual(pprint(result.get(':form')), '(self self x)')
+
+    def test_interop(self):
+        env = Env()
+        env[Symbol('f')] = parable.eval(read_str("(fn (x) (imul x 2))"), env)
+        env[Symbol('g')] = vm.eval(read_str("(fn (x) (iadd (f x) 1))"), env)
+        self.assertEqual(vm.eval(read_str("(g 5)"), env), 11)
+        self.assertEqual(parable.eval(read_str("(g 6)"), env), 13)
+
+    def test_shared_forms(self):
+        # the VM expands the stdlib macros the tree-walker has native
+        # forms for; what each caches on a form must not confuse the
+        # other.
+        env = Env()
+        for lib in ['stdlib.lisp', 'bq.lisp']:
+            with open(lib) as f:
+                load.load(f, lib, env, use_cache=False)
+        for exp in ['(try (error :a) (:a 1))',
+                    '(let ((x 1)) (try (error :a) (:a x)))',
+                    '(let* ((x 1)) x)',
+                    '(cond (#f 0) (#t 1))']:
+            form = read_str(exp)
+            self.assertEqual(vm.eval(form, env), 1)
+            self.assertEqual(parable.eval(form, env), 1)
+            self.assertEqual(vm.eval(form, env), 1)
+
+    def test_macro_capture(self):
+        env = Env()
+        env[Symbol('getx')] = vm.eval(read_str("(mac () 'x)"), env)
+        env[Symbol('f')] = vm.eval(read_str("(fn (x) ((fn () (getx))))"), env)
+        self.assertEqual(vm.eval(read_str("(f 5)"), env), 5)
+
+        func = vm.eval(read_str("((fn (x y) (fn () (gety))) 1 2)"), env)
+        env[Symbol('gety')] = vm.eval(read_str("(mac () 'y)"), env)
+        self.assertEqual(func.call(List()), 2)
+
+    def test_disassemble(self):
+        code = vm.assemble(read_str("(fn (x) (if x 'yes (foo x)))"), None, True)
+        self.assertEqual(vm.disassemble(code).split('\n'), [
+            '    0 FN       0 0               ; fn (x)',
+            '    3 RETURN',
+            '',
+            'fn (x):',
+            '        0 LOCAL0   0',
+            "        2 IF       10 21 0       ; (if x 'yes (foo x))",
+            '        6 CONST    1             ; yes',
+            '        8 JUMP     21',
+            '       10 GLOBAL   1 2           ; foo',
+            '       13 MACRO    3 21          ; (foo x)',
+            '       16 LOCAL0   0',
+            '       18 TAILCALL 1 4           ; (foo x)',
+            '       21 RETURN',
+        ])
+
+    def test_constants(self):
+        # a constant used more than once is only in the pool once.
+        code = vm.assemble(read_str("(prep 'a (prep 'a '()))"), None, True)
+        self.assertEqual(code.consts.count(Symbol('a')), 1)
+
+    def test_operand_range(self):
+        # more arguments than an operand can count are an error, not a
+        # crash.
+        args = ' '.join('"{}"'.format(i) for i in xrange(0x10000))
+        result = vm.eval(read_str('(f {})'.format(args)), Env())
+        self.assertEqual(result, create_error(':form-error'))
+
+    def test_global_location(self):
+        result = vm.eval(read_str('(iadd 1\n  undefined-var)'), Env())
+        self.assertEqual(result, create_error(':variable-error'))
+        self.assertEqual((result.start_row, result.start_col,
+                          result.end_row, result.end_col), (1, 2, 1, 14))
+
+class LoadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'lib.lisp')
+        self.write("(define m (mac (x) (prep 'quote (prep x '()))))\n"
+                   "(define f (fn () (m foo)))\n"
+                   "(define d (mac (name val) (prep 'define (prep name (prep val '())))))\n"
+                   "(d g (fn () 10))\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, content):
+        with open(self.filename, 'w') as f:
+            f.write(content)
+
+    def load(self):
+        with open(self.filename) as f:
+            return load.load(f, self.filename, Env())
+
+    def test_cache(self):
+        env = self.load()
+        self.assertTrue(os.path.exists(self.filename + 'c'))
+        self.assertEqual(parable.eval(read_str('(f)'), env), Symbol('foo'))
+
+        # the second time, the forms come from the cache already
+        # expanded, along with their locations.
+        stats = dict(parable.macro_stats)
+        env = self.load()
+        self.assertEqual(parable.macro_stats, stats)
+        self.assertEqual(parable.eval(read_str('(g)'), env), 10)
+        self.assertEqual(env[Symbol('f')].body.filename, self.filename)
+        self.assertEqual(env[Symbol('f')].body.start_row, 1)
+
+    def test_dict_env(self):
+        # any mapping will do as the environment, cached or not.
+        for i in xrange(2):
+            with open(self.filename) as f:
+                env = load.load(f, self.filename, {})
+            self.assertEqual(parable.eval(read_str('(g)'), env), 10)
+        self.assertTrue(os.path.exists(self.filename + 'c'))
+
+    def test_invalidation(self):
+        self.load()
+        self.write("(define g (fn () 20))\n")
+        env = self.load()
+        self.assertEqual(parable.eval(read_str('(g)'), env), 20)
+
+    def test_loaded_files(self):
+        # the expansions of a file depend on the files loaded before it.
+        other = os.path.join(self.dir, 'other.lisp')
+        with open(other, 'w') as f:
+            f.write("(define v (m bar))\n")
+
+        for name in ['foo', 'bar']:
+            self.write("(define m (mac (x) (prep 'quote (prep '{} '()))))\n".format(name))
+            env = self.load()
+            with open(other) as f:
+                load.load(f, other, env)
+            self.assertEqual(env[Symbol('v')], Symbol(name))
+            self.assertEqual([i for i, _ in env.loaded], [self.filename, other])
+
+        # nothing is cached after a file loaded without a key.
+        env = Env()
+        load.load(StringIO("(define m (mac (x) ''baz))"), '<string>', env)
+        with open(other) as f:
+            load.load(f, other, env)
+        self.assertEqual(env[Symbol('v')], Symbol('baz'))
+        self.assertEqual(env.loaded[-1], (other, None))
+
+class ImageTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'test.img')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_image(self):
+        for evaluate in [parable.eval, vm.eval]:
+            env = Env()
+            env[Symbol('m')] = evaluate(read_str("(mac (x) (prep 'quote (prep x '())))"), env)
+            env[Symbol('fs')] = evaluate(read_str(
+                "((fn (x) (prep (fn () x) (prep (fn () (prep (m x) x)) '()))) '(10))"), env)
+            load.dump_image(env, self.filename)
+
+            env = load.load_image(self.filename)
+            self.assertEqual(evaluate(read_str("((first fs))"), env), [10])
+            self.assertEqual(evaluate(read_str("((1 fs))"), env), [Symbol('x'), 10])
+
+            # shared structure is kept.
+            fs = env[Symbol('fs')]
+            self.assertTrue(fs[0].env.values[0] is fs[1].env.values[0])
+            self.assertTrue(fs[0].env.parent is env)
+
+    def test_stdlib_definitions(self):
+        # the native forms still stand for the stdlib definitions in an
+        # image.
+        env = Env()
+        with open('stdlib.lisp') as f:
+            load.load(f, 'stdlib.lisp', env, use_cache=False)
+        load.dump_image(env, self.filename)
+
+        env = load.load_image(self.filename)
+        self.assertTrue(env.stdlib[Symbol('cond')] is env[Symbol('cond')])
+        self.assertEqual(len(env.stdlib), len(parable.derived_forms))
+
+    def test_native_off(self):
+        # images are written before the native functions are installed,
+        # so --native off gets the Lisp versions from one.
+        def run(*args):
+            return subprocess.check_output(
+                [sys.executable, 'load.py', '--no-cache'] + list(args))
+
+        run('-l', 'stdlib.lisp', '--dump-image', self.filename)
+        env = load.load_image(self.filename)
+        self.assertNotEqual(type(env[Symbol('append')].code), parable.CompiledCode)
+
+        for mode in ['on', 'off', 'check']:
+            self.assertEqual(run('--image', self.filename, '--native', mode,
+                                 '-e', "(append '(1) '(2))"),
+                             'Evaluation Result: (1 2)\n')
+
+        copy = os.path.join(self.dir, 'copy.img')
+        run('--image', self.filename, '--native', 'off', '--dump-image', copy)
+        env = load.load_image(copy)
+        self.assertNotEqual(type(env[Symbol('append')].code), parable.CompiledCode)
+
+    def test_closure_engine(self):
+        env = Env()
+        env[Symbol('f')] = compile.eval(read_str("(fn () 1)"), env)
+        with self.assertRaises(load.LoadError):
+            load.dump_image(env, self.filename)
+
+class VectorTest(unittest.TestCase):
+    def test_conversion(self):
+        result = eval_str("(vec '(1 2 3))")
+        self.assertEqual(result, parable.Vector([1, 2, 3]))
+        self.assertEqual(eval_str("(vlist (vec '(1 2 3)))"), [1, 2, 3])
+        self.assertEqual(eval_str("(vlen (vec nil))"), 0)
+        self.assertEqual(eval_str("(typeof (vec nil))"), Symbol('vec'))
+        self.assertEqual(pprint(result), '#v(1 2 3)')
+
+        self.assertEqual(eval_str("(vec '(1 a))"), create_error(':type-error'))
+        self.assertEqual(eval_str("(vec 1)"), create_error(':type-error'))
+        self.assertEqual(eval_str("(vlist '(1))"), create_error(':type-error'))
+
+    def test_arithmetic(self):
+        self.assertEqual(eval_str("(vlist (vadd (vec '(1 2 3)) (vec '(10 20 30))))"), [11, 22, 33])
+        self.assertEqual(eval_str("(vlist (vmul (vec '(1 2 3)) (vec '(10 20 30))))"), [10, 40, 90])
+        self.assertEqual(eval_str("(vdot (vec '(1 2 3)) (vec '(4 5 6)))"), 32)
+        self.assertEqual(eval_str("(vsum (vec '(1 2 3)))"), 6)
+        self.assertEqual(eval_str("(vsum (vec nil))"), 0)
+        self.assertEqual(eval_str("(vmin (vec '(3 -1 2)))"), -1)
+        self.assertEqual(eval_str("(vmax (vec '(3 -1 2)))"), 3)
+
+        self.assertEqual(eval_str("(vadd (vec '(1)) (vec '(1 2)))"), create_error(':value-error'))
+        self.assertEqual(eval_str("(vdot (vec '(1)) (vec nil))"), create_error(':value-error'))
+        self.assertEqual(eval_str("(vmax (vec nil))"), create_error(':value-error'))
+        if parable.numpy is None:
+            exp = "(vadd (vec '({0})) (vec '({0})))".format(2 ** (parable.vector_bits - 2))
+            self.assertEqual(eval_str(exp), create_error(':value-error'))
+
+    def test_sum_overflow(self):
+        largest = 2 ** (parable.vector_bits - 1) - 1
+        exp = "(vsum (vec '({0} {0})))".format(largest)
+        if parable.numpy is None:
+            self.assertEqual(eval_str(exp), create_error(':value-error'))
+        else:
+            # NumPy wraps around.
+            self.assertEqual(eval_str(exp), -2)
+        self.assertEqual(eval_str("(vsum (vec '({} -1)))".format(largest)),
+                         largest - 1)
+
+    def test_dot_overflow(self):
+        half = 2 ** (parable.vector_bits / 2)
+        exp = "(vdot (vec '({0})) (vec '({0})))".format(half)
+        if parable.numpy is None:
+            self.assertEqual(eval_str(exp), create_error(':value-error'))
+        else:
+            self.assertEqual(eval_str(exp), 0)
+        self.assertEqual(eval_str("(vdot (vec '({})) (vec '(2)))".format(half)),
+                         half * 2)
+
+    def test_slice(self):
+        self.assertEqual(eval_str("(vlist (vslice (vec '(1 2 3 4)) 1 2))"), [2, 3])
+        self.assertEqual(eval_str("(vlist (vslice (vec '(1 2 3 4)) 3 10))"), [4])
+        self.assertEqual(eval_str("(vlist (vslice (vec '(1 2 3 4)) 4 1))"), [])
+
+    def test_eq(self):
+        self.assertEqual(eval_str("(eq (vec '(1 2)) (vec '(1 2)))"), Bool(True))
+        self.assertEqual(eval_str("(eq (vec '(1 2)) (vec '(1 3)))"), Bool(False))
+        self.assertEqual(eval_str("(eq (vec '(1 2)) '(1 2))"), Bool(False))
+
+class NativeTest(unittest.TestCase):
+    def stdlib(self, check):
+        env = Env()
+        for lib in ['stdlib.lisp', 'bq.lisp']:
+            with open(lib) as f:
+                load.load(f, lib, env, use_cache=False)
+        native.install(env, check=check)
+        return env
+
+    def test_differential(self):
+        # in check mode, the native functions return a :native-mismatch
+        # error if the Lisp version returns something else.
+        env = self.stdlib(True)
+        exps = [
+            "(append '(1 2) nil '(3) '(4 5))",
+            "(append2 (list 1 (error :foo)) '(2))",
+            "(append2 '(1) 2)",
+            "(mapf ++ '(1 2 3))",
+            "(mapf (fn (x y) x) '(1 2))",
+            "(map + '(1 2 3) '(10 20))",
+            "(map 1 '((1 2) (3 4)))",
+            "(len \"foo\")",
+            "(len 10)",
+            "(reduce + '(1 2 3 4))",
+            "(reduce + nil)",
+            "(reduce 1 '(1 2))",
+            "(= '(1 (2 \"x\")) '(1 (2 \"x\")))",
+            "(= '(1 2) '(1 2 3))",
+            "(= 1 \"1\")",
+            "(+ 1 2 3)",
+            "(+ 1 \"2\")",
+            "(* 2 3 4)",
+            "(* (error :foo) 2)",
+            "(max '(3 1 3 2))",
+            "(min '(3 1 1 2))",
+            "(max nil)",
+            "(remove 2 '(1 2 3 2))",
+            "(zip '(1 2 3) '(a b))",
+            "(zip1 '((1 2) (error :foo)))",
+            "(assoc :b '(:a 1 :b 2))",
+            "(assoc :c '(:a 1 :b))",
+            "(assoc :c '(:a 1))",
+            "(assoc :c 10)",
+            "(bq-process '(a (unquote b) (c d) (unquote-splicing e) (f (unquote g))) 1)",
+            "(bq-process '(a (backquote (b (unquote (unquote c)) (unquote-splicing d)))) 1)",
+            "(bq-process '(a (quote (unquote b))) 1)",
+            "(bq-process '(unquote a) 1)",
+            "(bq-process '(unquote-splicing a) 1)",
+            "(bq-process '(a (unquote)) 1)",
+            "(bq-process 'a 1)",
+            "(bq-process nil 1)",
+        ]
+        for exp in exps:
+            result = parable.eval(read_str(exp), env)
+            self.assertNotEqual(result, create_error(':native-mismatch'), exp)
+
+        # make sure a difference is noticed.
+        append2 = env[Symbol('append2')].code.run
+        impl = append2.impl
+        append2.impl = lambda lisp, l1, l2: l1
+        try:
+            result = parable.eval(read_str("(append2 '(1) '(2))"), env)
+        finally:
+            append2.impl = impl
+        self.assertEqual(result, create_error(':native-mismatch'))
+
+    def test_long_lists(self):
+        env = self.stdlib(False)
+        env[Symbol('big')] = List(Integer(i) for i in xrange(10000))
+        self.assertEqual(parable.eval(read_str("(len (mapf ++ big))"), env), 10000)
+        self.assertEqual(parable.eval(read_str("(max (append big big))"), env), 9999)
+        self.assertEqual(parable.eval(read_str("(apply + big)"), env), 49995000)
+
+        # they are still functions.
+        self.assertEqual(parable.eval(read_str("(typeof len)"), env), Symbol('function'))
+        self.assertEqual(pprint(env[Symbol('len')]), pprint(self.stdlib(False)[Symbol('len')]))
+
+    def test_backquote(self):
+        # templates expand to the simplest code that makes them.
+        env = self.stdlib(False)
+        for exp, expansion in [
+                ("`(a (b c))", "'(a (b c))"),
+                ("`(a ,b (c ,d))", "(list 'a b (list 'c d))"),
+                ("`(a ,@b c ,'d)", "(append '(a) b '(c d))"),
+                ("`(,@a)", "(append a)"),
+                ("`()", "'()")]:
+            result, expanded = parable.macro_expand(read_str(exp), env)
+            self.assertTrue(expanded)
+            self.assertEqual(result, read_str(expansion))
+
 if __name__ == '__main__':
     unittest.main()
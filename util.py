@@ -8,7 +8,10 @@ def assoc(l, k):
 
     '''
 
-    if not isinstance(l, list):
+    # imported here, as parable imports this module.
+    from parable import List
+
+    if not isinstance(l, (list, List)):
         raise InvalidAssocList()
 
     if len(l) % 2 != 0:
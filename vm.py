@@ -0,0 +1,652 @@
+from array import array
+
+from parable import Symbol, List, Integer, String, Error, Function, Macro, \
+    Frame, CompiledCode, ParamError, Primitive, Message, create_error, lookup, \
+    check_function_params, collect_references, collect_heads, may_expand, \
+    expand_macro_call, eval_function_composition, eval as eval_tree, \
+    special_forms as tree_forms, true, false, empty_list, arg_list, \
+    copy_location, locate
+from compile import Scope, find, scope_depth, parent_at
+from pprint import pprint
+
+# The bytecode engine compiles a form into a flat array of 16-bit words
+# (an opcode followed by its operands) and a constant pool, and runs it
+# in a single dispatch loop with its own value stack and call stack.
+# Calls between functions compiled to bytecode only push a call frame,
+# so deep recursion does not use Python stack frames. Functions made by
+# the other engines, and macros, are called through the tree-walker.
+#
+# Local variables use the same (depth, slot) addressing in a Frame
+# chain as the closure compiler, so functions created by any engine can
+# be called from the others.
+
+# opcodes; the operands each one takes are listed in `operands` below.
+LOCAL0 = 0      # slot: push a variable of the innermost frame.
+LOCAL1 = 1      # slot: push a variable of the enclosing frame.
+LOCAL = 2       # depth slot: push a variable of an outer frame.
+GLOBAL = 3      # depth const: look a symbol up past the local frames;
+                # the const is the symbol and its location, or None.
+CONST = 4       # const: push a constant.
+NIL = 5         # push an empty list.
+PRIM = 6        # const nargs: call a primitive on the top nargs values.
+CALL = 7        # nargs const: call the function below the arguments.
+TAILCALL = 8    # nargs const: like CALL, reusing the current call frame.
+MACRO = 9       # const target: expand a call if its head is a macro.
+IF = 10         # else-target end-target const: branch on a boolean.
+JUMP = 11       # target: continue at target.
+RETURN = 12     # return the top of the stack to the caller.
+FN = 13         # const ncaptured: make a function.
+MAC = 14        # const: make a macro.
+APPLY = 15      # const tail: apply a function to a list of arguments.
+COMPOSE = 16    # const: evaluate a function composition symbol.
+ERROR = 17      # const: push a new error made from create_error args.
+TREE = 18       # const: evaluate a form with the tree-walker.
+
+opnames = ['LOCAL0', 'LOCAL1', 'LOCAL', 'GLOBAL', 'CONST', 'NIL', 'PRIM',
+           'CALL', 'TAILCALL', 'MACRO', 'IF', 'JUMP', 'RETURN', 'FN', 'MAC',
+           'APPLY', 'COMPOSE', 'ERROR', 'TREE']
+
+operands = [1, 1, 2, 2, 1, 0, 2, 2, 2, 2, 3, 1, 0, 2, 1, 2, 1, 1, 1]
+
+class Code(object):
+    '''A compiled form: the instruction words, the constant pool the
+    instructions refer to, and the form it was compiled from. Calling
+    it with an environment runs it.
+
+    '''
+
+    __slots__ = ['ops', 'consts', 'form']
+
+    def __init__(self, ops, consts, form):
+        self.ops = ops
+        self.consts = consts
+        self.form = form
+
+    def __call__(self, env):
+        return run(self, env)
+
+    def __repr__(self):
+        return '<Code {} words, {} constants>'.format(len(self.ops),
+                                                      len(self.consts))
+
+class FunctionTemplate(object):
+    '''The constant behind an FN instruction: everything about a fn form
+    that does not depend on the values it is closed over. The heads are
+    the calls in the body that may be macros (see may_expand); when one
+    is, the function runs in the whole environment, with the code
+    assembled for it in the scope of the fn form.
+
+    '''
+
+    __slots__ = ['params', 'body', 'names', 'code', 'captured', 'depth',
+                 'heads', 'scope', 'full_code']
+
+    def __init__(self, params, body, names, code, captured, depth, heads,
+                 scope):
+        self.params = params
+        self.body = body
+        self.names = names
+        self.code = code
+        self.captured = captured
+        self.depth = depth
+        self.heads = heads
+        self.scope = scope
+        self.full_code = None
+
+    def expanding_code(self):
+        if self.full_code is None:
+            self.full_code = CompiledCode(
+                assemble(self.body, Scope(self.names, self.scope), True))
+        return self.full_code
+
+    def __repr__(self):
+        return '<FunctionTemplate params={}>'.format(self.params)
+
+class MacroSite(object):
+    '''The constant behind a MACRO instruction: a call form whose head
+    may turn out to be a macro, the scope it appears in and the code
+    compiled for its expansion by the last macro seen there.
+
+    '''
+
+    __slots__ = ['form', 'scope', 'tail', 'macro', 'code']
+
+    def __init__(self, form, scope, tail):
+        self.form = form
+        self.scope = scope
+        self.tail = tail
+        self.macro = None
+        self.code = None
+
+    def expansion(self, macro):
+        if self.macro is not macro:
+            expanded = expand_macro_call(macro, self.form)
+            self.code = assemble(expanded, self.scope, self.tail)
+            self.macro = macro
+        return self.code
+
+    def __repr__(self):
+        return '<MacroSite {}>'.format(self.form)
+
+class OperandError(Exception):
+    '''Raised by the assembler when an operand does not fit in a word:
+    a form too long to jump over, or with too many constants or
+    arguments. assemble turns it into a Lisp error.
+
+    '''
+
+def check_operand(value):
+    if not 0 <= value <= 0xffff:
+        raise OperandError('Operand out of range: {}.'.format(value))
+
+class Assembler(object):
+    '''Collects the instruction words and constants of one Code object.
+    Each constant is only added to the pool once, keyed by identity.
+
+    '''
+
+    def __init__(self):
+        self.ops = []
+        self.consts = []
+        self.indexes = {}
+
+    def emit(self, op, *args):
+        for i in args:
+            check_operand(i)
+        self.ops.append(op)
+        self.ops.extend(args)
+
+    def const(self, value):
+        index = self.indexes.get(id(value))
+        if index is None:
+            # the pool keeps value alive, so its id is not reused.
+            index = len(self.consts)
+            self.consts.append(value)
+            self.indexes[id(value)] = index
+        return index
+
+    def label(self):
+        return len(self.ops)
+
+    def patch(self, pos, value):
+        check_operand(value)
+        self.ops[pos] = value
+
+def assemble(exp, scope, tail):
+    asm = Assembler()
+    try:
+        compile_exp(asm, exp, scope, tail)
+        asm.emit(RETURN)
+    except OperandError as e:
+        asm = Assembler()
+        compile_error(asm, ':form-error',
+                      ':msg', 'Form too large for the bytecode engine. ' + str(e),
+                      ':form', exp)
+        asm.emit(RETURN)
+    return Code(array('H', asm.ops), asm.consts, exp)
+
+def compile_error(asm, *args):
+    asm.emit(ERROR, asm.const(args))
+
+def compile_symbol(asm, exp, scope, location=None):
+    if exp.kind == Symbol.NIL:
+        asm.emit(NIL)
+    elif exp.kind == Symbol.KEYWORD:
+        asm.emit(CONST, asm.const(exp))
+    elif exp.kind == Symbol.COMPOSITION:
+        asm.emit(COMPOSE, asm.const(exp))
+    else:
+        address = find(scope, exp)
+        if address is None:
+            asm.emit(GLOBAL, scope_depth(scope), asm.const((exp, location)))
+        elif address[0] == 0:
+            asm.emit(LOCAL0, address[1])
+        elif address[0] == 1:
+            asm.emit(LOCAL1, address[1])
+        else:
+            asm.emit(LOCAL, *address)
+
+def compile_item(asm, form, i, scope, tail):
+    # item i of form. Symbols have no location of their own; errors
+    # about one take its location in form (see List.item_location).
+    exp = form[i]
+    if type(exp) == Symbol:
+        return compile_symbol(asm, exp, scope, form.item_location(i))
+    compile_exp(asm, exp, scope, tail)
+
+def compile_fn(asm, exp, scope, tail):
+    if len(exp) != 3:
+        return compile_error(asm, ':form-error',
+                             ':msg', 'Invalid fn expression.',
+                             ':form', exp)
+
+    params = exp[1]
+    body = exp[2]
+    try:
+        check_function_params(params)
+    except ParamError as e:
+        return compile_error(asm, ':param-error',
+                             ':msg', str(e),
+                             ':form', params)
+
+    # push the local variables of the enclosing scopes the body refers
+    # to; FN keeps them in the closure frame.
+    names = tuple(p for p in params if p != Symbol('&'))
+    captured = []
+    for name in collect_references(body, frozenset(names), []):
+        if find(scope, name) is not None:
+            compile_symbol(asm, name, scope)
+            captured.append(name)
+    captured = tuple(captured)
+
+    if captured:
+        body_scope = Scope(names, Scope(captured, None))
+    else:
+        body_scope = Scope(names, None)
+    code = CompiledCode(assemble(body, body_scope, True))
+    heads = tuple(collect_heads(body, frozenset(names), [])) if scope else ()
+    template = FunctionTemplate(params, body, names, code, captured,
+                                scope_depth(scope), heads, scope)
+    asm.emit(FN, asm.const(template), len(captured))
+
+def compile_mac(asm, exp, scope, tail):
+    if len(exp) != 3:
+        return compile_error(asm, ':form-error',
+                             ':msg', 'Invalid mac expression.',
+                             ':form', exp)
+    asm.emit(MAC, asm.const(exp))
+
+def compile_if(asm, exp, scope, tail):
+    if len(exp) != 4:
+        return compile_error(asm, ':arg-error',
+                             ':msg', '`if` form accepts exactly 3 arguments; {} given.'.format(len(exp) - 1),
+                             ':form', exp)
+
+    compile_item(asm, exp, 1, scope, False)
+    branch = asm.label()
+    asm.emit(IF, 0, 0, asm.const(exp))
+    compile_item(asm, exp, 2, scope, tail)
+    jump = asm.label()
+    asm.emit(JUMP, 0)
+    asm.patch(branch + 1, asm.label())
+    compile_item(asm, exp, 3, scope, tail)
+    asm.patch(branch + 2, asm.label())
+    asm.patch(jump + 1, asm.label())
+
+def compile_quote(asm, exp, scope, tail):
+    if len(exp) != 2:
+        return compile_error(asm, ':arg-error',
+                             ':msg', '`quote` form accepts exactly one argument; got {} instead.'.format(len(exp) - 1),
+                             ':form', exp)
+    asm.emit(CONST, asm.const(exp[1]))
+
+def compile_apply(asm, exp, scope, tail):
+    if len(exp) != 3:
+        return compile_error(asm, ':arg-error',
+                             ':msg', '`apply` expects 2 arguments; {} given.'.format(len(exp) - 1),
+                             ':form', exp)
+
+    compile_item(asm, exp, 1, scope, False)
+    compile_item(asm, exp, 2, scope, False)
+    asm.emit(APPLY, asm.const(exp), 1 if tail else 0)
+
+def compile_tree(asm, exp, scope, tail):
+    # forms without a compiler of their own are left to the tree-walker;
+    # the Frame chain carries the names it needs to look variables up.
+    asm.emit(TREE, asm.const(exp))
+
+def compile_primitive(asm, prim, exp, scope):
+    error = prim.check_arity(exp)
+    if error is not None:
+        return asm.emit(CONST, asm.const(error))
+
+    for i in xrange(1, len(exp)):
+        compile_item(asm, exp, i, scope, False)
+    asm.emit(PRIM, asm.const((prim, exp)), len(exp) - 1)
+
+def compile_call(asm, exp, scope, tail):
+    compile_item(asm, exp, 0, scope, False)
+    site = asm.label()
+    asm.emit(MACRO, asm.const(MacroSite(exp, scope, tail)), 0)
+    for i in xrange(1, len(exp)):
+        compile_item(asm, exp, i, scope, False)
+    asm.emit(TAILCALL if tail else CALL, len(exp) - 1, asm.const(exp))
+    asm.patch(site + 2, asm.label())
+
+special_forms = {
+    'fn': compile_fn,
+    'mac': compile_mac,
+    'if': compile_if,
+    'quote': compile_quote,
+    'apply': compile_apply,
+    'error': compile_tree,
+}
+
+def compile_exp(asm, exp, scope, tail):
+    t = type(exp)
+    if t == Symbol:
+        return compile_symbol(asm, exp, scope)
+    elif t != List:
+        return asm.emit(CONST, asm.const(exp))
+    elif len(exp) == 0:
+        return asm.emit(NIL)
+
+    head = exp[0]
+    if type(head) == Symbol:
+        if head.name in special_forms:
+            return special_forms[head.name](asm, exp, scope, tail)
+        prim = tree_forms.get(head)
+        if type(prim) == Primitive:
+            return compile_primitive(asm, prim, exp, scope)
+
+    compile_call(asm, exp, scope, tail)
+
+def call_value(func, args, form):
+    '''Calls something that is not a bytecode function with a Python list
+    of arguments: an integer index, or a function made by another
+    engine. Returns the result.
+
+    '''
+
+    if isinstance(func, Function):
+        env = func.frame(args)
+        if env is None:
+            return func.arg_error(arg_list(args, form))
+        return eval_tree(func.code, env)
+
+    if isinstance(func, Integer):
+        if len(args) != 1:
+            return create_error(':arg-error',
+                                ':msg', 'Index form with more than one argument.',
+                                ':form', form)
+
+        second = args[0]
+        if not isinstance(second, (List, String)):
+            return create_error(':type-error',
+                                ':msg', 'Only lists and strings can be indexed.',
+                                ':form', form[1])
+
+        if func < 0 or func > len(second) - 1:
+            return create_error(':index-error',
+                                ':msg', 'Index {} not valid for the given argument.'.format(func),
+                                ':form', form[0])
+
+        if isinstance(second, List):
+            return second[func]
+        else:
+            return String(second[func])
+
+    if isinstance(func, Error):
+        return func
+
+    error = create_error(':value-error',
+                         ':msg', 'Not a function or a macro: {}'.format(func),
+                         ':form', form[0])
+    locate(error, form)
+    return error
+
+# the most calls run can have in progress. Deeper non-tail recursion
+# stops with a :recursion-error rather than growing the call stack
+# until memory runs out; the tree-walker and the closure engine stop at
+# Python's recursion limit instead.
+max_depth = 100000
+
+def recursion_error(form):
+    return create_error(':recursion-error',
+                        ':msg', 'Maximum call depth exceeded.',
+                        ':form', form)
+
+def run(code, env):
+    '''Runs code in env and returns the result. A call that would go past
+    max_depth calls in progress ends the run, returning a
+    :recursion-error for it.
+
+    '''
+
+    stack = []
+    frames = []
+    ops = code.ops
+    consts = code.consts
+    pc = 0
+
+    while True:
+        op = ops[pc]
+
+        if op == LOCAL0:
+            stack.append(env.values[ops[pc + 1]])
+            pc += 2
+        elif op == GLOBAL:
+            symbol, location = consts[ops[pc + 2]]
+            value = lookup(parent_at(env, ops[pc + 1]), symbol)
+            if value is None:
+                value = create_error(':variable-error',
+                                     ':msg', Message('Unbound variable: {}', symbol.name),
+                                     ':form', symbol)
+                if location is not None:
+                    copy_location(value, location)
+            stack.append(value)
+            pc += 3
+        elif op == LOCAL1:
+            stack.append(env.parent.values[ops[pc + 1]])
+            pc += 2
+        elif op == CONST:
+            stack.append(consts[ops[pc + 1]])
+            pc += 2
+        elif op == PRIM:
+            prim, form = consts[ops[pc + 1]]
+            n = ops[pc + 2]
+            args = stack[-n:]
+            del stack[-n:]
+            stack.append(prim.apply(args, form))
+            pc += 3
+        elif op == MACRO:
+            if type(stack[-1]) == Macro:
+                site = consts[ops[pc + 1]]
+                expansion = site.expansion(stack.pop())
+                if not site.tail:
+                    if len(frames) >= max_depth:
+                        return recursion_error(site.form)
+                    frames.append((code, ops[pc + 2], env))
+                code = expansion
+                ops = code.ops
+                consts = code.consts
+                pc = 0
+            else:
+                pc += 3
+        elif op == CALL or op == TAILCALL:
+            n = ops[pc + 1]
+            form = consts[ops[pc + 2]]
+            pc += 3
+            if n:
+                values = stack[-n:]
+                del stack[-n:]
+            else:
+                values = []
+            func = stack.pop()
+
+            if type(func) == Function and type(func.code) == CompiledCode and \
+               type(func.code.run) == Code:
+                frame = func.frame(values)
+                if frame is None:
+                    stack.append(func.arg_error(arg_list(values, form)))
+                    continue
+                if op == CALL:
+                    if len(frames) >= max_depth:
+                        return recursion_error(form)
+                    frames.append((code, pc, env))
+                code = func.code.run
+                ops = code.ops
+                consts = code.consts
+                env = frame
+                pc = 0
+            else:
+                stack.append(call_value(func, values, form))
+        elif op == IF:
+            cond = stack.pop()
+            if cond is true:
+                pc += 4
+            elif type(cond) == Error:
+                stack.append(cond)
+                pc = ops[pc + 2]
+            elif cond is false:
+                pc = ops[pc + 1]
+            elif cond == true:
+                # an integer 1 or 0; see parable.condition.
+                pc += 4
+            elif cond == false:
+                pc = ops[pc + 1]
+            else:
+                form = consts[ops[pc + 3]]
+                error = create_error(':type-error',
+                                     ':msg', Message('`if` condition can only be a boolean; got a {} instead.', type(cond).__name__),
+                                     ':form', form[1])
+                locate(error, form)
+                stack.append(error)
+                pc = ops[pc + 2]
+        elif op == RETURN:
+            if not frames:
+                return stack.pop()
+            code, pc, env = frames.pop()
+            ops = code.ops
+            consts = code.consts
+        elif op == JUMP:
+            pc = ops[pc + 1]
+        elif op == NIL:
+            stack.append(empty_list)
+            pc += 1
+        elif op == LOCAL:
+            stack.append(parent_at(env, ops[pc + 1]).values[ops[pc + 2]])
+            pc += 3
+        elif op == FN:
+            template = consts[ops[pc + 1]]
+            n = ops[pc + 2]
+            if template.heads and may_expand(template.heads, env):
+                # the captured values are in env already.
+                del stack[len(stack) - n:]
+                body_code = template.expanding_code()
+                closure = env
+            else:
+                body_code = template.code
+                closure = parent_at(env, template.depth)
+                if n:
+                    closure = Frame(template.captured, stack[-n:], closure)
+                    del stack[-n:]
+            stack.append(Function.compiled(template.params, template.body,
+                                           template.names, body_code, closure))
+            pc += 3
+        elif op == MAC:
+            form = consts[ops[pc + 1]]
+            try:
+                stack.append(Macro(form[1], form[2], env))
+            except ParamError as e:
+                stack.append(create_error(':param-error',
+                                          ':msg', 'Invalid macro parameter list: ' + str(e),
+                                          ':form', form[1]))
+            pc += 2
+        elif op == APPLY:
+            form = consts[ops[pc + 1]]
+            tail = ops[pc + 2]
+            pc += 3
+            args = stack.pop()
+            func = stack.pop()
+            if isinstance(func, Error):
+                stack.append(func)
+                continue
+            if not isinstance(func, Function):
+                stack.append(create_error(':type-error',
+                                          ':msg', '`apply` first argument must be a function; got {}.'.format(func),
+                                          ':form', form[1]))
+                continue
+            if isinstance(args, Error):
+                stack.append(args)
+                continue
+            if not isinstance(args, (list, List)):
+                stack.append(create_error(':type-error',
+                                          ':msg', 'A list not passed as function argument list.',
+                                          ':form', args))
+                continue
+
+            frame = func.bind(args)
+            if isinstance(frame, Error):
+                stack.append(frame)
+            elif type(func.code) == CompiledCode and type(func.code.run) == Code:
+                if not tail:
+                    if len(frames) >= max_depth:
+                        return recursion_error(form)
+                    frames.append((code, pc, env))
+                code = func.code.run
+                ops = code.ops
+                consts = code.consts
+                env = frame
+                pc = 0
+            else:
+                stack.append(eval_tree(func.code, frame))
+        elif op == COMPOSE:
+            stack.append(eval_function_composition(consts[ops[pc + 1]], env))
+            pc += 2
+        elif op == ERROR:
+            stack.append(create_error(*consts[ops[pc + 1]]))
+            pc += 2
+        elif op == TREE:
+            stack.append(eval_tree(consts[ops[pc + 1]], env))
+            pc += 2
+        else:
+            raise RuntimeError('Invalid opcode {} at {}.'.format(op, pc))
+
+def disassemble(code, indent=''):
+    '''Returns a listing of the instructions in code, one per line,
+    followed by the listings of the functions defined in it.
+
+    '''
+
+    lines = []
+    nested = []
+    ops = code.ops
+    pc = 0
+    while pc < len(ops):
+        op = ops[pc]
+        args = list(ops[pc + 1:pc + 1 + operands[op]])
+        line = '{}{:5} {:9}{}'.format(indent, pc, opnames[op],
+                                      ' '.join(str(i) for i in args)).rstrip()
+
+        # show the constant the instruction refers to.
+        if op in (CONST, PRIM, MACRO, FN, MAC, APPLY, COMPOSE, ERROR, TREE):
+            const = code.consts[args[0]]
+        elif op == GLOBAL:
+            const = code.consts[args[1]][0]
+        elif op in (CALL, TAILCALL):
+            const = code.consts[args[1]]
+        elif op == IF:
+            const = code.consts[args[2]]
+        else:
+            const = None
+
+        if op == FN:
+            nested.append(const)
+        if const is not None:
+            line = '{:32} ; {}'.format(line, describe(const))
+
+        lines.append(line)
+        pc += 1 + operands[op]
+
+    for template in nested:
+        lines.append('')
+        lines.append('{}fn {}:'.format(indent, pprint(template.params)))
+        lines.append(disassemble(template.code.run, indent + '    '))
+
+    return '\n'.join(lines)
+
+def describe(const):
+    if isinstance(const, tuple) and len(const) == 2 and \
+       isinstance(const[0], Primitive):
+        return const[0].name
+    if isinstance(const, tuple):
+        return ' '.join(i if isinstance(i, str) else pprint(i) for i in const)
+    if isinstance(const, MacroSite):
+        return pprint(const.form)
+    if isinstance(const, FunctionTemplate):
+        return 'fn {}'.format(pprint(const.params))
+    return pprint(const)
+
+def eval(exp, env):
+    return assemble(exp, None, True)(env)